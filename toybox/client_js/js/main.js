@@ -107,13 +107,32 @@ function API(ctx, user, onUserChange){
     authHeadersProvider: ctx.firebase.withRequestAuthHeaders,
   });
 
-  function updateAppSchema(response) {
-    if (response.app) {
-      ctx.app = response.app;
-    }
+  function updateAppSchema(response, opt_callback) {
+    const callback = opt_callback || function() {};
     if (response.server) {
       ctx.server = response.server;
     }
+    if (!response.app) {
+      callback();
+      return;
+    }
+
+    // schema is fetched only when its version changes; browser caches it
+    const version = response.app.schema_version;
+    if (ctx.app && ctx.app.schema_version == version) {
+      callback();
+      return;
+    }
+    server.invoke(
+        '/api/rest/v1/schema/' + encodeURIComponent(version), 'GET', null,
+        function (schema) {
+          ctx.app = {schema_version: version, schema: schema};
+          callback();
+        },
+        function (error) {
+          ctx.handleError(error);
+        },
+    );
   }
 
   function asValidationError(error) {
@@ -141,8 +160,9 @@ function API(ctx, user, onUserChange){
         '/api/rest/v1/whoami', 'GET', null,
         function (response){
           ctx.loading.hide();
-          updateAppSchema(response);
-          callback(response.user);
+          updateAppSchema(response, function() {
+            callback(response.user);
+          });
         },
         function (error) {
           ctx.loading.hide();
@@ -49,6 +49,16 @@ function build_and_test_py3 {
   pushd "$APP_DIR/"
   $PY_BIN dao_test.py &>> "$LOG"
   $PY_BIN main_test.py &>> "$LOG"
+  $PY_BIN ratelimit_test.py &>> "$LOG"
+  $PY_BIN jobs_test.py &>> "$LOG"
+  $PY_BIN bloom_test.py &>> "$LOG"
+  $PY_BIN moderation_test.py &>> "$LOG"
+  $PY_BIN counters_test.py &>> "$LOG"
+  $PY_BIN compression_test.py &>> "$LOG"
+  $PY_BIN assets_test.py &>> "$LOG"
+  $PY_BIN fingerprint_test.py &>> "$LOG"
+  $PY_BIN serialization_test.py &>> "$LOG"
+  $PY_BIN fieldmask_test.py &>> "$LOG"
   popd
 }
 
@@ -110,6 +120,14 @@ function prepare_static_assets {
   cp "$JS_ENV_HOME"/release/js/*.* "$APP_DIR/static/js/"
 }
 
+# rename assets by content hash, so browsers can cache them forever
+function fingerprint_static_assets {
+  echo "Fingerprinting static assets in $APP_DIR/static"
+  pushd "$APP_DIR/"
+  $PY_BIN fingerprint.py --static_dir "$APP_DIR/static" &>> "$LOG"
+  popd
+}
+
 # build and test our project
 function build_and_test {
   rm -rf "$MANAGE_HOME"
@@ -118,6 +136,7 @@ function build_and_test {
   build_and_test_js
   build_and_test_py3
   prepare_static_assets
+  fingerprint_static_assets
 }
 
 
@@ -146,12 +165,19 @@ if [[ "$ACTION" == "deploy" ]]; then
 fi
 
 
+# execute action
+if [[ "$ACTION" == "fingerprint" ]]; then
+  fingerprint_static_assets
+  exit 0
+fi
+
+
 # print help text and list of actions
 echo ""
 echo "Usage:"
 echo "   bash manage.sh {command}"
 echo ""
 echo "Valid commands are:"
-echo "   [run, deploy]"
+echo "   [run, deploy, fingerprint]"
 echo ""
 exit 1
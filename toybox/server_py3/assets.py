@@ -0,0 +1,122 @@
+"""In-memory cache of static assets served with strong validators."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import flask
+import compression
+
+
+# maps asset name to its name with content hash; made by fingerprint.py
+MANIFEST_FILENAME = 'manifest.json'
+
+# fingerprinted assets are cached by browsers for a year and never revalidated
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# other assets can be cached, but must be revalidated with ETag before use
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+
+class Asset(object):
+  """Static asset with all its precomputed representations."""
+
+  def __init__(self, name, data, mimetype, compressor, is_fingerprinted):
+    self.name = name
+    self.data = data
+    self.mimetype = mimetype
+    self.etag = hashlib.sha256(data).hexdigest()
+    self.is_fingerprinted = is_fingerprinted
+
+    # encoding to compressed bytes; for encodings worth compressing only
+    self.variants = {}
+    if mimetype in compression.COMPRESSIBLE_MIMETYPES:
+      for encoding in compression.supported_encodings():
+        compressed = compressor.compress_data(data, encoding)
+        if compressed is not None:
+          self.variants[encoding] = compressed
+
+
+class AssetCache(object):
+  """Static assets of a folder loaded into memory on startup.
+
+  Each asset is read, hashed and compressed once; requests are then served
+  from memory with strong ETags, 304 for If-None-Match and partial content
+  for Range requests. Assets listed as fingerprinted in the manifest are
+  served as immutable.
+  """
+
+  def __init__(self, root_dir, compressor):
+    self.root_dir = root_dir
+    self.compressor = compressor
+    self.assets = {}
+    self.manifest = {}
+
+  def load(self):
+    """Loads all files under root_dir; returns number of bytes loaded."""
+    manifest = {}
+    filename = os.path.join(self.root_dir, MANIFEST_FILENAME)
+    if os.path.isfile(filename):
+      with open(filename, 'r') as stream:
+        manifest = json.load(stream)
+    fingerprinted = set(manifest.values())
+
+    assets = {}
+    total = 0
+    for dirname, _, filenames in os.walk(self.root_dir):
+      for filename in filenames:
+        filename = os.path.join(dirname, filename)
+        name = os.path.relpath(filename, self.root_dir).replace(os.sep, '/')
+        if name == MANIFEST_FILENAME:
+          continue
+        mimetype = mimetypes.guess_type(filename)[0] or 'text/plain'
+        with open(filename, 'rb') as stream:
+          data = stream.read()
+        assets[name] = Asset(name, data, mimetype, self.compressor,
+                             name in fingerprinted)
+        total += len(data)
+    self.assets = assets
+    self.manifest = manifest
+    logging.info('Loaded %s static assets, %s bytes', len(assets), total)
+    return total
+
+  def get(self, name):
+    return self.assets.get(name)
+
+  def serve(self, request, name):
+    """Returns response for the asset or None if there is no such asset."""
+    asset = self.get(name)
+    if not asset:
+      return None
+
+    # ranges are served from the original bytes; this is what they point to
+    encoding = None
+    if asset.variants and 'Range' not in request.headers:
+      encoding = self.compressor.negotiate(request)
+      if encoding not in asset.variants:
+        encoding = None
+
+    if encoding:
+      response = flask.Response(asset.variants[encoding], 200,
+                                mimetype=asset.mimetype)
+      response.headers['Content-Encoding'] = encoding
+      response.set_etag('%s-%s' % (asset.etag, encoding))
+    else:
+      response = flask.Response(asset.data, 200, mimetype=asset.mimetype)
+      response.set_etag(asset.etag)
+    if asset.variants:
+      response.vary.add('Accept-Encoding')
+
+    if asset.is_fingerprinted:
+      response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+      response.headers['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+
+    return response.make_conditional(
+        request, accept_ranges=not encoding,
+        complete_length=None if encoding else len(asset.data))
@@ -0,0 +1,99 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import flask
+import assets
+import compression
+
+
+class AssetCacheTestSuite(unittest.TestCase):
+  """Test cases for AssetCache."""
+
+  def setUp(self):
+    super(AssetCacheTestSuite, self).setUp()
+    self.app = flask.Flask(__name__)
+    self.root_dir = tempfile.mkdtemp()
+    self.script = b'function main() { return 1; }\n' * 100
+    self._write('index.html', b'<html></html>')
+    self._write('js/app.0123abcd.js', self.script)
+    self._write('img/logo.png', b'\x89PNG' * 1000)
+    self._write(assets.MANIFEST_FILENAME, json.dumps(
+        {'js/app.js': 'js/app.0123abcd.js'}).encode('utf-8'))
+    self.cache = assets.AssetCache(
+        self.root_dir, compression.Compressor(min_bytes=100))
+    self.cache.load()
+
+  def tearDown(self):
+    shutil.rmtree(self.root_dir)
+    super(AssetCacheTestSuite, self).tearDown()
+
+  def _write(self, name, data):
+    filename = os.path.join(self.root_dir, name)
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as stream:
+      stream.write(data)
+
+  def _serve(self, name, headers=None):
+    with self.app.test_request_context('/%s' % name, headers=headers or {}):
+      return self.cache.serve(flask.request, name)
+
+  def test_load(self):
+    self.assertEqual(
+        ['img/logo.png', 'index.html', 'js/app.0123abcd.js'],
+        sorted(self.cache.assets.keys()))
+    self.assertEqual('text/html', self.cache.get('index.html').mimetype)
+    self.assertTrue(self.cache.get('js/app.0123abcd.js').is_fingerprinted)
+    self.assertFalse(self.cache.get('index.html').is_fingerprinted)
+    self.assertIn(
+        compression.GZIP, self.cache.get('js/app.0123abcd.js').variants)
+    self.assertFalse(self.cache.get('index.html').variants)
+    self.assertFalse(self.cache.get('img/logo.png').variants)
+    self.assertIsNone(self._serve('missing.html'))
+    self.assertIsNone(self._serve('../index.html'))
+
+  def test_not_modified(self):
+    response = self._serve('index.html')
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(b'<html></html>', response.get_data())
+    self.assertEqual('public, no-cache', response.headers['Cache-Control'])
+    etag, is_weak = response.get_etag()
+    self.assertFalse(is_weak)
+
+    response = self._serve('index.html', {'If-None-Match': '"%s"' % etag})
+    self.assertEqual(304, response.status_code)
+
+  def test_fingerprinted_is_immutable_and_compressed(self):
+    response = self._serve('js/app.0123abcd.js', {'Accept-Encoding': 'gzip'})
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(
+        assets.IMMUTABLE_CACHE_CONTROL, response.headers['Cache-Control'])
+    self.assertEqual('gzip', response.headers['Content-Encoding'])
+    self.assertEqual('Accept-Encoding', response.headers['Vary'])
+    self.assertEqual(self.script, gzip.decompress(response.get_data()))
+
+    response = self._serve('js/app.0123abcd.js')
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual(self.script, response.get_data())
+
+  def test_range(self):
+    response = self._serve('js/app.0123abcd.js', {
+        'Accept-Encoding': 'gzip', 'Range': 'bytes=0-7'})
+    self.assertEqual(206, response.status_code)
+    self.assertNotIn('Content-Encoding', response.headers)
+    self.assertEqual(b'function', response.get_data())
+    self.assertEqual(
+        'bytes 0-7/%s' % len(self.script), response.headers['Content-Range'])
+
+
+if __name__ == '__main__':
+  unittest.main()
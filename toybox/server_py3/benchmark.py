@@ -0,0 +1,213 @@
+"""Benchmarks of response encoding on payloads of typical sizes.
+
+Benchmarks are run from the command line, e.g.:
+
+  python3 benchmark.py compression
+  python3 benchmark.py compression --posts 10 --posts 500 --repeat 50
+  python3 benchmark.py json
+"""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import argparse
+import json
+import random
+import time
+import compression
+import serialization
+
+
+# number of posts in a response; from a single post to the full list
+DEFAULT_POST_COUNTS = [1, 10, 100, 500]
+DEFAULT_REPEAT = 20
+
+_WORDS = [
+    'the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', 'vote',
+    'post', 'member', 'server', 'client', 'cache', 'index', 'query', 'data',
+]
+
+
+def new_post(uid, rnd):
+  """Returns a post as it is returned by posts_query_to_list()."""
+  votes_up = rnd.randint(0, 100)
+  votes_down = rnd.randint(0, 100)
+  return {
+      'uid': uid,
+      'can_delete': rnd.random() < 0.1,
+      'data': {
+          'text': ' '.join([rnd.choice(_WORDS)
+                            for _ in range(rnd.randint(5, 60))]),
+      },
+      'my_vote_value': rnd.choice([None, 1, -1]),
+      'votes_up': votes_up,
+      'votes_down': votes_down,
+      'votes_total': votes_up - votes_down,
+      'views': rnd.randint(0, 10000),
+  }
+
+
+def new_posts_payload(count, seed=0):
+  """Returns body of posts list response with count posts."""
+  rnd = random.Random(seed)
+  return {
+      'app': {'schema_version': 'V1-0123456789ab'},
+      'user': {
+          'uid': '1/1234567890',
+          'email': 'member@example.com',
+          'roles': ['user'],
+          'settings': {'registered': True},
+      },
+      'server': {'lang': 'PY37', 'time': '2020-01-01 00:00:00.000000'},
+      'result': [new_post(5629499534213120 + index, rnd)
+                 for index in range(count)],
+  }
+
+
+def _timed(func, repeat):
+  """Returns result of func() and average seconds it took."""
+  started_on = time.perf_counter()
+  for _ in range(repeat):
+    result = func()
+  return result, (time.perf_counter() - started_on) / repeat
+
+
+def benchmark_compression(post_counts=None, repeat=DEFAULT_REPEAT):
+  """Measures CPU time and size of compressed responses.
+
+  Returns:
+    A list of dicts, one per payload size and encoding level.
+  """
+  levels = [(compression.GZIP, level) for level in [1, 6, 9]]
+  if compression.brotli:
+    levels += [(compression.BROTLI, quality) for quality in [1, 5, 11]]
+
+  results = []
+  for count in post_counts or DEFAULT_POST_COUNTS:
+    data = json.dumps(new_posts_payload(count)).encode('utf-8')
+    for encoding, level in levels:
+      compressed, seconds = _timed(
+          lambda: compression.compress(data, encoding, level), repeat)
+      results.append({
+          'posts': count,
+          'encoding': '%s-%s' % (encoding, level),
+          'bytes': len(data),
+          'compressed_bytes': len(compressed),
+          'saved_percent': 100.0 * (len(data) - len(compressed)) / len(data),
+          'ms': 1000.0 * seconds,
+          'saved_kb_per_ms': (
+              (len(data) - len(compressed)) / 1024.0 / (1000.0 * seconds)),
+      })
+  return results
+
+
+def _posts_payload_with_data(count, wrap):
+  """Returns posts payload with post data made by wrap(stored_string)."""
+  payload = new_posts_payload(count)
+  for post in payload['result']:
+    post['data'] = wrap(json.dumps(post['data']))
+  return payload
+
+
+def _serialize_as_before(count):
+  """Parses stored post data, sorts keys and joins with prefix as a str."""
+  payload = _posts_payload_with_data(count, lambda data: data)
+  def serialize():
+    value = dict(payload)
+    value['result'] = [dict(post, data=json.loads(post['data']))
+                       for post in payload['result']]
+    return (')]}\'\n%s' % json.dumps(value, sort_keys=True)).encode('utf-8')
+  return serialize
+
+
+def _serialize_with(backend, count):
+  """Passes stored post data through with given serialization backend."""
+  payload = _posts_payload_with_data(count, serialization.RawJSON)
+  def serialize():
+    original = serialization.orjson
+    serialization.orjson = backend
+    try:
+      return serialization.dumps(payload)
+    finally:
+      serialization.orjson = original
+  return serialize
+
+
+def benchmark_json(post_counts=None, repeat=DEFAULT_REPEAT):
+  """Measures throughput of serialization of posts list responses.
+
+  Returns:
+    A list of dicts, one per payload size and serialization method.
+  """
+  methods = [
+      ('json-sorted-parsed', _serialize_as_before),
+      ('json-raw', lambda count: _serialize_with(None, count)),
+  ]
+  if serialization.orjson:
+    methods.append(('orjson-raw', lambda count: _serialize_with(
+        serialization.orjson, count)))
+
+  results = []
+  for count in post_counts or DEFAULT_POST_COUNTS:
+    for name, new_serialize in methods:
+      data, seconds = _timed(new_serialize(count), repeat)
+      results.append({
+          'posts': count,
+          'method': name,
+          'bytes': len(data),
+          'ms': 1000.0 * seconds,
+          'mb_per_second': len(data) / 1024.0 / 1024.0 / seconds,
+      })
+  return results
+
+
+def _print_table(rows):
+  columns = list(rows[0].keys())
+  print('\t'.join(columns))
+  for row in rows:
+    print('\t'.join([
+        '%.2f' % row[name] if isinstance(row[name], float)
+        else str(row[name]) for name in columns]))
+
+
+def _compression_command(args):
+  _print_table(benchmark_compression(
+      post_counts=args.posts, repeat=args.repeat))
+
+
+def _json_command(args):
+  _print_table(benchmark_json(post_counts=args.posts, repeat=args.repeat))
+
+
+def _new_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+
+  command = commands.add_parser(
+      'compression', help='CPU cost vs. bytes saved by compression.')
+  command.add_argument(
+      '--posts', type=int, action='append',
+      help='Number of posts in response; can be repeated.')
+  command.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+  command.set_defaults(handler=_compression_command)
+
+  command = commands.add_parser(
+      'json', help='Throughput of JSON serialization of responses.')
+  command.add_argument(
+      '--posts', type=int, action='append',
+      help='Number of posts in response; can be repeated.')
+  command.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+  command.set_defaults(handler=_json_command)
+
+  return parser
+
+
+def main(argv=None):
+  args = _new_parser().parse_args(argv)
+  args.handler(args)
+
+
+if __name__ == '__main__':
+  main()
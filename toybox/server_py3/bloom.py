@@ -0,0 +1,71 @@
+"""Bloom filter."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import hashlib
+import math
+import struct
+
+
+# default target rate of false positives
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+
+
+def optimal_size(capacity, false_positive_rate):
+  """Returns (number of bits, number of hashes) for capacity and target rate."""
+  assert capacity > 0
+  assert 0 < false_positive_rate < 1
+  bits = int(math.ceil(
+      -capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+  hashes = max(1, int(round(bits / capacity * math.log(2))))
+  return bits, hashes
+
+
+class BloomFilter(object):
+  """Bloom filter of strings; tells if item is certainly not in the set.
+
+  The filter is sized for "capacity" items at "false_positive_rate"; it keeps
+  working when more items are added, but the rate of false positives goes up;
+  use is_over_capacity() to find when the filter needs to be rebuilt larger.
+  """
+
+  def __init__(self, capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE,
+               bits=None, count=0):
+    self.capacity = capacity
+    self.false_positive_rate = false_positive_rate
+    self.size, self.hashes = optimal_size(capacity, false_positive_rate)
+    if bits is None:
+      bits = bytearray((self.size + 7) // 8)
+    assert len(bits) == (self.size + 7) // 8
+    self.bits = bits
+    self.count = count
+
+  def _positions(self, item):
+    # double hashing: position i is (h1 + i * h2) mod size
+    digest = hashlib.md5(str(item).encode('utf-8')).digest()
+    h1, h2 = struct.unpack('<QQ', digest)
+    for i in range(self.hashes):
+      yield (h1 + i * h2) % self.size
+
+  def add(self, item):
+    """Adds item; returns True if item was not in the filter before."""
+    added = False
+    for position in self._positions(item):
+      mask = 1 << (position % 8)
+      if not self.bits[position // 8] & mask:
+        self.bits[position // 8] |= mask
+        added = True
+    if added:
+      self.count += 1
+    return added
+
+  def __contains__(self, item):
+    for position in self._positions(item):
+      if not self.bits[position // 8] & (1 << (position % 8)):
+        return False
+    return True
+
+  def is_over_capacity(self):
+    return self.count > self.capacity
@@ -0,0 +1,39 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import unittest
+import bloom
+
+
+class BloomFilterTestSuite(unittest.TestCase):
+  """Test cases for BloomFilter."""
+
+  def test_optimal_size(self):
+    self.assertEqual((959, 7), bloom.optimal_size(100, 0.01))
+    self.assertEqual((1918, 7), bloom.optimal_size(200, 0.01))
+    self.assertEqual((1438, 10), bloom.optimal_size(100, 0.001))
+
+  def test_no_false_negatives(self):
+    afilter = bloom.BloomFilter(100)
+    for index in range(100):
+      afilter.add('post-%s' % index)
+    for index in range(100):
+      self.assertIn('post-%s' % index, afilter)
+    self.assertFalse(afilter.add('post-1'))
+    self.assertLessEqual(afilter.count, 100)
+    self.assertFalse(afilter.is_over_capacity())
+
+  def test_false_positive_rate(self):
+    afilter = bloom.BloomFilter(1000, false_positive_rate=0.01)
+    for index in range(1000):
+      afilter.add('member/%s' % index)
+    false_positives = len([
+        index for index in range(10000) if 'other/%s' % index in afilter])
+    self.assertLess(false_positives, 200)
+
+
+if __name__ == '__main__':
+  unittest.main()
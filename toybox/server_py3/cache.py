@@ -0,0 +1,60 @@
+"""Cache helpers shared by the request handlers."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import collections
+import threading
+import time
+
+
+# default limits of the in-process cache
+DEFAULT_MAX_ITEMS = 10000
+DEFAULT_TTL_SECS = 60 * 5  # 5 min
+
+
+class InProcessCache(object):
+  """Thread-safe in-process cache with TTL and LRU eviction.
+
+  This class defines the contract for all caches we use: get(), set() and
+  delete(); any shared cache (Memcache, Redis, etc.) can be plugged into
+  container.Registry.shared_cache as long as it has the same methods.
+  """
+
+  def __init__(self, max_items=DEFAULT_MAX_ITEMS, clock=time.time):
+    self._max_items = max_items
+    self._clock = clock
+    self._items = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      item = self._items.get(key)
+      if item is None:
+        return default
+      value, expires_on = item
+      if expires_on is not None and expires_on <= self._clock():
+        del self._items[key]
+        return default
+      self._items.move_to_end(key)
+      return value
+
+  def set(self, key, value, ttl=DEFAULT_TTL_SECS):
+    with self._lock:
+      expires_on = self._clock() + ttl if ttl else None
+      self._items[key] = (value, expires_on)
+      self._items.move_to_end(key)
+      while len(self._items) > self._max_items:
+        self._items.popitem(last=False)
+
+  def delete(self, key):
+    with self._lock:
+      self._items.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+  def __len__(self):
+    return len(self._items)
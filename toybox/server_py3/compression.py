@@ -0,0 +1,103 @@
+"""Compression of HTTP responses negotiated with Accept-Encoding."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import zlib
+
+
+# brotli is optional; we fall back to gzip if it's not installed
+try:
+  import brotli  # pylint: disable=g-import-not-at-top
+except ImportError:
+  brotli = None
+
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+# responses smaller than this are sent as is; compression does not pay off
+DEFAULT_MIN_BYTES = 1024
+
+# levels are picked to trade a bit of size for much less CPU; see benchmark.py
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 5
+
+# only text responses are compressed; images and fonts are already compressed
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+])
+
+
+def supported_encodings():
+  """Returns encodings we can produce, most preferred first."""
+  if brotli:
+    return [BROTLI, GZIP]
+  return [GZIP]
+
+
+def compress(data, encoding, level):
+  """Compresses bytes; output is the same for the same input and level."""
+  if encoding == BROTLI:
+    return brotli.compress(data, quality=level)
+  assert encoding == GZIP, encoding
+  # wbits of 31 makes gzip container with zero mtime; unlike gzip.compress()
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+  return compressor.compress(data) + compressor.flush()
+
+
+class Compressor(object):
+  """Compresses responses the client can accept."""
+
+  def __init__(self, min_bytes=DEFAULT_MIN_BYTES,
+               gzip_level=DEFAULT_GZIP_LEVEL,
+               brotli_quality=DEFAULT_BROTLI_QUALITY):
+    self.min_bytes = min_bytes
+    self.levels = {GZIP: gzip_level, BROTLI: brotli_quality}
+
+  def negotiate(self, request):
+    """Returns best encoding client accepts or None."""
+    return request.accept_encodings.best_match(supported_encodings())
+
+  def compress_data(self, data, encoding):
+    """Returns compressed data or None if it's not worth compressing."""
+    if len(data) < self.min_bytes:
+      return None
+    compressed = compress(data, encoding, self.levels[encoding])
+    if len(compressed) >= len(data):
+      return None
+    return compressed
+
+  def compress_response(self, request, response):
+    """Compresses response body in place if it's worth it."""
+    if (response.status_code != 200 or response.direct_passthrough or
+        response.is_streamed or 'Content-Encoding' in response.headers or
+        response.mimetype not in COMPRESSIBLE_MIMETYPES):
+      return response
+    response.vary.add('Accept-Encoding')
+    if request.method == 'HEAD':
+      return response
+
+    encoding = self.negotiate(request)
+    if not encoding:
+      return response
+    compressed = self.compress_data(response.get_data(), encoding)
+    if compressed is None:
+      return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    # body bytes differ from uncompressed ones; they are still same content
+    etag, is_weak = response.get_etag()
+    if etag and not is_weak:
+      response.set_etag(etag, weak=True)
+    return response
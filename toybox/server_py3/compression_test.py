@@ -0,0 +1,69 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import gzip
+import json
+import unittest
+import flask
+import compression
+
+
+class CompressorTestSuite(unittest.TestCase):
+  """Test cases for Compressor."""
+
+  def setUp(self):
+    super(CompressorTestSuite, self).setUp()
+    self.app = flask.Flask(__name__)
+    self.compressor = compression.Compressor(min_bytes=100)
+    self.data = json.dumps([{'uid': index, 'data': 'post'}
+                            for index in range(100)]).encode('utf-8')
+
+  def _compress(self, accept_encoding, data=None, mimetype='application/json',
+                status=200):
+    headers = {}
+    if accept_encoding:
+      headers['Accept-Encoding'] = accept_encoding
+    with self.app.test_request_context('/', headers=headers):
+      response = flask.Response(
+          self.data if data is None else data, status, mimetype=mimetype)
+      response.set_etag('abc')
+      return self.compressor.compress_response(flask.request, response)
+
+  def test_gzip(self):
+    response = self._compress('gzip, deflate')
+    self.assertEqual('gzip', response.headers['Content-Encoding'])
+    self.assertEqual('Accept-Encoding', response.headers['Vary'])
+    self.assertEqual(self.data, gzip.decompress(response.get_data()))
+    self.assertEqual(len(response.get_data()),
+                     int(response.headers['Content-Length']))
+    self.assertEqual(('abc', True), response.get_etag())
+
+  def test_output_is_stable(self):
+    self.assertEqual(
+        compression.compress(self.data, compression.GZIP, 6),
+        compression.compress(self.data, compression.GZIP, 6))
+
+  def test_brotli_if_available(self):
+    response = self._compress('gzip;q=0.5, br')
+    if compression.brotli:
+      self.assertEqual('br', response.headers['Content-Encoding'])
+    else:
+      self.assertEqual('gzip', response.headers['Content-Encoding'])
+
+  def test_not_compressed(self):
+    for response in [
+        self._compress(None),
+        self._compress('identity'),
+        self._compress('gzip;q=0'),
+        self._compress('gzip', data=b'{}'),
+        self._compress('gzip', mimetype='image/png'),
+        self._compress('gzip', status=404)]:
+      self.assertNotIn('Content-Encoding', response.headers)
+      self.assertEqual(('abc', False), response.get_etag())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -5,6 +5,7 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
 import logging
+import cache
 
 
 _DATASTORE_NS = 'A120_PWA'
@@ -19,6 +20,12 @@ class Registry(object):
     # TODO(psimakov): we could pick a different NS when running locally
     self.datastore_ns = _DATASTORE_NS
 
+    # in-process cache; one per server instance
+    self.cache = cache.InProcessCache()
+
+    # optional cache shared by all server instances; same API as self.cache
+    self.shared_cache = None
+
   def patch(self, name, value):
     old_value = getattr(self, name, value)
     setattr(self, name, value)
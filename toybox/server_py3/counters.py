@@ -0,0 +1,104 @@
+"""Counters aggregated in memory and written to storage in batches."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import collections
+import logging
+import threading
+import time
+
+
+# default limits of how long and how many deltas we keep in memory
+DEFAULT_FLUSH_INTERVAL_SECS = 10
+DEFAULT_MAX_PENDING_KEYS = 1000
+
+
+class PartialFlushError(Exception):
+  """Raised by flush_func that wrote some deltas; holds deltas not written."""
+
+  def __init__(self, message, deltas):
+    super(PartialFlushError, self).__init__(message)
+    self.deltas = deltas
+
+
+class WriteBehindCounter(object):
+  """Thread-safe counters of a server instance flushed as batched deltas.
+
+  Increments are added up in memory; once flush_interval_secs passed since
+  the last flush, or max_pending_keys keys have pending deltas, the next
+  add() hands all deltas over to flush_func(deltas) in a background thread;
+  if the instance dies, increments not yet flushed are lost; deltas of a
+  failed flush are added back and retried with the next flush, but only
+  while there are fewer than max_pending_keys keys pending; flush_func that
+  wrote some of the deltas raises PartialFlushError, and only deltas it did
+  not write are added back, so none are counted twice.
+  """
+
+  def __init__(self, flush_func,
+               flush_interval_secs=DEFAULT_FLUSH_INTERVAL_SECS,
+               max_pending_keys=DEFAULT_MAX_PENDING_KEYS, clock=time.time,
+               background=True):
+    self._flush_func = flush_func
+    self._flush_interval_secs = flush_interval_secs
+    self._max_pending_keys = max_pending_keys
+    self._clock = clock
+    self._background = background
+    self._pending = collections.defaultdict(int)
+    self._flushed_on = clock()
+    self._is_flushing = False
+    self._lock = threading.Lock()
+
+  def _is_due(self):
+    return (len(self._pending) >= self._max_pending_keys or
+            self._clock() - self._flushed_on >= self._flush_interval_secs)
+
+  def add(self, key, delta=1):
+    with self._lock:
+      self._pending[key] += delta
+      if self._is_flushing or not self._is_due():
+        return
+      self._is_flushing = True
+    if self._background:
+      threading.Thread(target=self._flush_started).start()
+    else:
+      self._flush_started()
+
+  def get_pending(self, key):
+    with self._lock:
+      return self._pending.get(key, 0)
+
+  def flush(self):
+    """Flushes all pending deltas now; returns number of keys flushed."""
+    with self._lock:
+      if self._is_flushing:
+        return 0
+      self._is_flushing = True
+    return self._flush_started()
+
+  def _flush_started(self):
+    with self._lock:
+      deltas = dict(self._pending)
+      self._pending.clear()
+      self._flushed_on = self._clock()
+    try:
+      if deltas:
+        self._flush_func(deltas)
+      return len(deltas)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error('Failed to flush %s counters: %s', len(deltas), e)
+      if isinstance(e, PartialFlushError):
+        deltas = e.deltas
+      with self._lock:
+        if len(self._pending) + len(deltas) < self._max_pending_keys:
+          for key, delta in deltas.items():
+            self._pending[key] += delta
+      return 0
+    finally:
+      with self._lock:
+        self._is_flushing = False
+
+  def clear(self):
+    with self._lock:
+      self._pending.clear()
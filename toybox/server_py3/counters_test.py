@@ -0,0 +1,82 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import unittest
+import counters
+
+
+class WriteBehindCounterTestSuite(unittest.TestCase):
+  """Test cases for WriteBehindCounter."""
+
+  def setUp(self):
+    super(WriteBehindCounterTestSuite, self).setUp()
+    self.now = 0
+    self.flushed = []
+
+  def _new_counter(self, flush_func=None):
+    return counters.WriteBehindCounter(
+        flush_func or self.flushed.append, flush_interval_secs=10,
+        max_pending_keys=3, clock=lambda: self.now, background=False)
+
+  def test_flush_on_interval(self):
+    counter = self._new_counter()
+    counter.add('a')
+    counter.add('a', delta=2)
+    self.assertEqual(3, counter.get_pending('a'))
+    self.assertEqual([], self.flushed)
+    self.now += 10
+    counter.add('b')
+    self.assertEqual([{'a': 3, 'b': 1}], self.flushed)
+    self.assertEqual(0, counter.get_pending('a'))
+
+  def test_flush_on_pending_keys(self):
+    counter = self._new_counter()
+    for key in ['a', 'b', 'c']:
+      counter.add(key)
+    self.assertEqual([{'a': 1, 'b': 1, 'c': 1}], self.flushed)
+    self.assertEqual(0, counter.flush())
+
+  def test_failed_flush_is_retried(self):
+    calls = []
+
+    def fail(deltas):
+      calls.append(deltas)
+      raise Exception('Datastore is unavailable.')
+
+    counter = self._new_counter(flush_func=fail)
+    counter.add('a')
+    self.assertEqual(0, counter.flush())
+    self.assertEqual(1, counter.get_pending('a'))
+    counter.add('a')
+    counter.flush()
+    self.assertEqual([{'a': 1}, {'a': 2}], calls)
+
+    # deltas are dropped if too many are pending
+    for key in ['b', 'c']:
+      counter.add(key)
+    self.assertEqual(0, counter.get_pending('a'))
+
+  def test_partly_failed_flush_retries_only_deltas_not_written(self):
+    calls = []
+
+    def fail(deltas):
+      calls.append(deltas)
+      if len(calls) == 1:
+        raise counters.PartialFlushError(
+            'Datastore is unavailable.', {'b': deltas['b']})
+
+    counter = self._new_counter(flush_func=fail)
+    counter.add('a')
+    counter.add('b', delta=2)
+    self.assertEqual(0, counter.flush())
+    self.assertEqual(0, counter.get_pending('a'))
+    self.assertEqual(2, counter.get_pending('b'))
+    self.assertEqual(1, counter.flush())
+    self.assertEqual([{'a': 1, 'b': 2}, {'b': 2}], calls)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,12 +4,25 @@
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
+import atexit
+import collections
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
+import logging
+import random
+import threading
+import time
 import uuid
+import zlib
 import pytz
 from google.cloud import datastore
+import bloom
 import container
+import counters
+import serialization
 
 
 # serialization date format
@@ -18,6 +31,25 @@ ISO_8601_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
 # limits
 MAX_MEMBERS_IN_LIST = 500
 MAX_POSTS_IN_LIST = 500
+MAX_POST_CHANGES_IN_LIST = 500
+
+# post uids are 64-bit Datastore ids; longer ones are not ours
+MAX_POST_UID_LENGTH = 19
+
+# moderation states of a post; new posts wait for inspection in "pending"
+MODERATION_PENDING = 'pending'
+MODERATION_APPROVED = 'approved'
+MODERATION_FLAGGED = 'flagged'
+MODERATION_STATES = frozenset([
+    MODERATION_PENDING, MODERATION_APPROVED, MODERATION_FLAGGED])
+
+# transactions take their updated_on before they commit; ones started this
+# long before a query may still commit after it
+MAX_TRANSACTION_SECS = 60
+
+# generation of a kind changes on every write unless more entities than this
+# were written within MAX_TRANSACTION_SECS
+MAX_ENTITIES_IN_GENERATION = 500
 
 # special value for FALSE in Datastore queries
 _FALSE_VALUE = False
@@ -39,6 +71,60 @@ def datetime_to_str(value):
   return to_utc(value).isoformat()
 
 
+def pack(value):
+  """Packs JSON serializable value into a compact compressed blob."""
+  return zlib.compress(json.dumps(
+      value, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+
+def unpack(blob):
+  return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def is_valid_post_uid(value):
+  """Checks if value sent by client can be a post uid: int or digit string."""
+  if isinstance(value, bool):
+    return False
+  if isinstance(value, int):
+    return 0 < value < 2 ** 63
+  return (isinstance(value, str) and 0 < len(value) <= MAX_POST_UID_LENGTH and
+          value.isascii() and value.isdigit())
+
+
+def shard_for(value, shards):
+  """Returns stable shard number for a value."""
+  return zlib.crc32(str(value).encode('utf-8')) % shards
+
+
+def _generation_of(client, kind):
+  """Returns a token that changes whenever any entity of kind is written.
+
+  The latest updated_on alone is not enough: a write committed late may be
+  older than the latest one, but not by more than MAX_TRANSACTION_SECS; the
+  token hashes keys and updated_on of all entities in that window, or is
+  unique when there are too many of them.
+  """
+  query = client.query(kind=kind)
+  query.projection = ['updated_on']
+  query.order = ['-updated_on']
+  items = []
+  since = None
+  for item in query.fetch(limit=MAX_ENTITIES_IN_GENERATION + 1):
+    if since is None:
+      since = item['updated_on'] - datetime.timedelta(
+          seconds=MAX_TRANSACTION_SECS)
+    elif item['updated_on'] < since:
+      break
+    items.append('%s@%s' % (
+        item.key.id_or_name, datetime_to_str(item['updated_on'])))
+  if not items:
+    return ''
+  if len(items) > MAX_ENTITIES_IN_GENERATION:
+    return uuid.uuid4().hex
+  return '%s/%s' % (items[0], hashlib.sha256(
+      '\n'.join(items).encode('utf-8')).hexdigest())
+
+
 class BusinessRuleError(Exception):
   """Any error sent out to the client application and possibly user."""
 
@@ -73,6 +159,45 @@ class ETagError(BusinessRuleError):
   pass
 
 
+class TooManyRequestsError(BusinessRuleError):
+  """Member made too many requests and must wait before trying again."""
+  pass
+
+
+class Schema(object):
+  """Declares which properties of a kind are indexed and which are not.
+
+  Every property we never filter or order on is excluded from indexes; this
+  makes each put() cheaper and faster as no index entries need to be written.
+  """
+
+  # names of backfill jobs already applied to an entity; any kind may have it
+  BACKFILLS = 'backfills'
+
+  def __init__(self, kind, indexed, unindexed):
+    assert not set(indexed) & set(unindexed)
+    self.kind = kind
+    self.indexed = frozenset(indexed)
+    self.unindexed = frozenset(unindexed) | frozenset([self.BACKFILLS])
+
+  def new_entity(self, key):
+    assert key.kind == self.kind
+    return datastore.Entity(
+        key, exclude_from_indexes=tuple(sorted(self.unindexed)))
+
+  def needs_reindex(self, entity):
+    # entities loaded from Datastore only list exclusions of properties they
+    # have, so we compare exclusions of present properties only
+    names = set(entity.keys())
+    return set(entity.exclude_from_indexes) & names != self.unindexed & names
+
+  def apply_to(self, entity):
+    """Makes index exclusions of (possibly old) entity match this schema."""
+    assert entity.key.kind == self.kind
+    entity.exclude_from_indexes = set(self.unindexed)
+    return entity
+
+
 class _Member(object):
   """Persistent entity Member."""
 
@@ -110,6 +235,12 @@ class Members(object):
   """Facade for Datastore table Members."""
 
   TABLE = 'Members'
+  SCHEMA = Schema(TABLE, indexed=['slug', 'updated_on'], unindexed=[
+      'data', 'created_on', 'version'])
+
+  # keys of members found by slug are cached; slugs don't change, so this
+  # saves the query, and members themselves are always read by key
+  SLUG_CACHE_TTL_SECS = 60
 
   def __init__(self, client=None):
     if not client:
@@ -123,11 +254,37 @@ class Members(object):
 
   def query_members(self):
     """Returns all members."""
+    return list(self.iter_members())
+
+  def iter_members(self):
+    """Yields all members as query pages are fetched."""
     query = self.client.query(kind=self.TABLE)
-    results = []
     for item in query.fetch():
-      results.append(_Member(item))
-    return results
+      yield _Member(item)
+
+  def get_generation(self):
+    """Returns a token that changes whenever any member is added or updated."""
+    return _generation_of(self.client, self.TABLE)
+
+  def _slug_cache_key(self, slug):
+    return '%s/slug/%s' % (self.TABLE, slug)
+
+  def get_member_by_slug(self, slug):
+    """Returns stored member with the slug or None; its key is cached."""
+    cache = container.Registry.current().cache
+    key = cache.get(self._slug_cache_key(slug))
+    if key is not None:
+      obj = self.client.get(key)
+      if obj and obj.get('slug') == slug:
+        return _Member(obj)
+    query = self.client.query(kind=self.TABLE)
+    query.add_filter('slug', '=', str(slug))
+    items = list(query.fetch(limit=1))
+    if not items:
+      return None
+    cache.set(self._slug_cache_key(slug), items[0].key,
+              ttl=self.SLUG_CACHE_TTL_SECS)
+    return _Member(items[0])
 
   def get_or_create_member(self, uid, create_if_not_found=True):
     """Loads existing or creates new member entity."""
@@ -142,21 +299,27 @@ class Members(object):
 
       # created new
       if create_if_not_found:
-        obj = datastore.Entity(key)
+        obj = self.SCHEMA.new_entity(key)
+        utcnow = datetime.datetime.utcnow()
         obj.update({
             'slug': str(uuid.uuid4()),
             'data': '{}',
-            'created_on': datetime.datetime.utcnow(),
+            'created_on': utcnow,
+            'updated_on': utcnow,
             'version': 1,
         })
         self.client.put(obj)
+
+        # new member has no votes; start with empty vote summary and filter
+        VoteSummaries(client=self.client).replace(uid, {})
+        VoteBlooms(client=self.client).replace(uid, [])
         return _Member(obj)
 
       # not found and not created
       return None
 
   def update(self, uid, data, version=None):
-    """Updates existing member entity."""
+    """Updates existing member entity; returns updated member."""
     with self.client.transaction():
       # make sure payload is JSON parsable string
       if data:
@@ -183,7 +346,8 @@ class Members(object):
           'updated_on': datetime.datetime.utcnow(),
           'version': old.version + 1,
       })
-      self.client.put(obj)
+      self.client.put(self.SCHEMA.apply_to(obj))
+    return _Member(obj)
 
 
 class _Post(object):
@@ -246,6 +410,22 @@ class _Post(object):
   def is_deleted(self):
     return self._obj['is_deleted']
 
+  @property
+  def votes_archived(self):
+    return self._obj.get('votes_archived', False)
+
+  @property
+  def moderation(self):
+    return self._obj.get('moderation')
+
+  @property
+  def moderation_findings(self):
+    return self._obj.get('moderation_findings', [])
+
+  @votes_archived.setter
+  def votes_archived(self, votes_archived):
+    self._obj['votes_archived'] = votes_archived
+
   @property
   def version(self):
     return self._obj['version']
@@ -259,6 +439,13 @@ class Posts(object):
   """Facade for Datastore table Posts."""
 
   TABLE = 'Posts'
+  SCHEMA = Schema(TABLE, indexed=[
+      'member_uid', 'is_deleted', 'votes_total', 'created_on', 'updated_on',
+      'moderation'
+  ], unindexed=[
+      'data', 'votes_up', 'votes_down', 'votes_archived',
+      'moderation_findings', 'version'
+  ])
 
   def __init__(self, client=None):
     if not client:
@@ -271,15 +458,20 @@ class Posts(object):
       return self.client.key(self.TABLE, uid)
     return self.client.key(self.TABLE)
 
-  def query_posts(self):
-    """Returns all posts."""
+  def query_posts(self, moderation=None):
+    """Returns all posts or only posts in a given moderation state."""
+    return list(self.iter_posts(moderation=moderation))
+
+  def iter_posts(self, moderation=None, limit=None):
+    """Yields posts of query_posts() as query pages are fetched."""
     query = self.client.query(kind=self.TABLE)
     query.add_filter('is_deleted', '=', _FALSE_VALUE)
+    if moderation:
+      assert moderation in MODERATION_STATES, moderation
+      query.add_filter('moderation', '=', moderation)
     query.order = '-votes_total'
-    results = []
-    for item in query.fetch():
-      results.append(_Post(item))
-    return results
+    for item in query.fetch(limit=limit):
+      yield _Post(item)
 
   def query_member_posts(self, member_uid):
     """Returns all posts by a member."""
@@ -292,6 +484,42 @@ class Posts(object):
       results.append(_Post(item))
     return results
 
+  def iter_post_uids_created_before(self, before):
+    """Yields uids of posts, including deleted, created before naive UTC."""
+    query = self.client.query(kind=self.TABLE)
+    query.add_filter('created_on', '<', before)
+    query.keys_only()
+    for item in query.fetch():
+      yield item.key.id_or_name
+
+  def get_generation(self):
+    """Returns a token that changes whenever any post is added or updated."""
+    return _generation_of(self.client, self.TABLE)
+
+  def query_posts_changed_since(self, since, after_uid=None,
+                                limit=MAX_POST_CHANGES_IN_LIST):
+    """Returns posts, including deleted, updated after since; oldest first.
+
+    Posts are ordered by updated_on and then by key. If after_uid is given,
+    posts updated exactly at since with keys after it are returned too, so
+    paging through posts with the same updated_on doesn't skip any of them.
+    """
+    results = []
+    if after_uid is not None:
+      query = self.client.query(kind=self.TABLE)
+      query.add_filter('updated_on', '=', since)
+      query.add_filter('__key__', '>', self._key(after_uid))
+      query.order = '__key__'
+      for item in query.fetch(limit=limit):
+        results.append(_Post(item))
+    if len(results) < limit:
+      query = self.client.query(kind=self.TABLE)
+      query.add_filter('updated_on', '>', since)
+      query.order = ['updated_on', '__key__']
+      for item in query.fetch(limit=limit - len(results)):
+        results.append(_Post(item))
+    return results
+
   def get_post(self, post_uid):
     post_key = self._key(post_uid)
     post = self.client.get(post_key)
@@ -317,8 +545,9 @@ class Posts(object):
         raise NotFoundError('No member for uid "%s".' % member_uid)
 
       # add new post
+      utcnow = datetime.datetime.utcnow()
       post_key = self._key()
-      post = datastore.Entity(post_key)
+      post = self.SCHEMA.new_entity(post_key)
       post.update({
           'member_uid': str(member_uid),
           'data': post_data,
@@ -326,11 +555,28 @@ class Posts(object):
           'votes_down': 0,
           'votes_total': 0,
           'is_deleted': False,
-          'created_on': datetime.datetime.utcnow(),
+          'created_on': utcnow,
+          'updated_on': utcnow,
+          'moderation': MODERATION_PENDING,
           'version': 1,
       })
       self.client.put(post)
-      return _Post(post)
+
+    # new post key is only known after commit; post is already saved, so we
+    # don't fail the request if updating the leaderboard fails
+    boards = Leaderboards(client=self.client)
+    try:
+      with self.client.transaction():
+        boards.update_post(post.key.id, post['votes_total'])
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error('Failed to add post %s to leaderboard: %s',
+                    post.key.id, e)
+    boards.invalidate()
+    ActivityCounters(client=self.client).record(
+        ActivityCounters.SERIES_POSTS)
+    RecentWrites(client=self.client).add_post(member_uid, post)
+
+    return _Post(post)
 
   def mark_post_deleted(self, member_uid, post_uid):
     """Marks post deleted."""
@@ -349,8 +595,606 @@ class Posts(object):
       # update
       post.update({
           'is_deleted': True,
+          'updated_on': datetime.datetime.utcnow(),
+          'version': post['version'] + 1,
       })
-      self.client.put(post)
+      self.client.put(self.SCHEMA.apply_to(post))
+      Leaderboards(client=self.client).update_post(
+          post_uid, post['votes_total'], is_deleted=True)
+    Leaderboards(client=self.client).invalidate()
+    RecentWrites(client=self.client).add_post(member_uid, post)
+
+  def query_pending_moderation(self, limit):
+    """Returns posts waiting for moderation."""
+    query = self.client.query(kind=self.TABLE)
+    query.add_filter('moderation', '=', MODERATION_PENDING)
+    results = []
+    for item in query.fetch(limit=limit):
+      results.append(_Post(item))
+    return results
+
+  def set_moderation(self, findings):
+    """Records results of moderation of posts still pending it.
+
+    Args:
+      findings: dict of post_uid to list of names of info types found in the
+          post; posts with no findings are approved, others are flagged
+
+    Returns:
+      A number of posts updated.
+    """
+    updated = []
+    with self.client.transaction():
+      utcnow = datetime.datetime.utcnow()
+      for post in self.client.get_multi(
+          [self._key(post_uid) for post_uid in findings.keys()]):
+        if post.get('moderation') != MODERATION_PENDING:
+          continue
+        names = sorted(set(findings[post.key.id_or_name]))
+        post.update({
+            'moderation': (
+                MODERATION_FLAGGED if names else MODERATION_APPROVED),
+            'moderation_findings': names,
+            'updated_on': utcnow,
+            'version': post['version'] + 1,
+        })
+        updated.append(self.SCHEMA.apply_to(post))
+      if updated:
+        self.client.put_multi(updated)
+    return len(updated)
+
+  def get_posts(self, post_uids):
+    """Returns existing posts in the order of post_uids."""
+    by_key = dict([(post.key, post) for post in self.client.get_multi(
+        [self._key(post_uid) for post_uid in post_uids])])
+    results = []
+    for post_uid in post_uids:
+      post = by_key.get(self._key(post_uid))
+      if post:
+        results.append(_Post(post))
+    return results
+
+  def query_top_posts(self, limit, accept=None):
+    """Returns top posts by votes_total from leaderboard or query.
+
+    If accept is given, only posts with accept(post) True are returned; they
+    are picked from all top posts on the board, or from a query if the board
+    has too few of them.
+    """
+    boards = Leaderboards(client=self.client)
+    assert limit <= boards.SIZE
+    if accept:
+      top = self.query_top_posts(boards.SIZE)
+      posts = [post for post in top if accept(post)]
+      if len(posts) >= limit or len(top) < boards.SIZE:
+        return posts[:limit]
+      return list(itertools.islice(
+          (post for post in self.iter_posts() if accept(post)), limit))
+
+    post_uids = boards.get_top_post_uids(limit)
+    if post_uids is not None:
+      posts = [post for post in self.get_posts(post_uids)
+               if not post.is_deleted]
+      return sorted(posts, key=lambda post: post.votes_total, reverse=True)
+
+    # leaderboard is not valid; one caller rebuilds it, others just query
+    generation = boards.lease_rebuild()
+    if generation is None:
+      return list(self.iter_posts(limit=limit))
+    scanned_on = datetime.datetime.utcnow()
+    posts = self.query_posts()
+    boards.rebuild(posts, generation=generation, scanned_on=scanned_on)
+    return posts[:limit]
+
+
+class Leaderboards(object):
+  """Facade for Datastore table Leaderboards.
+
+  Leaderboard holds top posts by votes_total, so we don't need to query all
+  posts to show the top ones; it's split into SHARDS entities by post uid;
+  each shard keeps up to CAPACITY of its best posts and is updated in the
+  same transaction as the post; all posts not kept in a shard have votes_total
+  not above shard "floor"; if a kept post drops below the floor, we can no
+  longer tell if it's still among the top ones, so we let it go; when shard
+  has fewer than SIZE posts left, it's invalid until rebuilt from a query;
+  extra room of CAPACITY over SIZE makes this rare; shards are only written
+  when their entries change, and invalid shards are not written at all;
+  only the caller holding the rebuild lease rebuilds shards, each in its own
+  transaction, and then merges again all posts changed since it queried them.
+  """
+
+  TABLE = 'Leaderboards'
+  SCHEMA = Schema(TABLE, indexed=[], unindexed=[
+      'data', 'floor', 'generation', 'is_complete', 'is_valid',
+      'leased_until', 'updated_on', 'version'])
+
+  SHARDS = 4
+  SIZE = 50
+  CAPACITY = 60
+  CACHE_KEY = 'Leaderboards/top'
+  CACHE_TTL_SECS = 10
+  REBUILD_LEASE_SECS = 60
+  TRANSACTION_SECS = MAX_TRANSACTION_SECS
+
+  def __init__(self, client=None):
+    if not client:
+      client = container.Registry.current().datastore_client
+    self.client = client
+
+  def _key(self, shard):
+    return self.client.key(self.TABLE, 'top/%s' % shard)
+
+  def _keys(self):
+    return [self._key(shard) for shard in range(self.SHARDS)]
+
+  def _lease_key(self):
+    return self.client.key(self.TABLE, 'rebuild')
+
+  def invalidate(self):
+    """Drops cached top posts; call after transaction changing shards."""
+    container.Registry.current().cache.delete(self.CACHE_KEY)
+
+  def _put_board(self, obj, entries, floor, is_complete):
+    obj.update({
+        'data': pack(list(entries.items())),
+        'floor': floor,
+        'is_complete': is_complete,
+        'is_valid': is_complete or len(entries) >= self.SIZE,
+        'updated_on': datetime.datetime.utcnow(),
+        'version': obj.get('version', 0) + 1,
+    })
+    return self.SCHEMA.apply_to(obj)
+
+  def update_post(self, post_uid, votes_total, is_deleted=False):
+    """Merges new post votes_total into its shard; call in transaction."""
+    self.update_posts([(post_uid, votes_total, is_deleted)])
+
+  def update_posts(self, updates):
+    """Merges (post_uid, votes_total, is_deleted) items into their shards.
+
+    Must be called in transaction; a transaction does not see its own
+    writes, so each shard is read and written once for all its updates.
+    """
+    by_shard = collections.OrderedDict()
+    for update in updates:
+      by_shard.setdefault(
+          shard_for(update[0], self.SHARDS), []).append(update)
+    keys = [self._key(shard) for shard in by_shard]
+    existing = dict([(obj.key, obj) for obj in self.client.get_multi(keys)])
+
+    updated = []
+    for key, shard_updates in zip(keys, by_shard.values()):
+      # rebuild merges posts changed while it runs, we leave shard alone
+      obj = existing.get(key)
+      if not obj or not obj['is_valid']:
+        continue
+      entries = dict(unpack(obj['data']))
+      floor = obj['floor']
+      is_complete = obj['is_complete']
+      is_changed = False
+      for post_uid, votes_total, is_deleted in shard_updates:
+        floor, is_complete, is_merged = self._merge_post(
+            entries, floor, is_complete, post_uid, votes_total, is_deleted)
+        is_changed = is_changed or is_merged
+      if is_changed:
+        updated.append(self._put_board(obj, entries, floor, is_complete))
+
+    if updated:
+      self.client.put_multi(updated)
+
+  def _merge_post(self, entries, floor, is_complete, post_uid, votes_total,
+                  is_deleted):
+    """Merges post into entries; returns new floor, is_complete, is_changed."""
+    is_above_floor = is_complete or votes_total >= floor
+
+    if is_deleted:
+      if post_uid not in entries:
+        return floor, is_complete, False
+      del entries[post_uid]
+    elif post_uid in entries:
+      if is_above_floor:
+        entries[post_uid] = votes_total
+      else:
+        del entries[post_uid]
+    elif is_above_floor:
+      entries[post_uid] = votes_total
+    else:
+      return floor, is_complete, False
+
+    # keep CAPACITY best posts; the ones we let go define new floor
+    if len(entries) > self.CAPACITY:
+      kept = dict(heapq.nlargest(
+          self.CAPACITY, entries.items(), key=lambda entry: entry[1]))
+      floor = max([
+          score for uid, score in entries.items() if uid not in kept])
+      for uid in list(entries.keys()):
+        if uid not in kept:
+          del entries[uid]
+      is_complete = False
+    return floor, is_complete, True
+
+  def lease_rebuild(self):
+    """Takes rebuild lease; returns its generation or None if it's taken.
+
+    Caller holding the lease queries all posts and passes them with this
+    generation to rebuild(); others don't rebuild until the lease expires.
+    """
+    with self.client.transaction():
+      utcnow = datetime.datetime.utcnow()
+      lease = self.client.get(self._lease_key())
+      if lease and lease['leased_until'] > utcnow:
+        return None
+      lease = lease or self.SCHEMA.new_entity(self._lease_key())
+      lease.update({
+          'generation': lease.get('generation', 0) + 1,
+          'leased_until': utcnow + datetime.timedelta(
+              seconds=self.REBUILD_LEASE_SECS),
+          'updated_on': utcnow,
+      })
+      self.client.put(self.SCHEMA.apply_to(lease))
+      return lease['generation']
+
+  def _holds_lease(self, generation):
+    """Checks lease was not taken over; call in transaction."""
+    lease = self.client.get(self._lease_key())
+    return bool(lease) and lease['generation'] == generation
+
+  def rebuild(self, posts, generation=None, scanned_on=None):
+    """Rebuilds all shards from a list of all posts, which are not deleted.
+
+    If generation from lease_rebuild() is given, each shard is rebuilt only
+    while the lease was not taken over by another caller; posts changed since
+    scanned_on, when posts were queried, are then merged into shards again
+    and the lease is released.
+
+    Returns:
+      True if shards were rebuilt, False otherwise.
+    """
+    by_shard = [[] for _ in range(self.SHARDS)]
+    for post in posts:
+      by_shard[shard_for(post.key.id, self.SHARDS)].append(post)
+
+    for key, shard_posts in zip(self._keys(), by_shard):
+      shard_posts = sorted(
+          shard_posts, key=lambda post: post.votes_total, reverse=True)
+      entries = dict([(post.key.id, post.votes_total)
+                      for post in shard_posts[:self.CAPACITY]])
+      is_complete = len(shard_posts) <= self.CAPACITY
+      floor = None if is_complete else shard_posts[
+          self.CAPACITY].votes_total
+      with self.client.transaction():
+        if generation is not None and not self._holds_lease(generation):
+          logging.info('Leaderboard lease was taken over; rebuild stopped')
+          return False
+        obj = self.client.get(key) or self.SCHEMA.new_entity(key)
+        obj['generation'] = generation
+        self.client.put(self._put_board(obj, entries, floor, is_complete))
+
+    if scanned_on is not None:
+      self._merge_posts_changed_since(scanned_on - datetime.timedelta(
+          seconds=self.TRANSACTION_SECS))
+    if generation is not None:
+      with self.client.transaction():
+        if self._holds_lease(generation):
+          self.client.delete(self._lease_key())
+    self.invalidate()
+    return True
+
+  def _merge_posts_changed_since(self, since):
+    """Merges again posts changed since naive UTC since into their shards."""
+    query = self.client.query(kind=Posts.TABLE)
+    query.add_filter('updated_on', '>=', since)
+    query.keys_only()
+    keys = [item.key for item in query.fetch()]
+    for index in range(0, len(keys), Votes.MAX_POSTS_IN_TRANSACTION):
+      with self.client.transaction():
+        posts = [_Post(obj) for obj in self.client.get_multi(
+            keys[index:index + Votes.MAX_POSTS_IN_TRANSACTION])]
+        self.update_posts([(post.key.id, post.votes_total, post.is_deleted)
+                           for post in posts])
+
+  def get_top_post_uids(self, limit):
+    """Returns uids of top posts or None if leaderboard is not valid."""
+    cache = container.Registry.current().cache
+    top = cache.get(self.CACHE_KEY)
+    if top is None:
+      objs = self.client.get_multi(self._keys())
+      if len(objs) != self.SHARDS:
+        return None
+      entries = []
+      for obj in objs:
+        if not obj['is_valid']:
+          return None
+        entries.extend(unpack(obj['data']))
+      top = heapq.nlargest(self.SIZE, entries, key=lambda entry: entry[1])
+      cache.set(self.CACHE_KEY, top, ttl=self.CACHE_TTL_SECS)
+    return [post_uid for post_uid, _ in top[:limit]]
+
+
+class ActivityCounters(object):
+  """Facade for Datastore table ActivityCounters.
+
+  Counts events, like new posts and votes, in buckets of a minute, an hour
+  and a day; each bucket is split into SHARDS entities and each event goes
+  into one random shard, so bursts of events don't contend on one entity;
+  series are read by keys of their buckets, never by a query; minute and
+  hour buckets older than MAX_BUCKETS are never read and are deleted by the
+  prune_activity job, day buckets are kept and grow by a few per day.
+  """
+
+  TABLE = 'ActivityCounters'
+  SCHEMA = Schema(TABLE, indexed=[], unindexed=['count', 'updated_on'])
+
+  SHARDS = 8
+  SERIES_POSTS = 'posts'
+  SERIES_VOTES = 'votes'
+  SERIES = frozenset([SERIES_POSTS, SERIES_VOTES])
+  GRANULARITIES = collections.OrderedDict([
+      ('minute', datetime.timedelta(minutes=1)),
+      ('hour', datetime.timedelta(hours=1)),
+      ('day', datetime.timedelta(days=1)),
+  ])
+  MAX_BUCKETS = 120
+
+  def __init__(self, client=None):
+    if not client:
+      client = container.Registry.current().datastore_client
+    self.client = client
+
+  @classmethod
+  def bucket_start(cls, when, granularity):
+    when = when.replace(second=0, microsecond=0)
+    if granularity in ['hour', 'day']:
+      when = when.replace(minute=0)
+    if granularity == 'day':
+      when = when.replace(hour=0)
+    return when
+
+  def _key(self, series, granularity, start, shard):
+    return self.client.key(self.TABLE, '%s/%s/%s/%s' % (
+        series, granularity, start.strftime('%Y%m%d%H%M'), shard))
+
+  def increment(self, series, when=None, delta=1):
+    """Adds delta to all buckets of a series the time falls into."""
+    assert series in self.SERIES, series
+    when = when or datetime.datetime.utcnow()
+    shard = random.randrange(self.SHARDS)
+    keys = [self._key(series, granularity,
+                      self.bucket_start(when, granularity), shard)
+            for granularity in self.GRANULARITIES]
+    with self.client.transaction():
+      by_key = dict([(obj.key, obj) for obj in self.client.get_multi(keys)])
+      updated = []
+      for key in keys:
+        obj = by_key.get(key) or self.SCHEMA.new_entity(key)
+        obj.update({
+            'count': obj.get('count', 0) + delta,
+            'updated_on': datetime.datetime.utcnow(),
+        })
+        updated.append(obj)
+      self.client.put_multi(updated)
+
+  def record(self, series, delta=1):
+    """Counts events that already happened; never fails the caller."""
+    try:
+      self.increment(series, delta=delta)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.warning('Failed to count %s activity: %s', series, e)
+
+  def delete_buckets_before(self, series, granularity, before,
+                            batch_size=500):
+    """Deletes all shards of buckets of a series that start before a time.
+
+    Returns:
+      A number of entities deleted.
+    """
+    assert series in self.SERIES, series
+    assert granularity in self.GRANULARITIES, granularity
+    start = self.client.key(self.TABLE, '%s/%s/' % (series, granularity))
+    end = self._key(
+        series, granularity, self.bucket_start(before, granularity), '')
+    deleted = 0
+    while True:
+      query = self.client.query(kind=self.TABLE)
+      query.add_filter('__key__', '>=', start)
+      query.add_filter('__key__', '<', end)
+      query.keys_only()
+      keys = [obj.key for obj in query.fetch(limit=batch_size)]
+      if not keys:
+        return deleted
+      self.client.delete_multi(keys)
+      deleted += len(keys)
+
+  def get_series(self, series, granularity, count, end=None):
+    """Returns a list of (bucket start, count) of last buckets; oldest first."""
+    assert series in self.SERIES, series
+    assert 0 < count <= self.MAX_BUCKETS, count
+    step = self.GRANULARITIES[granularity]
+    last = self.bucket_start(end or datetime.datetime.utcnow(), granularity)
+    starts = [last - step * index for index in reversed(range(count))]
+    keys = dict([(start, [self._key(series, granularity, start, shard)
+                          for shard in range(self.SHARDS)])
+                 for start in starts])
+    counts = dict([(obj.key, obj['count']) for obj in self.client.get_multi(
+        [key for start in starts for key in keys[start]])])
+    return [(start, sum([counts.get(key, 0) for key in keys[start]]))
+            for start in starts]
+
+
+class PostViews(object):
+  """Facade for Datastore table PostViews.
+
+  Views are too frequent to be written into posts, which already get
+  contended by votes; views are added up in memory of each server instance
+  and flushed every few seconds as deltas into SHARDS counter entities per
+  post; each instance writes into its own shard, so instances don't contend;
+  view counts of posts are cached for CACHE_TTL_SECS; readers also save the
+  sum of shards into a summary entity per post, so others read one entity
+  instead of SHARDS until the summary is SUMMARY_TTL_SECS old or new views
+  are flushed; shards are summed and summaries saved in one transaction, so
+  a summary never hides views flushed while it was computed.
+  """
+
+  TABLE = 'PostViews'
+  SCHEMA = Schema(TABLE, indexed=[], unindexed=['count', 'updated_on'])
+
+  SHARDS = 8
+  CACHE_TTL_SECS = 30
+  SUMMARY_TTL_SECS = 120
+  MAX_POSTS_IN_TRANSACTION = 25
+  MAX_KEYS_IN_GET = 1000
+
+  # shard this server instance writes into
+  INSTANCE_SHARD = random.randrange(SHARDS)
+
+  def __init__(self, client=None):
+    if not client:
+      client = container.Registry.current().datastore_client
+    self.client = client
+
+  def _key(self, post_uid, shard):
+    return self.client.key(self.TABLE, '%s/%s' % (post_uid, shard))
+
+  def _summary_key(self, post_uid):
+    return self._key(post_uid, 'sum')
+
+  @classmethod
+  def _cache_key(cls, post_uid):
+    return '%s/%s' % (cls.TABLE, post_uid)
+
+  def get_generation(self, now=None):
+    """Returns a token that changes as often as cached view counts expire."""
+    return str(int((now or time.time()) // self.CACHE_TTL_SECS))
+
+  def record_views(self, post_uids):
+    """Counts views of posts in memory; does not access Datastore."""
+    for post_uid in post_uids:
+      _POST_VIEWS_PENDING.add(str(post_uid))
+
+  def add_views(self, deltas, shard=None):
+    """Adds dict of post_uid to number of views into counters of a shard.
+
+    Raises:
+      counters.PartialFlushError: with deltas of batches not committed.
+    """
+    shard = self.INSTANCE_SHARD if shard is None else shard
+    items = sorted(deltas.items())
+    for index in range(0, len(items), self.MAX_POSTS_IN_TRANSACTION):
+      batch = items[index:index + self.MAX_POSTS_IN_TRANSACTION]
+      keys = [self._key(post_uid, shard) for post_uid, _ in batch]
+      try:
+        with self.client.transaction():
+          by_key = dict([
+              (obj.key, obj) for obj in self.client.get_multi(keys)])
+          updated = []
+          for key, (_, delta) in zip(keys, batch):
+            obj = by_key.get(key) or self.SCHEMA.new_entity(key)
+            obj.update({
+                'count': obj.get('count', 0) + delta,
+                'updated_on': datetime.datetime.utcnow(),
+            })
+            updated.append(obj)
+          self.client.put_multi(updated)
+      except Exception as e:  # pylint: disable=broad-except
+        raise counters.PartialFlushError(str(e), dict(items[index:]))
+      self._drop_summaries([post_uid for post_uid, _ in batch])
+
+  def _drop_summaries(self, post_uids):
+    """Drops summaries of posts with new views; never fails the caller."""
+    cache = container.Registry.current().cache
+    for post_uid in post_uids:
+      cache.delete(self._cache_key(post_uid))
+    try:
+      self.client.delete_multi(
+          [self._summary_key(post_uid) for post_uid in post_uids])
+    except Exception as e:  # pylint: disable=broad-except
+      logging.error(
+          'Failed to drop %s view summaries: %s', len(post_uids), e)
+
+  def get_view_counts(self, post_uids):
+    """Returns dict of post_uid to number of views, including not flushed."""
+    cache = container.Registry.current().cache
+    results = {}
+    missing = []
+    for post_uid in [str(post_uid) for post_uid in post_uids]:
+      count = cache.get(self._cache_key(post_uid))
+      if count is None:
+        missing.append(post_uid)
+        results[post_uid] = 0
+      else:
+        results[post_uid] = count
+
+    # read summaries; sum up shards of posts with no recent summary
+    fresh_after = timezone_aware_now() - datetime.timedelta(
+        seconds=self.SUMMARY_TTL_SECS)
+    stale = set(missing)
+    for obj in self._get_multi([
+        self._summary_key(post_uid) for post_uid in missing]):
+      post_uid = obj.key.name.rsplit('/', 1)[0]
+      results[post_uid] = obj['count']
+      if to_utc(obj['updated_on']) > fresh_after:
+        stale.discard(post_uid)
+    results.update(self._sum_shards(
+        [post_uid for post_uid in missing if post_uid in stale]))
+
+    for post_uid in missing:
+      cache.set(self._cache_key(post_uid), results[post_uid],
+                ttl=self.CACHE_TTL_SECS)
+
+    for post_uid in results:
+      results[post_uid] += _POST_VIEWS_PENDING.get_pending(post_uid)
+    return results
+
+  def _get_multi(self, keys):
+    for index in range(0, len(keys), self.MAX_KEYS_IN_GET):
+      for obj in self.client.get_multi(
+          keys[index:index + self.MAX_KEYS_IN_GET]):
+        yield obj
+
+  def _sum_shards(self, post_uids):
+    """Returns dict of post_uid to sum of its shards; saves sums as summaries.
+
+    Shards of a batch of posts are read and their summaries are written in
+    one transaction, so no flush commits views into a shard between the two;
+    flushes drop summaries only after they commit.
+    """
+    counts = {}
+    for index in range(0, len(post_uids), self.MAX_POSTS_IN_TRANSACTION):
+      batch = dict([(post_uid, 0) for post_uid in post_uids[
+          index:index + self.MAX_POSTS_IN_TRANSACTION]])
+      is_read = False
+      try:
+        with self.client.transaction():
+          for obj in self.client.get_multi([
+              self._key(post_uid, shard)
+              for post_uid in sorted(batch) for shard in range(self.SHARDS)]):
+            batch[obj.key.name.rsplit('/', 1)[0]] += obj['count']
+          is_read = True
+          self.client.put_multi(self._new_summaries(batch))
+      except Exception as e:  # pylint: disable=broad-except
+        if not is_read:
+          raise
+        logging.error('Failed to save %s view summaries: %s', len(batch), e)
+      counts.update(batch)
+    return counts
+
+  def _new_summaries(self, counts):
+    utcnow = datetime.datetime.utcnow()
+    summaries = []
+    for post_uid, count in sorted(counts.items()):
+      obj = self.SCHEMA.new_entity(self._summary_key(post_uid))
+      obj.update({'count': count, 'updated_on': utcnow})
+      summaries.append(obj)
+    return summaries
+
+
+def _flush_post_views(deltas):
+  PostViews().add_views(deltas)
+
+
+# views counted by this server instance and not yet flushed into Datastore
+_POST_VIEWS_PENDING = counters.WriteBehindCounter(_flush_post_views)
+atexit.register(_POST_VIEWS_PENDING.flush)
 
 
 class _Vote(object):
@@ -402,22 +1246,368 @@ class _Vote(object):
     self._obj['version'] = version
 
 
+class VoteArchives(object):
+  """Facade for Datastore table VoteArchives.
+
+  Votes on old posts are rarely read; we move them out of the Votes table into
+  one compact blob per post, which keeps Votes indexes small; posts keep their
+  aggregated vote counters; votes cast after archival go into Votes table and
+  take precedence over archived ones.
+  """
+
+  TABLE = 'VoteArchives'
+  SCHEMA = Schema(TABLE, indexed=[], unindexed=[
+      'data', 'count', 'created_on', 'updated_on', 'version'])
+
+  # number of archived votes deleted from Votes in one transaction
+  DELETE_BATCH_SIZE = 25
+
+  def __init__(self, client=None):
+    if not client:
+      client = container.Registry.current().datastore_client
+    self.client = client
+
+  def _key(self, post_uid):
+    return self.client.key(self.TABLE, str(post_uid))
+
+  def get_archived_votes(self, post_uids):
+    """Returns dict of post_uid to dict of member_uid to archived vote value."""
+    if not post_uids:
+      return {}
+    results = {}
+    keys = [self._key(post_uid) for post_uid in post_uids]
+    for obj in self.client.get_multi(keys):
+      results[obj.key.name] = unpack(obj['data'])
+    return results
+
+  def _put_votes(self, obj, votes, utcnow):
+    obj.update({
+        'data': pack(votes),
+        'count': len(votes),
+        'updated_on': utcnow,
+        'version': obj.get('version', 0) + 1,
+    })
+    self.client.put(self.SCHEMA.apply_to(obj))
+
+  def remove_vote(self, post_uid, member_uid):
+    """Removes archived vote; must be called in transaction; returns value."""
+    obj = self.client.get(self._key(post_uid))
+    if not obj:
+      return None
+    votes = unpack(obj['data'])
+    value = votes.pop(str(member_uid), None)
+    if value is not None:
+      self._put_votes(obj, votes, datetime.datetime.utcnow())
+    return value
+
+  def archive_post_votes(self, post_uid):
+    """Moves all votes of a post into its archive blob.
+
+    Returns:
+      A number of votes deleted from the Votes table.
+    """
+    query = self.client.query(kind=Votes.TABLE)
+    query.add_filter('post_uid', '=', str(post_uid))
+    hot_votes = [_Vote(item) for item in query.fetch()]
+    posts = Posts(client=self.client)
+
+    with self.client.transaction():
+      utcnow = datetime.datetime.utcnow()
+
+      # load post
+      post_key = posts._key(post_uid)  # pylint: disable=protected-access
+      post_ = self.client.get(post_key)
+      if not post_:
+        raise NotFoundError('No post for post_uid "%s".' % post_uid)
+      post = _Post(post_)
+      if post.votes_archived and not hot_votes:
+        return 0
+
+      # merge votes into archive; cancelled votes are same as no vote
+      key = self._key(post_uid)
+      obj = self.client.get(key)
+      if not obj:
+        obj = self.SCHEMA.new_entity(key)
+        obj['created_on'] = utcnow
+        votes = {}
+      else:
+        votes = unpack(obj['data'])
+      for vote in hot_votes:
+        if vote.value:
+          votes[vote.member_uid] = vote.value
+        else:
+          votes.pop(vote.member_uid, None)
+      self._put_votes(obj, votes, utcnow)
+
+      # mark post archived
+      if not post.votes_archived:
+        post.votes_archived = True
+        self.client.put(posts.SCHEMA.apply_to(
+            post._obj))  # pylint: disable=protected-access
+
+    # delete archived votes unless they were changed after we read them
+    deleted = 0
+    versions = dict([(vote.key, vote.version) for vote in hot_votes])
+    keys = list(versions.keys())
+    for index in range(0, len(keys), self.DELETE_BATCH_SIZE):
+      with self.client.transaction():
+        unchanged = []
+        for obj in self.client.get_multi(
+            keys[index:index + self.DELETE_BATCH_SIZE]):
+          if obj.get('version') == versions[obj.key]:
+            unchanged.append(obj.key)
+        self.client.delete_multi(unchanged)
+        deleted += len(unchanged)
+    return deleted
+
+
+class VoteSummaries(object):
+  """Facade for Datastore table VoteSummaries.
+
+  Summary holds values of all votes of one member packed into a few shards;
+  the shard of a vote is picked by hashing its post uid; this lets us read
+  votes of a member for a whole page of posts with one get_multi(); shards
+  are created with the member and updated in the same transaction as Vote
+  entity; members created before this table existed have no shards until
+  'jobs.py rebuild_vote_summaries' is run; we query Votes for them instead.
+  """
+
+  TABLE = 'VoteSummaries'
+  SCHEMA = Schema(TABLE, indexed=[], unindexed=[
+      'data', 'count', 'updated_on', 'version'])
+
+  SHARDS = 4
+
+  def __init__(self, client=None):
+    if not client:
+      client = container.Registry.current().datastore_client
+    self.client = client
+
+  def _key(self, member_uid, shard):
+    return self.client.key(self.TABLE, '%s/%s' % (member_uid, shard))
+
+  @classmethod
+  def shard_for(cls, post_uid):
+    return shard_for(post_uid, cls.SHARDS)
+
+  def _put_values(self, obj, values, utcnow):
+    obj.update({
+        'data': pack(values),
+        'count': len(values),
+        'updated_on': utcnow,
+        'version': obj.get('version', 0) + 1,
+    })
+    return self.SCHEMA.apply_to(obj)
+
+  def replace(self, member_uid, values):
+    """Replaces all shards; must be called in transaction."""
+    utcnow = datetime.datetime.utcnow()
+    shards = [{} for _ in range(self.SHARDS)]
+    for post_uid, value in values.items():
+      shards[self.shard_for(post_uid)][str(post_uid)] = value
+    keys = [self._key(member_uid, shard) for shard in range(self.SHARDS)]
+    existing = dict([(obj.key, obj) for obj in self.client.get_multi(keys)])
+    entities = []
+    for key, shard_values in zip(keys, shards):
+      obj = existing.get(key) or self.SCHEMA.new_entity(key)
+      entities.append(self._put_values(obj, shard_values, utcnow))
+    self.client.put_multi(entities)
+
+  def set_vote(self, member_uid, post_uid, value):
+    """Records vote value; must be called in transaction.
+
+    Returns:
+      False if member has no summary, True otherwise.
+    """
+    return self.set_votes(member_uid, {post_uid: value})
+
+  def set_votes(self, member_uid, values):
+    """Records dict of post_uid to vote value; must be called in transaction.
+
+    Returns:
+      False if member has no summary, True otherwise.
+    """
+    by_shard = collections.defaultdict(dict)
+    for post_uid, value in values.items():
+      by_shard[self.shard_for(post_uid)][str(post_uid)] = value
+    keys = [self._key(member_uid, shard) for shard in sorted(by_shard)]
+    objs = self.client.get_multi(keys)
+    if len(objs) != len(keys):
+      return False
+    existing = dict([(obj.key, obj) for obj in objs])
+    utcnow = datetime.datetime.utcnow()
+    updated = []
+    for key, shard in zip(keys, sorted(by_shard)):
+      obj = existing[key]
+      shard_values = unpack(obj['data'])
+      shard_values.update(by_shard[shard])
+      updated.append(self._put_values(obj, shard_values, utcnow))
+    self.client.put_multi(updated)
+    return True
+
+  def get_all_vote_values(self, member_uid):
+    """Returns dict of post_uid to vote value or None if there is no summary."""
+    keys = [self._key(member_uid, shard) for shard in range(self.SHARDS)]
+    objs = self.client.get_multi(keys)
+    if len(objs) != len(keys):
+      return None
+    results = {}
+    for obj in objs:
+      results.update(unpack(obj['data']))
+    return results
+
+  def get_vote_values(self, member_uid, post_uids):
+    """Returns dict of post_uid to vote value or None if there is no summary."""
+    shards = set([self.shard_for(post_uid) for post_uid in post_uids])
+    if not shards:
+      return {}
+    keys = [self._key(member_uid, shard) for shard in sorted(shards)]
+    objs = self.client.get_multi(keys)
+    if len(objs) != len(keys):
+      return None
+    post_uids = set([str(post_uid) for post_uid in post_uids])
+    results = {}
+    for obj in objs:
+      for post_uid, value in unpack(obj['data']).items():
+        if post_uid in post_uids:
+          results[post_uid] = value
+    return results
+
+
+class VoteBlooms(object):
+  """Facade for Datastore table VoteBlooms.
+
+  Bloom filter of uids of posts a member voted on; it's keyed by member uid
+  and created and rebuilt alongside the member vote summary; posts not in the
+  filter have no vote of the member, so we don't look up their votes at all;
+  the filter is rebuilt larger when it gets over capacity; filters are only
+  read for members with no vote summary, which otherwise gives all their
+  votes in one read; filters are not cached, as a cached filter that misses
+  a vote would tell us the member has no vote on a post.
+  """
+
+  TABLE = 'VoteBlooms'
+  SCHEMA = Schema(TABLE, indexed=[], unindexed=[
+      'bits', 'capacity', 'count', 'false_positive_rate', 'updated_on',
+      'version'])
+
+  MIN_CAPACITY = 128
+  FALSE_POSITIVE_RATE = 0.01
+
+  def __init__(self, client=None):
+    if not client:
+      client = container.Registry.current().datastore_client
+    self.client = client
+
+  def _key(self, member_uid):
+    return self.client.key(self.TABLE, str(member_uid))
+
+  @classmethod
+  def new_filter(cls, post_uids):
+    """Creates filter with twice the room needed to hold post_uids."""
+    post_uids = list(post_uids)
+    result = bloom.BloomFilter(
+        max(cls.MIN_CAPACITY, 2 * len(post_uids)),
+        false_positive_rate=cls.FALSE_POSITIVE_RATE)
+    for post_uid in post_uids:
+      result.add(str(post_uid))
+    return result
+
+  def _put_filter(self, obj, afilter):
+    obj.update({
+        'bits': bytes(afilter.bits),
+        'capacity': afilter.capacity,
+        'count': afilter.count,
+        'false_positive_rate': afilter.false_positive_rate,
+        'updated_on': datetime.datetime.utcnow(),
+        'version': obj.get('version', 0) + 1,
+    })
+    self.client.put(self.SCHEMA.apply_to(obj))
+
+  def _filter_from(self, obj):
+    return bloom.BloomFilter(
+        obj['capacity'], false_positive_rate=obj['false_positive_rate'],
+        bits=bytearray(obj['bits']), count=obj['count'])
+
+  def replace(self, member_uid, post_uids):
+    """Replaces filter; must be called in transaction."""
+    key = self._key(member_uid)
+    obj = self.client.get(key) or self.SCHEMA.new_entity(key)
+    self._put_filter(obj, self.new_filter(post_uids))
+
+  def add_post(self, member_uid, post_uid, summaries):
+    """Adds post to member filter; must be called in transaction."""
+    self.add_posts(member_uid, [post_uid], summaries)
+
+  def add_posts(self, member_uid, post_uids, summaries):
+    """Adds posts to member filter; must be called in transaction."""
+    obj = self.client.get(self._key(member_uid))
+    if not obj:
+      return
+    afilter = self._filter_from(obj)
+    added = [afilter.add(str(post_uid)) for post_uid in post_uids]
+    if not any(added):
+      return
+
+    # too many items; rebuild larger filter from member vote summary
+    if afilter.is_over_capacity():
+      values = summaries.get_all_vote_values(member_uid) or {}
+      all_post_uids = set(values.keys())
+      all_post_uids.update([str(post_uid) for post_uid in post_uids])
+      afilter = self.new_filter(all_post_uids)
+    self._put_filter(obj, afilter)
+
+  def get_filter(self, member_uid):
+    """Returns stored filter or None if member has no filter."""
+    obj = self.client.get(self._key(member_uid))
+    if not obj:
+      return None
+    return self._filter_from(obj)
+
+  def filter_voted(self, member_uid, post_uids):
+    """Returns post_uids member may have voted on; None if no filter."""
+    afilter = self.get_filter(member_uid)
+    if afilter is None:
+      return None
+    return [post_uid for post_uid in post_uids if str(post_uid) in afilter]
+
+
 class Votes(object):
   """Facade for Datastore table Votes."""
 
   TABLE = 'Votes'
+  SCHEMA = Schema(TABLE, indexed=[
+      'post_uid', 'member_uid', 'created_on'
+  ], unindexed=[
+      'value', 'updated_on', 'version'
+  ])
+
+  MAX_POSTS_IN_TRANSACTION = 25
 
   def __init__(self, client=None):
     if not client:
       client = container.Registry.current().datastore_client
     self.client = client
     self.posts = Posts(client=client)
+    self.archives = VoteArchives(client=client)
+    self.summaries = VoteSummaries(client=client)
+    self.blooms = VoteBlooms(client=client)
 
   def _key(self, uid=None):
     if uid:
       return self.client.key(self.TABLE, uid)
     return self.client.key(self.TABLE)
 
+  def _archived_vote(self, post_uid, member_uid, value):
+    vote_ = datastore.Entity(self._key('%s/%s' % (post_uid, member_uid)))
+    vote_.update({
+        'post_uid': str(post_uid),
+        'member_uid': str(member_uid),
+        'value': value,
+        'version': 0,
+    })
+    return _Vote(vote_)
+
   def _fetch(self, query):
     results = []
     for item in query.fetch():
@@ -431,14 +1621,24 @@ class Votes(object):
     return self._fetch(query)
 
   def query_member_votes(self, member_uid):
-    """Returns all member votes."""
+    """Returns all member votes, except archived ones."""
     query = self.client.query(kind=self.TABLE)
     query.add_filter('member_uid', '=', str(member_uid))
     query.order = '-created_on'
     return self._fetch(query)
 
-  def query_member_votes_for(self, member_uid, post_uids):
-    """Returns all votes for specific user and posts."""
+  def query_member_votes_for(self, member_uid, post_uids,
+                             archived_post_uids=None):
+    """Returns all votes for specific user and posts.
+
+    Args:
+      member_uid: a uid of the member
+      post_uids: a list of post uids
+      archived_post_uids: a list of post uids, which votes were archived;
+          votes not found in Votes table are read from their archive blobs
+    Returns:
+      A list of votes.
+    """
 
     #
     # TODO(psimakov): this is ideally done using IN query, which was available
@@ -466,6 +1666,18 @@ class Votes(object):
       vote = _Vote(item)
       if vote.post_uid in post_uids:
         results.append(vote)
+
+    # add archived votes
+    if archived_post_uids:
+      found = set([vote.post_uid for vote in results])
+      missing = [str(item) for item in archived_post_uids
+                 if str(item) not in found]
+      archived = self.archives.get_archived_votes(missing)
+      for post_uid, votes in archived.items():
+        value = votes.get(str(member_uid))
+        if value:
+          results.append(self._archived_vote(post_uid, member_uid, value))
+
     return results
 
   def query_post_votes(self, post_uid):
@@ -475,13 +1687,71 @@ class Votes(object):
     query.order = '-created_on'
     return self._fetch(query)
 
-  def insert_vote(self, member_uid, post_uid, value):
-    """Inserts new vote from user."""
-
+  @classmethod
+  def _check_value(cls, value):
     if value not in set([1, -1]):
       raise BusinessRuleError(
           'Allowed vote values are +1 and -1, was "%s".' % value)
 
+  def _new_vote(self, member_uid, post, vote_key, utcnow):
+    """Returns new vote and old value of it, which may be in the archive."""
+    vote_ = self.SCHEMA.new_entity(vote_key)
+    vote_.update({
+        'post_uid': str(post.key.id_or_name),
+        'member_uid': str(member_uid),
+        'created_on': utcnow,
+        'version': 0,
+    })
+
+    # old vote may have been moved into archive
+    old_value = None
+    if post.votes_archived:
+      old_value = self.archives.remove_vote(post.key.id_or_name, member_uid)
+    return _Vote(vote_), old_value
+
+  @classmethod
+  def _apply_vote(cls, post, vote, old_value, value, utcnow):
+    """Replaces old vote value with a new one in vote and post counters."""
+
+    # revert old vote from post
+    if old_value == 1:
+      post.votes_up -= 1
+    elif old_value == -1:
+      post.votes_down -= 1
+    elif old_value == 0 or old_value is None:
+      # nothing to undo
+      pass
+    else:
+      raise BusinessRuleError('Bad vote value: "%s".' % old_value)
+
+    # voting with the same value again nulls the vote value
+    if old_value and old_value == value:
+      vote.value = 0
+    else:
+      vote.value = value
+
+    # update post with new vote
+    if vote.value == 1:
+      post.votes_up += 1
+    elif vote.value == -1:
+      post.votes_down += 1
+    elif vote.value == 0:
+      # nothing to do
+      pass
+    else:
+      raise BusinessRuleError('Bad vote value: "%s".' % vote.value)
+    post.votes_total = post.votes_up - post.votes_down
+
+    vote.updated_on = utcnow
+    vote.version += 1
+    post.updated_on = utcnow
+    post.version += 1
+
+  def insert_vote(self, member_uid, post_uid, value):
+    """Inserts new vote from user."""
+
+    self._check_value(value)
+
     with self.client.transaction():
       utcnow = datetime.datetime.utcnow()
 
@@ -497,65 +1767,303 @@ class Votes(object):
       vote_key = self._key(composite_uid)
       vote_ = self.client.get(vote_key)
 
-      old_value = None
       if not vote_:
         # add new vote if not exists
-        vote_ = datastore.Entity(vote_key)
-        vote_.update({
-            'post_uid': str(post_uid),
-            'member_uid': str(member_uid),
-            'created_on': utcnow,
-            'version': 0,
-        })
-        vote = _Vote(vote_)
+        vote, old_value = self._new_vote(member_uid, post, vote_key, utcnow)
       else:
-        # revert old vote from post
         vote = _Vote(vote_)
         old_value = vote.value
-        if vote.value == 1:
-          post.votes_up -= 1
-        elif vote.value == -1:
-          post.votes_down -= 1
-        elif vote.value == 0:
-          # nothing to undo
-          pass
-        else:
-          raise BusinessRuleError('Bad vote value: "%s".' % vote.value)
-
-      # voting with the same value again nulls the vote value
-      if old_value and old_value == value:
-        vote.value = 0
-      else:
-        vote.value = value
-
-      # update post with new vote
-      if vote.value == 1:
-        post.votes_up += 1
-      elif vote.value == -1:
-        post.votes_down += 1
-      elif vote.value == 0:
-        # nothing to do
-        pass
-      else:
-        raise BusinessRuleError('Bad vote value: "%s".' % vote.value)
-      post.votes_total = post.votes_up - post.votes_down
+      self._apply_vote(post, vote, old_value, value, utcnow)
 
       # update vote
-      vote.updated_on = utcnow
-      vote.version += 1
-      self.client.put(vote._obj)  # pylint: disable=protected-access
+      self.client.put(self.SCHEMA.apply_to(
+          vote._obj))  # pylint: disable=protected-access
+      self.summaries.set_vote(member_uid, post_uid, vote.value)
+      self.blooms.add_post(member_uid, post_uid, self.summaries)
 
       # update post
-      post.updated_on = utcnow
-      post.version += 1
-      self.client.put(post._obj)  # pylint: disable=protected-access
+      self.client.put(self.posts.SCHEMA.apply_to(
+          post._obj))  # pylint: disable=protected-access
+      Leaderboards(client=self.client).update_post(
+          post_uid, post.votes_total, is_deleted=post.is_deleted)
+
+    Leaderboards(client=self.client).invalidate()
+    ActivityCounters(client=self.client).record(ActivityCounters.SERIES_VOTES)
+    recent = RecentWrites(client=self.client)
+    recent.add_post(member_uid, post._obj)  # pylint: disable=protected-access
+    recent.add_vote(member_uid, post_uid, vote.value)
+    return post, vote
+
+  def insert_votes(self, member_uid, votes):
+    """Inserts many votes from user; each as insert_vote() would.
+
+    Votes are applied in order, so voting on the same post twice with the
+    same value cancels the vote, as two calls of insert_vote() would; votes
+    on up to MAX_POSTS_IN_TRANSACTION posts are read with one get_multi()
+    and written with one put_multi() in one transaction.
+
+    Args:
+      member_uid: uid of member voting
+      votes: a list of (post_uid, value)
+
+    Returns:
+      A list with (post, vote) or BusinessRuleError for each vote in order;
+      post and vote are the ones after all votes on the post were applied.
+    """
+    results = [None] * len(votes)
+    indexes_by_post_uid = collections.OrderedDict()
+    for index, (post_uid, value) in enumerate(votes):
+      if not is_valid_post_uid(post_uid):
+        results[index] = InvalidFieldValueError('uid', 'Must be a post uid.')
+        continue
+      try:
+        self._check_value(value)
+      except BusinessRuleError as error:
+        results[index] = error
+        continue
+      indexes_by_post_uid.setdefault(int(post_uid), []).append(index)
+
+    post_uids = list(indexes_by_post_uid.keys())
+    for start in range(0, len(post_uids), self.MAX_POSTS_IN_TRANSACTION):
+      batch = collections.OrderedDict([
+          (post_uid, indexes_by_post_uid[post_uid])
+          for post_uid in post_uids[
+              start:start + self.MAX_POSTS_IN_TRANSACTION]])
+      try:
+        updated = self._insert_votes_batch(member_uid, votes, batch, results)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error('Failed to insert %s votes: %s', len(batch), e)
+        error = BusinessRuleError(
+            'Failed to record vote. Please try again later.')
+        for indexes in batch.values():
+          for index in indexes:
+            results[index] = error
+        continue
+
+      # votes are committed; failures past this point must not report them
+      # as failed, or client retries and cancels them
+      try:
+        self._after_votes_batch(member_uid, batch, updated)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error('Failed to track %s committed votes: %s', len(batch), e)
+    return results
+
+  def _insert_votes_batch(self, member_uid, votes, indexes_by_post_uid,
+                          results):
+    """Inserts votes on a batch of posts in one transaction.
 
-      return post, vote
+    Returns:
+      A list of (post_uid, post, vote) for each post updated.
+    """
+    post_uids = list(indexes_by_post_uid.keys())
+    post_keys = [
+        self.posts._key(post_uid)  # pylint: disable=protected-access
+        for post_uid in post_uids]
+    vote_keys = [self._key('%s/%s' % (post_uid, member_uid))
+                 for post_uid in post_uids]
 
+    with self.client.transaction():
+      utcnow = datetime.datetime.utcnow()
+      existing = dict([(obj.key, obj) for obj in self.client.get_multi(
+          post_keys + vote_keys)])
+
+      updated = []
+      for post_uid, post_key, vote_key in zip(post_uids, post_keys, vote_keys):
+        indexes = indexes_by_post_uid[post_uid]
+        if post_key not in existing:
+          error = NotFoundError('No post for post_uid "%s".' % post_uid)
+          for index in indexes:
+            results[index] = error
+          continue
+        post = _Post(existing[post_key])
+
+        if vote_key not in existing:
+          vote, old_value = self._new_vote(member_uid, post, vote_key, utcnow)
+        else:
+          vote = _Vote(existing[vote_key])
+          old_value = vote.value
+        for index in indexes:
+          self._apply_vote(post, vote, old_value, votes[index][1], utcnow)
+          old_value = vote.value
+          results[index] = (post, vote)
+        updated.append((post_uid, post, vote))
+      if not updated:
+        return updated
+
+      # pylint: disable=protected-access
+      self.client.put_multi(
+          [self.SCHEMA.apply_to(vote._obj) for _, _, vote in updated] +
+          [self.posts.SCHEMA.apply_to(post._obj) for _, post, _ in updated])
+      # pylint: enable=protected-access
+      values = dict([
+          (post_uid, vote.value) for post_uid, _, vote in updated])
+      self.summaries.set_votes(member_uid, values)
+      self.blooms.add_posts(member_uid, list(values.keys()), self.summaries)
+      Leaderboards(client=self.client).update_posts([
+          (post_uid, post.votes_total, post.is_deleted)
+          for post_uid, post, _ in updated])
+    return updated
+
+  def _after_votes_batch(self, member_uid, indexes_by_post_uid, updated):
+    """Drops caches and tracks votes of a committed batch."""
+    if not updated:
+      return
+    Leaderboards(client=self.client).invalidate()
+    ActivityCounters(client=self.client).record(
+        ActivityCounters.SERIES_VOTES, delta=sum([
+            len(indexes_by_post_uid[post_uid]) for post_uid, _, _ in updated]))
+    recent = RecentWrites(client=self.client)
+    for post_uid, post, vote in updated:
+      recent.add_post(
+          member_uid, post._obj)  # pylint: disable=protected-access
+      recent.add_vote(member_uid, post_uid, vote.value)
+
+
+class RecentWrites(object):
+  """Short-lived journal of posts and votes each member has just written.
+
+  Queries are eventually consistent, so a member listing posts right after a
+  write may not see it yet; we keep recent writes of each member in a cache
+  for TTL_SECS and merge them into results of queries made by that member;
+  with the in-process cache the journal is only seen by the server instance
+  that took the write; plug in a shared cache to have it seen by all.
+  """
+
+  KEY_PREFIX = 'RecentWrites'
+  TTL_SECS = 60
+
+  _LOCK = threading.Lock()
+
+  def __init__(self, client=None, clock=time.time):
+    if not client:
+      client = container.Registry.current().datastore_client
+    self.client = client
+    self._clock = clock
+
+  @classmethod
+  def _store(cls):
+    registry = container.Registry.current()
+    if registry.shared_cache is not None:
+      return registry.shared_cache
+    return registry.cache
+
+  def _cache_key(self, member_uid):
+    return '%s/%s' % (self.KEY_PREFIX, member_uid)
+
+  def _load(self, member_uid):
+    journal = self._store().get(self._cache_key(member_uid)) or {}
+    cutoff = self._clock() - self.TTL_SECS
+    return dict([(name, dict([
+        (uid, entry) for uid, entry in journal.get(name, {}).items()
+        if entry['written_on'] > cutoff])) for name in ['posts', 'votes']])
+
+  def _add(self, member_uid, name, uid, entry):
+    entry['written_on'] = self._clock()
+    with self._LOCK:
+      journal = self._load(member_uid)
+      journal[name][str(uid)] = entry
+      self._store().set(
+          self._cache_key(member_uid), journal, ttl=self.TTL_SECS)
+
+  def add_post(self, member_uid, post):
+    """Records post as it was written by member."""
+    self._add(member_uid, 'posts', post.key.id_or_name, {
+        'uid': post.key.id_or_name,
+        'properties': dict(post),
+    })
+
+  def add_vote(self, member_uid, post_uid, value):
+    self._add(member_uid, 'votes', post_uid, {'value': value})
+
+  def get_generation(self, member_uid):
+    """Returns a token that changes whenever member writes something."""
+    journal = self._load(member_uid)
+    return str(max([entry['written_on'] for name in ['posts', 'votes']
+                    for entry in journal[name].values()] or [0]))
+
+  def get_vote_values(self, member_uid):
+    """Returns dict of post_uid to value of votes member recently cast."""
+    return dict([(uid, entry['value']) for uid, entry in self._load(
+        member_uid)['votes'].items()])
+
+  def merge_posts(self, member_uid, posts, accept=None, keep_deleted=False):
+    """Merges recent writes of member into a list of posts from a query.
+
+    Posts older than their recently written version are replaced by it;
+    posts recently deleted are dropped unless keep_deleted is set; posts
+    recently written but not in the list are added if accept(post) is True.
+
+    Returns:
+      A list of posts in the original order; added posts go last.
+    """
+    return list(self.iter_merged_posts(
+        member_uid, posts, accept=accept, keep_deleted=keep_deleted))
+
+  def iter_merged_posts(self, member_uid, posts, accept=None,
+                        keep_deleted=False):
+    """Yields posts of merge_posts() without reading all posts first."""
+    written = {}
+    for uid, entry in self._load(member_uid)['posts'].items():
+      obj = datastore.Entity(self.client.key(Posts.TABLE, entry['uid']))
+      obj.update(entry['properties'])
+      written[uid] = _Post(obj)
+
+    for post in posts:
+      recent = written.pop(str(post.key.id_or_name), None)
+      if recent and recent.version > post.version:
+        post = recent
+      if keep_deleted or not post.is_deleted:
+        yield post
+    if accept:
+      for post in written.values():
+        if (keep_deleted or not post.is_deleted) and accept(post):
+          yield post
+
+
+# all Datastore tables and their facades
+ALL_TABLES = dict([(table.TABLE, table) for table in [
+    Members, Posts, Votes, VoteArchives, VoteSummaries, VoteBlooms,
+    Leaderboards, ActivityCounters, PostViews]])
+
+
+def iter_pages(items, page_size):
+  """Yields lists of up to page_size items."""
+  page = []
+  for item in items:
+    page.append(item)
+    if len(page) >= page_size:
+      yield page
+      page = []
+  if page:
+    yield page
+
+
+def posts_query_to_pages(member_uid, posts, page_size, fill_votes=True,
+                         fields=None, client=None):
+  """Yields lists of posts of posts_query_to_list() page by page.
+
+  Only one page of posts is kept in memory; votes and views are read for
+  each page with a batch of lookups.
+  """
+  posts = itertools.islice(posts, MAX_POSTS_IN_LIST)
+  for page in iter_pages(posts, page_size):
+    yield posts_query_to_list(
+        member_uid, page, fill_votes=fill_votes, fields=fields, client=client)
+
+
+def posts_query_to_list(member_uid, posts, fill_votes=True, fields=None,
+                        client=None):
+  """Converts query iterator to list of posts.
+
+  If fields is given, only these fields of posts are needed; votes and views
+  are not read unless "my_vote_value" and "views" are among them.
+  """
+  fill_views = fields is None or 'views' in fields
+  fill_vote_values = fields is None or 'my_vote_value' in fields
+  fill_votes = fill_votes and fill_vote_values
 
-def posts_query_to_list(member_uid, posts, fill_votes=True, client=None):
-  """Converts query iterator to list of posts."""
   post_uids = []
+  archived_post_uids = []
   results = []
   by_post_uid = {}
 
@@ -566,25 +2074,58 @@ def posts_query_to_list(member_uid, posts, fill_votes=True, client=None):
 
     # collect ids
     post_uids.append(str(post.key.id))
+    if post.votes_archived:
+      archived_post_uids.append(str(post.key.id))
 
     # create projection and add to output
     item = {
         'uid': post.key.id,
         'can_delete': member_uid == post.member_uid,
-        'data': json.loads(post.data),
+        'data': serialization.RawJSON(post.data),
         'my_vote_value': None,
         'votes_up': post.votes_up,
         'votes_down': post.votes_down,
         'votes_total': post.votes_total,
+        'views': 0,
     }
     by_post_uid[str(post.key.id)] = item
     results.append(item)
 
   # add votes from current user
   if fill_votes:
-    votes = Votes(client=client).query_member_votes_for(member_uid, post_uids)
-    for vote in votes:
-      post = by_post_uid[vote.post_uid]
-      post['my_vote_value'] = vote.value
+    votes = Votes(client=client)
+
+    # summary has all votes of member in one read; without it, we query votes
+    # only for posts member may have voted on
+    values = {}
+    if post_uids:
+      values = votes.summaries.get_vote_values(member_uid, post_uids)
+    if values is None:
+      voted_post_uids = votes.blooms.filter_voted(member_uid, post_uids)
+      if voted_post_uids is None:
+        voted_post_uids = post_uids
+      voted = set(voted_post_uids)
+      archived_post_uids = [
+          item for item in archived_post_uids if item in voted]
+      values = {}
+      for vote in votes.query_member_votes_for(
+          member_uid, voted_post_uids,
+          archived_post_uids=archived_post_uids):
+        values[vote.post_uid] = vote.value
+    for post_uid, value in values.items():
+      by_post_uid[post_uid]['my_vote_value'] = value
+
+  # views
+  if fill_views:
+    for post_uid, count in PostViews(client=client).get_view_counts(
+        post_uids).items():
+      by_post_uid[post_uid]['views'] = count
+
+  # votes member has just cast may not be visible to queries yet
+  if fill_vote_values:
+    for post_uid, value in RecentWrites(
+        client=client).get_vote_values(member_uid).items():
+      if post_uid in by_post_uid:
+        by_post_uid[post_uid]['my_vote_value'] = value
 
   return results
@@ -5,10 +5,14 @@ __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
 import contextlib
+import datetime
+import time
 import unittest
 import webtest
 from google.cloud import datastore
+import cache
 import container
+import counters
 import dao
 import main
 
@@ -19,25 +23,67 @@ _TEST_PROJECT = 'TOYBOX_TEST'
 class MockQueryFetch(object):
   """Mock query fetch."""
 
+  OPS = {
+      '=': lambda left, right: left == right,
+      '<': lambda left, right: left < right,
+      '<=': lambda left, right: left <= right,
+      '>': lambda left, right: left > right,
+      '>=': lambda left, right: left >= right,
+  }
+
   def __init__(self, items):
     self.items = items
     self.order = None
     self.filters = []
 
-  def fetch(self):
+  def _orders(self):
+    if not self.order:
+      return []
+    if isinstance(self.order, str):
+      return [self.order]
+    return list(self.order)
+
+  @classmethod
+  def _key_order(cls, key):
+    return (key.kind, key.id or 0, key.name or '')
+
+  @classmethod
+  def _value_of(cls, item, field):
+    if field == '__key__':
+      return cls._key_order(item.key)
+    return item[field]
+
+  def keys_only(self):
+    pass
+
+  def fetch(self, limit=None):
     results = []
     for item in self.items:
       add = True
       for afilter in self.filters:
         field, op, value = afilter
-        if op == '=':
-          if item[field] != value:
-            add = False
-            break
-        else:
+        if op not in self.OPS:
           raise Exception('Unsupported filter: %s' % afilter)
+        if field == '__key__':
+          value = self._key_order(value)
+        elif field not in item:
+          add = False
+          break
+        if not self.OPS[op](self._value_of(item, field), value):
+          add = False
+          break
       if add:
         results.append(item)
+    for order in reversed(self._orders()):
+      field = order.lstrip('-')
+      if field == '__scatter__':
+        continue
+      results = sorted(
+          [item for item in results if field == '__key__' or field in item],
+          key=lambda item, field=field: self._value_of(item, field),
+          reverse=order.startswith('-'))
+    if limit is not None:
+      results = results[:limit]
     return results
 
   def add_filter(self, field, op, value):
@@ -68,6 +114,9 @@ class MockDatastoreClient(object):
   def get(self, key):
     return self.entities.get(key)
 
+  def get_multi(self, keys):
+    return [self.entities[key] for key in keys if key in self.entities]
+
   def put(self, entity):
     assert entity.key
 
@@ -81,6 +130,18 @@ class MockDatastoreClient(object):
     self.items.append(('put', entity))
     self.entities[entity.key] = entity
 
+  def put_multi(self, entities):
+    for entity in entities:
+      self.put(entity)
+
+  def delete(self, key):
+    self.items.append(('delete', key))
+    self.entities.pop(key, None)
+
+  def delete_multi(self, keys):
+    for key in keys:
+      self.delete(key)
+
   def query(self, kind=None):
     results = []
     for key, value in self.entities.items():
@@ -99,8 +160,11 @@ class BaseTestSuite(unittest.TestCase):
     self.client = self.DATASTORE_MOCK()
     self.old_datastore_client = container.Registry.current().patch(
         'datastore_client', self.client)
+    self.old_cache = container.Registry.current().patch(
+        'cache', cache.InProcessCache())
 
   def tearDown(self):
+    container.Registry.current().patch('cache', self.old_cache)
     container.Registry.current().patch(
         'datastore_client', self.old_datastore_client)
     super(BaseTestSuite, self).tearDown()
@@ -115,6 +179,57 @@ class MembersTestSuite(BaseTestSuite):
     members.get_or_create_member('member-1')
     self.assertEqual(1, len(list(members.query_members())))
 
+  def test_member_properties_are_not_indexed(self):
+    member = dao.Members().get_or_create_member('member-1')
+    entity = self.client.get(member.key)
+    self.assertEqual(
+        set(['data', 'created_on', 'version']),
+        set(entity.exclude_from_indexes) & set(entity.keys()))
+
+  def test_get_member_by_slug(self):
+    members = dao.Members()
+    member = members.get_or_create_member('member-1')
+    self.assertEqual(member.key, members.get_member_by_slug(member.slug).key)
+    self.assertIsNone(members.get_member_by_slug('no-such-slug'))
+
+    # update made by another server instance with its own cache is seen;
+    # entity is stored as a copy, as Datastore never returns the cached one
+    entity = datastore.Entity(member.key)
+    entity.update(self.client.get(member.key))
+    self.client.put(entity)
+    registry = container.Registry.current()
+    old_cache = registry.patch('cache', cache.InProcessCache())
+    try:
+      members.update('member-1', '{"a": 2}')
+    finally:
+      registry.patch('cache', old_cache)
+
+    # key is cached, so member is read by key without a query
+    query = self.client.query
+    def fail(*unused_args, **unused_kwargs):
+      raise Exception('Unexpected query.')
+    self.client.query = fail
+    try:
+      self.assertEqual(
+          '{"a": 2}', members.get_member_by_slug(member.slug).data)
+    finally:
+      self.client.query = query
+
+  def test_update_reindexes_old_entity(self):
+    key = self.client.key(dao.Members.TABLE, 'member-1')
+    old = datastore.Entity(key)
+    old.update({'slug': 'slug-1', 'data': '{}', 'version': 1})
+    self.client.put(old)
+
+    self.assertTrue(dao.Members.SCHEMA.needs_reindex(old))
+    dao.Members().update('member-1', '{}')
+    self.assertFalse(dao.Members.SCHEMA.needs_reindex(self.client.get(key)))
+
+    # loaded entities list exclusions of the properties they have only
+    loaded = datastore.Entity(key, exclude_from_indexes=('data', 'version'))
+    loaded.update({'data': '{}', 'version': 2})
+    self.assertFalse(dao.Members.SCHEMA.needs_reindex(loaded))
+
 
 class PostsAndVotesBaseTestSuite(BaseTestSuite):
   """Test cases for Posts and Votes."""
@@ -156,6 +271,13 @@ class PostsTestSuite(PostsAndVotesBaseTestSuite):
     posts = list(self.posts.query_posts())
     self.assertEqual(0, len(posts))
 
+  def test_post_schema(self):
+    post = self.client.get(self.test_insert_one_post().key)
+    self.assertEqual(dao.Posts.SCHEMA.unindexed,
+                     post.exclude_from_indexes)
+    for name in ['member_uid', 'is_deleted', 'votes_total', 'created_on']:
+      self.assertNotIn(name, post.exclude_from_indexes)
+
   def test_mark_post_deleted(self):
     post = self.test_insert_one_post()
     posts = list(self.posts.query_posts())
@@ -165,6 +287,83 @@ class PostsTestSuite(PostsAndVotesBaseTestSuite):
     posts = list(self.posts.query_posts())
     self.assertEqual(0, len(posts))
 
+  def test_query_posts_changed_since(self):
+    post = self.test_insert_one_post()
+    created_on = self.posts.get_post(post.key.id).updated_on
+    since = created_on - datetime.timedelta(microseconds=1)
+    self.assertEqual(1, len(self.posts.query_posts_changed_since(since)))
+    self.assertFalse(self.posts.query_posts_changed_since(created_on))
+
+    self.posts.mark_post_deleted('member-1', post.key.id)
+    changes = self.posts.query_posts_changed_since(created_on)
+    self.assertEqual(1, len(changes))
+    self.assertTrue(changes[0].is_deleted)
+    self.assertEqual(2, changes[0].version)
+
+  def test_query_posts_changed_since_same_updated_on(self):
+    self.members.get_or_create_member('member-1')
+    uids = [self.posts.insert_post('member-1', '{}').key.id
+            for _ in range(3)]
+    updated_on = self.posts.get_post(uids[0]).updated_on
+    for uid in uids:
+      self.client.get(self.posts._key(uid))['updated_on'] = updated_on
+    since = updated_on - datetime.timedelta(microseconds=1)
+
+    # page ends between posts with the same updated_on
+    changes = self.posts.query_posts_changed_since(since, limit=2)
+    self.assertEqual(uids[:2], [post.key.id for post in changes])
+    changes = self.posts.query_posts_changed_since(
+        updated_on, after_uid=uids[1], limit=2)
+    self.assertEqual(uids[2:], [post.key.id for post in changes])
+
+  def test_get_generation(self):
+    self.assertEqual('', self.posts.get_generation())
+    post = self.test_insert_one_post()
+    generation = self.posts.get_generation()
+    self.assertTrue(generation.startswith('%s@' % post.key.id))
+    self.posts.mark_post_deleted('member-1', post.key.id)
+    self.assertNotEqual(generation, self.posts.get_generation())
+
+    # a write that commits late, with updated_on older than the latest one
+    generation = self.posts.get_generation()
+    late = self.test_insert_one_post()
+    self.client.get(late.key)['updated_on'] -= datetime.timedelta(seconds=30)
+    self.assertNotEqual(generation, self.posts.get_generation())
+
+    # too many recent writes to tell apart
+    old_max_entities = dao.MAX_ENTITIES_IN_GENERATION
+    dao.MAX_ENTITIES_IN_GENERATION = 1
+    try:
+      self.assertNotEqual(self.posts.get_generation(),
+                          self.posts.get_generation())
+    finally:
+      dao.MAX_ENTITIES_IN_GENERATION = old_max_entities
+
+  def test_moderation(self):
+    post = self.test_insert_one_post()
+    self.assertEqual(dao.MODERATION_PENDING, post.moderation)
+    self.assertEqual(
+        [post.key.id],
+        [item.key.id for item in self.posts.query_pending_moderation(10)])
+    self.assertFalse(self.posts.query_posts(
+        moderation=dao.MODERATION_FLAGGED))
+
+    self.assertEqual(1, self.posts.set_moderation({
+        post.key.id: ['PHONE_NUMBER', 'EMAIL_ADDRESS', 'PHONE_NUMBER']}))
+    post = self.posts.get_post(post.key.id)
+    self.assertEqual(dao.MODERATION_FLAGGED, post.moderation)
+    self.assertEqual(['EMAIL_ADDRESS', 'PHONE_NUMBER'],
+                     post.moderation_findings)
+    self.assertEqual(2, post.version)
+    self.assertFalse(self.posts.query_pending_moderation(10))
+    self.assertEqual(1, len(self.posts.query_posts(
+        moderation=dao.MODERATION_FLAGGED)))
+
+    # posts already moderated are not changed
+    self.assertEqual(0, self.posts.set_moderation({post.key.id: []}))
+    self.assertEqual(dao.MODERATION_FLAGGED,
+                     self.posts.get_post(post.key.id).moderation)
+
   def test_mark_post_deleted_fails_if_not_owner(self):
     self.members.get_or_create_member('member-1')
     self.members.get_or_create_member('member-2')
@@ -292,6 +491,72 @@ class VotesTestSuite(PostsAndVotesBaseTestSuite):
     self.assertEqual(0, updated_post.votes_down)
     self.assertEqual(1, updated_post.votes_total)
 
+  def _test_insert_votes(self):
+    self.members.get_or_create_member('member-1')
+    post1 = self.posts.insert_post('member-1', '{}')
+    post2 = self.posts.insert_post('member-1', '{}')
+    uid1, uid2 = post1.key.id, post2.key.id
+
+    results = self.votes.insert_votes('member-1', [
+        (uid1, 1), (uid2, -1), (uid1, 1), (uid2, 1), (uid1, 2),
+        (123456789, 1)])
+    self.assertEqual(6, len(results))
+    self.assertIsInstance(results[4], dao.BusinessRuleError)
+    self.assertIsInstance(results[5], dao.NotFoundError)
+    self.assertEqual(0, results[0][1].value)
+    self.assertIs(results[0][0], results[2][0])
+    self.assertEqual(1, results[3][1].value)
+
+    # repeated vote cancelled the first one, as with insert_vote()
+    updated_post1 = self.posts.get_post(uid1)
+    self.assertEqual(0, updated_post1.votes_up)
+    self.assertEqual(0, updated_post1.votes_total)
+    updated_post2 = self.posts.get_post(uid2)
+    self.assertEqual(1, updated_post2.votes_up)
+    self.assertEqual(0, updated_post2.votes_down)
+    self.assertEqual(1, updated_post2.votes_total)
+
+    self.assertEqual(
+        {str(uid1): 0, str(uid2): 1},
+        self.votes.summaries.get_vote_values('member-1', [uid1, uid2]))
+    self.assertEqual(2, len(list(self.votes.query_member_votes('member-1'))))
+    self.assertEqual(
+        {str(uid1): 0, str(uid2): 1},
+        dao.RecentWrites().get_vote_values('member-1'))
+
+  def test_insert_votes(self):
+    self._test_insert_votes()
+
+  def test_insert_votes_in_many_transactions(self):
+    self.votes.MAX_POSTS_IN_TRANSACTION = 1
+    self._test_insert_votes()
+
+  def test_insert_votes_checks_post_uids(self):
+    self.members.get_or_create_member('member-1')
+    uid = self.posts.insert_post('member-1', '{}').key.id
+    results = self.votes.insert_votes('member-1', [
+        ([uid], 1), ('x' * 2000, 1), (True, 1), (str(uid), 1), (uid, -1)])
+    for result in results[:3]:
+      self.assertIsInstance(result, dao.InvalidFieldValueError)
+
+    # digit string is the same post as int
+    self.assertEqual([-1, -1], [result[1].value for result in results[3:]])
+    self.assertEqual(-1, self.posts.get_post(uid).votes_total)
+
+  def test_insert_votes_keeps_committed_votes(self):
+    self.members.get_or_create_member('member-1')
+    uid = self.posts.insert_post('member-1', '{}').key.id
+    original = dao.RecentWrites.add_vote
+    def fail(*unused_args, **unused_kwargs):
+      raise Exception('Cache is not available.')
+    dao.RecentWrites.add_vote = fail
+    try:
+      results = self.votes.insert_votes('member-1', [(uid, 1)])
+    finally:
+      dao.RecentWrites.add_vote = original
+    self.assertEqual(1, results[0][1].value)
+    self.assertEqual(1, self.posts.get_post(uid).votes_total)
+
   def test_revoting_with_the_same_way_cancel_first_vote(self):
     post = self.test_insert_one_post()
 
@@ -330,5 +595,605 @@ class VotesTestSuite(PostsAndVotesBaseTestSuite):
     self.assertEqual(0, vote.value)
 
 
+class ActivityCountersTestSuite(BaseTestSuite):
+  """Test cases for ActivityCounters."""
+
+  def setUp(self):
+    super(ActivityCountersTestSuite, self).setUp()
+    self.counters = dao.ActivityCounters()
+
+  def test_bucket_start(self):
+    when = datetime.datetime(2020, 5, 6, 7, 8, 9, 10)
+    self.assertEqual(datetime.datetime(2020, 5, 6, 7, 8),
+                     self.counters.bucket_start(when, 'minute'))
+    self.assertEqual(datetime.datetime(2020, 5, 6, 7),
+                     self.counters.bucket_start(when, 'hour'))
+    self.assertEqual(datetime.datetime(2020, 5, 6),
+                     self.counters.bucket_start(when, 'day'))
+
+  def test_get_series(self):
+    start = datetime.datetime(2020, 5, 6, 7, 8)
+    for minutes in [0, 0, 1, 61, 61, 61]:
+      self.counters.increment(
+          'votes', when=start + datetime.timedelta(minutes=minutes))
+    self.counters.increment('posts', when=start)
+
+    end = start + datetime.timedelta(minutes=61)
+    self.assertEqual(
+        [(datetime.datetime(2020, 5, 6, 7), 3),
+         (datetime.datetime(2020, 5, 6, 8), 3)],
+        self.counters.get_series('votes', 'hour', 2, end=end))
+    self.assertEqual(
+        [(datetime.datetime(2020, 5, 6), 6)],
+        self.counters.get_series('votes', 'day', 1, end=end))
+    self.assertEqual(
+        [2, 1, 0], [count for _, count in self.counters.get_series(
+            'votes', 'minute', 3, end=start + datetime.timedelta(minutes=2))])
+
+    # reads a bounded set of keys, never queries
+    self.client.query = None
+    self.assertEqual(
+        [(datetime.datetime(2020, 5, 6, 8), 0)],
+        self.counters.get_series('posts', 'hour', 1, end=end))
+
+  def test_write_paths_count_activity(self):
+    dao.Members().get_or_create_member('member-1')
+    post = dao.Posts().insert_post('member-1', '{}')
+    dao.Votes().insert_vote('member-1', post.key.id, 1)
+    dao.Votes().insert_vote('member-1', post.key.id, 1)
+    self.assertEqual(
+        [(self.counters.bucket_start(datetime.datetime.utcnow(), 'day'), 1)],
+        self.counters.get_series('posts', 'day', 1))
+    self.assertEqual(2, self.counters.get_series('votes', 'day', 1)[0][1])
+
+  def test_record_never_fails(self):
+    self.client.transaction = None
+    self.counters.record('votes')
+
+
+class RecentWritesTestSuite(PostsAndVotesBaseTestSuite):
+  """Test cases for RecentWrites."""
+
+  def setUp(self):
+    super(RecentWritesTestSuite, self).setUp()
+    self.now = time.time()
+    self.recent = dao.RecentWrites(clock=lambda: self.now)
+    self.members.get_or_create_member('member-1')
+
+  def test_merge_posts(self):
+    post = self.posts.insert_post('member-1', '{}')
+    stale = self.posts.get_post(post.key.id)
+
+    # query has not seen new post yet
+    self.assertEqual([], self.recent.merge_posts('member-1', []))
+    self.assertEqual([post.key.id], [item.key.id for item in (
+        self.recent.merge_posts('member-1', [], accept=lambda _: True))])
+    self.assertEqual([], self.recent.merge_posts('member-2', [],
+                                                 accept=lambda _: True))
+
+    # query returns old version of the post
+    stale_obj = datastore.Entity(stale.key)
+    stale_obj.update(dict(self.client.get(stale.key)))
+    self.votes.insert_vote('member-1', post.key.id, 1)
+    stale_obj['votes_total'] = 0
+    stale_obj['version'] = 1
+    merged = self.recent.merge_posts('member-1', [dao._Post(stale_obj)])
+    self.assertEqual([1], [item.votes_total for item in merged])
+
+    # deleted post is dropped unless asked to keep it
+    self.posts.mark_post_deleted('member-1', post.key.id)
+    self.assertEqual([], self.recent.merge_posts(
+        'member-1', [dao._Post(stale_obj)]))
+    self.assertEqual([True], [item.is_deleted for item in (
+        self.recent.merge_posts('member-1', [dao._Post(stale_obj)],
+                                keep_deleted=True))])
+
+    # journal expires
+    self.now += dao.RecentWrites.TTL_SECS + 1
+    self.assertEqual([], self.recent.merge_posts(
+        'member-1', [], accept=lambda _: True, keep_deleted=True))
+
+  def test_vote_values_overlay(self):
+    post = self.posts.insert_post('member-1', '{}')
+    self.votes.insert_vote('member-1', post.key.id, -1)
+    self.assertEqual({str(post.key.id): -1},
+                     self.recent.get_vote_values('member-1'))
+    items = dao.posts_query_to_list(
+        'member-1', [self.posts.get_post(post.key.id)], fill_votes=False)
+    self.assertEqual(-1, items[0]['my_vote_value'])
+    items = dao.posts_query_to_list(
+        'member-2', [self.posts.get_post(post.key.id)], fill_votes=False)
+    self.assertIsNone(items[0]['my_vote_value'])
+
+
+class PostViewsTestSuite(PostsAndVotesBaseTestSuite):
+  """Test cases for PostViews."""
+
+  def setUp(self):
+    super(PostViewsTestSuite, self).setUp()
+    self.now = 0
+    self.flushed = []
+    self.old_pending = dao._POST_VIEWS_PENDING
+    dao._POST_VIEWS_PENDING = counters.WriteBehindCounter(
+        self._flush, flush_interval_secs=10, max_pending_keys=3,
+        clock=lambda: self.now, background=False)
+    self.views = dao.PostViews()
+
+  def tearDown(self):
+    dao._POST_VIEWS_PENDING = self.old_pending
+    super(PostViewsTestSuite, self).tearDown()
+
+  def _flush(self, deltas):
+    self.flushed.append(deltas)
+    dao.PostViews().add_views(deltas)
+
+  def test_views_are_flushed_in_batches(self):
+    self.views.record_views(['1', '2', '1'])
+    self.assertEqual([], self.flushed)
+    self.assertEqual({'1': 2, '2': 1, '3': 0},
+                     self.views.get_view_counts(['1', '2', '3']))
+
+    # flush on interval
+    self.now += 10
+    self.views.record_views(['1'])
+    self.assertEqual([{'1': 3, '2': 1}], self.flushed)
+    self.assertEqual({'1': 3, '2': 1},
+                     self.views.get_view_counts(['1', '2']))
+
+    # flush on number of keys pending
+    self.views.record_views(['4', '5', '6'])
+    self.assertEqual({'4': 1, '5': 1, '6': 1}, self.flushed[-1])
+
+    # counts of other instances are read from other shards
+    self.views.add_views({'1': 5}, shard=(
+        dao.PostViews.INSTANCE_SHARD + 1) % dao.PostViews.SHARDS)
+    self.assertEqual({'1': 8}, self.views.get_view_counts(['1']))
+
+  def test_view_counts_are_read_from_summaries(self):
+    for shard in [0, 1]:
+      self.views.add_views({'1': 1, '2': 2, '3': 3}, shard=shard)
+    old_max_posts = dao.PostViews.MAX_POSTS_IN_TRANSACTION
+    dao.PostViews.MAX_POSTS_IN_TRANSACTION = 2
+    try:
+      # shards of all posts are summed, a few posts per transaction
+      self.assertEqual({'1': 2, '2': 4, '3': 6},
+                       self.views.get_view_counts(['1', '2', '3']))
+    finally:
+      dao.PostViews.MAX_POSTS_IN_TRANSACTION = old_max_posts
+
+    # summaries are read instead of shards
+    container.Registry.current().cache.clear()
+    for shard in [0, 1]:
+      self.client.delete(self.views._key('1', shard))
+    self.assertEqual({'1': 2}, self.views.get_view_counts(['1']))
+
+    # new views drop summary
+    self.views.add_views({'1': 1}, shard=2)
+    self.assertEqual({'1': 1}, self.views.get_view_counts(['1']))
+
+  def test_summaries_are_saved_with_shards_read(self):
+    self.views.add_views({'1': 1})
+    calls = []
+    old_transaction = self.client.transaction
+    old_get_multi = self.client.get_multi
+    old_put_multi = self.client.put_multi
+
+    @contextlib.contextmanager
+    def transaction():
+      calls.append('begin')
+      with old_transaction():
+        yield
+      calls.append('commit')
+
+    def get_multi(keys):
+      calls.append('get')
+      return old_get_multi(keys)
+
+    def put_multi(entities):
+      calls.append('put')
+      return old_put_multi(entities)
+
+    self.client.transaction = transaction
+    self.client.get_multi = get_multi
+    self.client.put_multi = put_multi
+    self.assertEqual({'1': 1}, self.views.get_view_counts(['1']))
+    self.assertEqual(['get', 'begin', 'get', 'put', 'commit'], calls)
+
+  def test_failed_flush_returns_views_not_written(self):
+    self.views.add_views({'1': 1})
+    old_max_posts = dao.PostViews.MAX_POSTS_IN_TRANSACTION
+    old_delete_multi = self.client.delete_multi
+    old_put_multi = self.client.put_multi
+    dao.PostViews.MAX_POSTS_IN_TRANSACTION = 2
+
+    def put_multi(entities):
+      if entities[0].key.name.startswith('3/'):
+        raise Exception('Datastore is unavailable.')
+      old_put_multi(entities)
+
+    def delete_multi(unused_keys):
+      raise Exception('Datastore is unavailable.')
+
+    self.client.delete_multi = delete_multi
+    self.client.put_multi = put_multi
+    try:
+      with self.assertRaises(counters.PartialFlushError) as error:
+        self.views.add_views({'1': 1, '2': 2, '3': 3, '4': 4})
+    finally:
+      dao.PostViews.MAX_POSTS_IN_TRANSACTION = old_max_posts
+      self.client.delete_multi = old_delete_multi
+      self.client.put_multi = old_put_multi
+    self.assertEqual({'3': 3, '4': 4}, error.exception.deltas)
+    self.assertEqual({'1': 2, '2': 2, '3': 0, '4': 0},
+                     self.views.get_view_counts(['1', '2', '3', '4']))
+
+  def test_posts_query_to_list(self):
+    post = self.test_insert_one_post()
+    self.views.record_views([post.key.id, post.key.id])
+    results = dao.posts_query_to_list(
+        'member-1', [self.posts.get_post(post.key.id)])
+    self.assertEqual(2, results[0]['views'])
+
+    # views are not read if they are not among fields client needs
+    results = dao.posts_query_to_list(
+        'member-1', [self.posts.get_post(post.key.id)],
+        fields=frozenset(['uid', 'votes_total']))
+    self.assertEqual(0, results[0]['views'])
+
+  def test_posts_query_to_pages(self):
+    self.assertEqual(
+        [[0, 1], [2, 3], [4]], list(dao.iter_pages(iter(range(5)), 2)))
+    self.members.get_or_create_member('member-1')
+    post_uids = [self.posts.insert_post('member-1', '{}').key.id
+                 for _ in range(3)]
+    pages = list(dao.posts_query_to_pages(
+        'member-1', self.posts.iter_posts(), 2))
+    self.assertEqual([2, 1], [len(page) for page in pages])
+    self.assertEqual(
+        sorted(post_uids),
+        sorted([item['uid'] for page in pages for item in page]))
+
+
+class VoteArchivesTestSuite(PostsAndVotesBaseTestSuite):
+  """Test cases for VoteArchives."""
+
+  def setUp(self):
+    super(VoteArchivesTestSuite, self).setUp()
+    self.archives = dao.VoteArchives()
+
+  def _archived_post(self):
+    for uid in ['member-1', 'member-2', 'member-3']:
+      self.members.get_or_create_member(uid)
+    post = self.test_insert_one_post()
+    self.votes.insert_vote('member-1', post.key.id, 1)
+    self.votes.insert_vote('member-2', post.key.id, -1)
+    self.votes.insert_vote('member-3', post.key.id, 1)
+    self.votes.insert_vote('member-3', post.key.id, 1)
+
+    self.assertEqual(3, self.archives.archive_post_votes(post.key.id))
+    self.assertEqual(0, len(self.votes.query_votes()))
+    return post
+
+  def test_archive_post_votes(self):
+    post = self._archived_post()
+
+    # counters are kept on post
+    updated_post = self.posts.get_post(post.key.id)
+    self.assertTrue(updated_post.votes_archived)
+    self.assertEqual(1, updated_post.votes_up)
+    self.assertEqual(1, updated_post.votes_down)
+    self.assertEqual(0, updated_post.votes_total)
+
+    # cancelled votes are not archived
+    self.assertEqual(
+        {str(post.key.id): {'member-1': 1, 'member-2': -1}},
+        self.archives.get_archived_votes([post.key.id]))
+
+    # nothing to do second time
+    self.assertEqual(0, self.archives.archive_post_votes(post.key.id))
+
+  def test_query_member_votes_for_reads_archive(self):
+    post = self._archived_post()
+    self.assertFalse(self.votes.query_member_votes_for(
+        'member-1', [post.key.id]))
+    votes = self.votes.query_member_votes_for(
+        'member-1', [post.key.id], archived_post_uids=[post.key.id])
+    self.assertEqual(1, len(votes))
+    self.assertEqual(1, votes[0].value)
+    self.assertEqual(str(post.key.id), votes[0].post_uid)
+
+    results = dao.posts_query_to_list(
+        'member-2', [self.posts.get_post(post.key.id)])
+    self.assertEqual(-1, results[0]['my_vote_value'])
+
+  def test_vote_on_archived_post(self):
+    post = self._archived_post()
+
+    # same vote again cancels the archived one
+    self.votes.insert_vote('member-1', post.key.id, 1)
+    updated_post = self.posts.get_post(post.key.id)
+    self.assertEqual(0, updated_post.votes_up)
+    self.assertEqual(-1, updated_post.votes_total)
+    self.assertEqual(
+        {str(post.key.id): {'member-2': -1}},
+        self.archives.get_archived_votes([post.key.id]))
+    votes = self.votes.query_member_votes_for(
+        'member-1', [post.key.id], archived_post_uids=[post.key.id])
+    self.assertEqual([0], [vote.value for vote in votes])
+
+    # new votes are archived again
+    self.assertEqual(1, self.archives.archive_post_votes(post.key.id))
+    self.assertEqual(
+        {str(post.key.id): {'member-2': -1}},
+        self.archives.get_archived_votes([post.key.id]))
+
+
+class VoteSummariesTestSuite(PostsAndVotesBaseTestSuite):
+  """Test cases for VoteSummaries."""
+
+  def setUp(self):
+    super(VoteSummariesTestSuite, self).setUp()
+    self.summaries = dao.VoteSummaries()
+
+  def test_new_member_has_empty_summary(self):
+    self.members.get_or_create_member('member-1')
+    self.assertEqual({}, self.summaries.get_vote_values(
+        'member-1', ['1', '2', '3', '4', '5']))
+    self.assertIsNone(self.summaries.get_vote_values('member-2', ['1']))
+
+  def test_summary_follows_votes(self):
+    post = self.test_insert_one_post()
+    self.votes.insert_vote('member-1', post.key.id, 1)
+    self.assertEqual({str(post.key.id): 1}, self.summaries.get_vote_values(
+        'member-1', [post.key.id]))
+    self.votes.insert_vote('member-1', post.key.id, 1)
+    self.assertEqual({str(post.key.id): 0}, self.summaries.get_vote_values(
+        'member-1', [post.key.id]))
+
+  def test_posts_query_to_list_reads_summary_only(self):
+    post = self.test_insert_one_post()
+    self.votes.insert_vote('member-1', post.key.id, -1)
+
+    def fail(*unused_args, **unused_kwargs):
+      raise Exception('Unexpected query.')
+
+    self.client.query = fail
+    results = dao.posts_query_to_list(
+        'member-1', [self.posts.get_post(post.key.id)])
+    self.assertEqual(-1, results[0]['my_vote_value'])
+
+  def test_posts_query_to_list_without_summary(self):
+    post = self.test_insert_one_post()
+    self.votes.insert_vote('member-1', post.key.id, -1)
+    for key in list(self.client.entities.keys()):
+      if key.kind == dao.VoteSummaries.TABLE:
+        self.client.delete(key)
+
+    results = dao.posts_query_to_list(
+        'member-1', [self.posts.get_post(post.key.id)])
+    self.assertEqual(-1, results[0]['my_vote_value'])
+
+
+class VoteBloomsTestSuite(PostsAndVotesBaseTestSuite):
+  """Test cases for VoteBlooms."""
+
+  def setUp(self):
+    super(VoteBloomsTestSuite, self).setUp()
+    self.blooms = dao.VoteBlooms()
+
+  def test_filter_follows_votes(self):
+    post = self.test_insert_one_post()
+    self.assertEqual([], self.blooms.filter_voted('member-1', [post.key.id]))
+    self.votes.insert_vote('member-1', post.key.id, 1)
+    self.assertEqual(
+        [post.key.id], self.blooms.filter_voted('member-1', [post.key.id]))
+    self.assertIsNone(self.blooms.filter_voted('member-2', [post.key.id]))
+
+  def test_filter_is_not_cached_in_process(self):
+    post = self.test_insert_one_post()
+    self.assertEqual([], self.blooms.filter_voted('member-1', [post.key.id]))
+
+    # vote recorded by another server instance with its own cache
+    registry = container.Registry.current()
+    old_cache = registry.patch('cache', cache.InProcessCache())
+    try:
+      self.votes.insert_vote('member-1', post.key.id, 1)
+    finally:
+      registry.patch('cache', old_cache)
+    self.assertEqual(
+        [post.key.id], self.blooms.filter_voted('member-1', [post.key.id]))
+
+  def test_filter_is_not_cached(self):
+    post = self.test_insert_one_post()
+    shared_cache = cache.InProcessCache()
+    registry = container.Registry.current()
+    old_shared_cache = registry.patch('shared_cache', shared_cache)
+    try:
+      self.assertEqual(
+          [], self.blooms.filter_voted('member-1', [post.key.id]))
+      with self.client.transaction():
+        self.blooms.replace('member-1', [post.key.id])
+      self.assertEqual(
+          [post.key.id], self.blooms.filter_voted('member-1', [post.key.id]))
+      self.assertEqual(0, len(shared_cache))
+    finally:
+      registry.patch('shared_cache', old_shared_cache)
+
+  def _fail(self, *unused_args, **unused_kwargs):
+    raise Exception('Unexpected lookup.')
+
+  def test_posts_query_to_list_reads_summary_only(self):
+    post = self.test_insert_one_post()
+    self.votes.insert_vote('member-1', post.key.id, 1)
+    post = self.posts.get_post(post.key.id)
+    self.client.get = self._fail
+    self.client.query = self._fail
+    results = dao.posts_query_to_list('member-1', [post])
+    self.assertEqual(1, results[0]['my_vote_value'])
+
+  def test_posts_query_to_list_skips_lookups_without_summary(self):
+    post = self.test_insert_one_post()
+    for shard in range(dao.VoteSummaries.SHARDS):
+      self.client.delete(self.votes.summaries._key('member-1', shard))
+    self.client.query = self._fail
+    results = dao.posts_query_to_list(
+        'member-1', [self.posts.get_post(post.key.id)])
+    self.assertIsNone(results[0]['my_vote_value'])
+
+  def test_filter_is_rebuilt_when_over_capacity(self):
+    self.members.get_or_create_member('member-1')
+    for index in range(dao.VoteBlooms.MIN_CAPACITY + 1):
+      post = self.posts.insert_post('member-1', '{}')
+      self.votes.insert_vote('member-1', post.key.id, 1)
+    afilter = self.blooms.get_filter('member-1')
+    self.assertEqual(2 * (dao.VoteBlooms.MIN_CAPACITY + 1), afilter.capacity)
+    self.assertFalse(afilter.is_over_capacity())
+    self.assertIn(str(post.key.id), afilter)
+
+
+class LeaderboardsTestSuite(PostsAndVotesBaseTestSuite):
+  """Test cases for Leaderboards."""
+
+  def setUp(self):
+    super(LeaderboardsTestSuite, self).setUp()
+    self.old_sizes = (dao.Leaderboards.SHARDS, dao.Leaderboards.SIZE,
+                      dao.Leaderboards.CAPACITY)
+    dao.Leaderboards.SHARDS = 1
+    dao.Leaderboards.SIZE = 2
+    dao.Leaderboards.CAPACITY = 3
+    self.boards = dao.Leaderboards()
+    self.members.get_or_create_member('member-1')
+
+  def tearDown(self):
+    (dao.Leaderboards.SHARDS, dao.Leaderboards.SIZE,
+     dao.Leaderboards.CAPACITY) = self.old_sizes
+    super(LeaderboardsTestSuite, self).tearDown()
+
+  def _insert_posts(self, count):
+    return [self.posts.insert_post('member-1', '{}').key.id
+            for _ in range(count)]
+
+  def _vote(self, post_uid, value, voters):
+    for index in range(voters):
+      self.votes.insert_vote('voter-%s' % index, post_uid, value)
+
+  def _no_queries(self):
+    def fail(*unused_args, **unused_kwargs):
+      raise Exception('Unexpected query.')
+
+    self.client.query = fail
+
+  def test_fallback_to_query_rebuilds_board(self):
+    uid1, uid2, uid3 = self._insert_posts(3)
+    self._vote(uid2, 1, 2)
+    self._vote(uid3, 1, 1)
+    self.assertIsNone(self.boards.get_top_post_uids(2))
+
+    top = self.posts.query_top_posts(2)
+    self.assertEqual([uid2, uid3], [post.key.id for post in top])
+
+    self._no_queries()
+    self.assertEqual([uid2, uid3], [
+        post.key.id for post in self.posts.query_top_posts(2)])
+    self.assertEqual([uid2], self.boards.get_top_post_uids(1))
+    self.assertNotIn(uid1, self.boards.get_top_post_uids(2))
+
+  def test_votes_and_deletes_update_board(self):
+    uid1, uid2 = self._insert_posts(2)
+    self.posts.query_top_posts(2)
+    self._vote(uid1, -1, 1)
+    self.assertEqual([uid2, uid1], self.boards.get_top_post_uids(2))
+
+    uid3 = self._insert_posts(1)[0]
+    self._vote(uid3, 1, 1)
+    self.assertEqual([uid3, uid2], self.boards.get_top_post_uids(2))
+
+    self.posts.mark_post_deleted('member-1', uid3)
+    self._no_queries()
+    self.assertEqual([uid2, uid1], [
+        post.key.id for post in self.posts.query_top_posts(2)])
+
+  def test_board_gets_invalid_when_too_few_posts_are_left(self):
+    uids = self._insert_posts(5)
+    self._vote(uids[0], 1, 3)
+    self._vote(uids[1], 1, 2)
+    self._vote(uids[2], 1, 1)
+    self.posts.query_top_posts(2)
+    self.assertEqual(uids[:2], self.boards.get_top_post_uids(2))
+
+    # posts drop below floor and leave the board
+    self._vote(uids[2], -1, 2)
+    self.assertEqual(uids[:2], self.boards.get_top_post_uids(2))
+    self._vote(uids[1], -1, 3)
+    self.assertIsNone(self.boards.get_top_post_uids(2))
+
+    self.assertEqual([uids[0], uids[3]], [
+        post.key.id for post in self.posts.query_top_posts(2)])
+    self.assertEqual([uids[0], uids[3]], self.boards.get_top_post_uids(2))
+
+  def test_top_posts_are_picked_after_accept(self):
+    uids = self._insert_posts(4)
+    for index, uid in enumerate(uids):
+      self._vote(uid, 1, 4 - index)
+    accept = lambda post: post.key.id not in uids[:2]
+
+    # board has too few accepted posts; query is used
+    self.assertEqual(uids[2:3], [
+        post.key.id for post in self.posts.query_top_posts(1, accept=accept)])
+    self.assertEqual([uids[1]], [
+        post.key.id for post in self.posts.query_top_posts(
+            1, accept=lambda post: post.key.id != uids[0])])
+
+  def test_only_lease_holder_rebuilds_board(self):
+    uid1, uid2 = self._insert_posts(2)
+    self._vote(uid2, 1, 1)
+    generation = self.boards.lease_rebuild()
+    self.assertIsNotNone(generation)
+    self.assertIsNone(self.boards.lease_rebuild())
+
+    # others query top posts, but leave the board alone
+    self.assertEqual([uid2], [
+        post.key.id for post in self.posts.query_top_posts(1)])
+    self.assertIsNone(self.boards.get_top_post_uids(2))
+
+    # votes after posts were queried are merged in; lease is released
+    scanned_on = datetime.datetime.utcnow()
+    posts = self.posts.query_posts()
+    self._vote(uid1, 1, 2)
+    self.assertTrue(self.boards.rebuild(
+        posts, generation=generation, scanned_on=scanned_on))
+    self.assertEqual([uid1, uid2], self.boards.get_top_post_uids(2))
+    self.assertIsNotNone(self.boards.lease_rebuild())
+
+  def test_rebuild_stops_when_lease_is_taken_over(self):
+    self._insert_posts(2)
+    generation = self.boards.lease_rebuild()
+    lease = self.client.get(self.boards._lease_key())
+    lease['leased_until'] = datetime.datetime.utcnow()
+    self.assertIsNotNone(self.boards.lease_rebuild())
+    self.assertFalse(self.boards.rebuild(
+        self.posts.query_posts(), generation=generation))
+    self.assertIsNone(self.boards.get_top_post_uids(2))
+
+  def test_votes_do_not_write_invalid_board(self):
+    uid = self._insert_posts(1)[0]
+    writes = len(self.client.items)
+    self._vote(uid, 1, 1)
+    self.assertEqual([], [
+        item for action, item in self.client.items[writes:]
+        if action == 'put' and item.key.kind == dao.Leaderboards.TABLE])
+
+  def test_insert_post_survives_board_failure(self):
+    original = dao.Leaderboards.update_post
+    def fail(*unused_args, **unused_kwargs):
+      raise Exception('Leaderboard is not available.')
+    dao.Leaderboards.update_post = fail
+    try:
+      post = self.posts.insert_post('member-1', '{}')
+    finally:
+      dao.Leaderboards.update_post = original
+    self.assertEqual(post.key.id, self.posts.get_post(post.key.id).key.id)
+
+
 if __name__ == '__main__':
   unittest.main()
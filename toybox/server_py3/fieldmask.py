@@ -0,0 +1,173 @@
+"""Field masks selecting parts of API responses the client asked for.
+
+A mask is a comma separated list of field paths; nested fields are either
+separated by "/" or listed in parentheses after their parent, e.g.:
+
+  result(uid,votes_total,data/title),user/uid
+
+Lists are projected item by item and RawJSON values are parsed only if some
+of their fields are selected. Masks are compiled into projector functions
+once and cached by mask string.
+"""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import functools
+import re
+import serialization
+
+
+# masks are sent by clients, so they are limited in size and cache entries
+MAX_MASK_LENGTH = 1024
+MAX_CACHED_MASKS = 256
+
+_TOKEN = re.compile(r'\s*(?:([A-Za-z0-9_]+)|([(),/]))')
+
+
+def _tokenize(text):
+  tokens = []
+  position = 0
+  text = text.rstrip()
+  while position < len(text):
+    match = _TOKEN.match(text, position)
+    if not match:
+      raise ValueError('Unexpected character at position %s.' % position)
+    tokens.append(match.group(1) or match.group(2))
+    position = match.end()
+  return tokens
+
+
+def _merge(tree, name, subtree):
+  """Adds subtree under name; None selects all fields and wins any merge."""
+  if name in tree and (tree[name] is None or subtree is None):
+    tree[name] = None
+  elif name in tree:
+    for child, value in subtree.items():
+      _merge(tree[name], child, value)
+  else:
+    tree[name] = subtree
+
+
+class _Parser(object):
+  """Parses mask tokens into a tree of dicts; None marks whole value."""
+
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.position = 0
+
+  def _peek(self):
+    if self.position < len(self.tokens):
+      return self.tokens[self.position]
+    return None
+
+  def _next(self):
+    token = self._peek()
+    self.position += 1
+    return token
+
+  def _name(self):
+    token = self._next()
+    if token is None or token in '(),/':
+      raise ValueError('Expected field name, found %s.' % (
+          '"%s"' % token if token else 'end of mask'))
+    return token
+
+  def _selection(self, tree):
+    path = [self._name()]
+    while self._peek() == '/':
+      self._next()
+      path.append(self._name())
+    subtree = None
+    if self._peek() == '(':
+      self._next()
+      subtree = self._selections(closing=')')
+    for name in reversed(path[1:]):
+      subtree = {name: subtree}
+    _merge(tree, path[0], subtree)
+
+  def _selections(self, closing=None):
+    tree = {}
+    self._selection(tree)
+    while self._peek() == ',':
+      self._next()
+      self._selection(tree)
+    token = self._next()
+    if token != closing:
+      raise ValueError('Expected %s, found %s.' % (
+          '"%s"' % closing if closing else 'end of mask',
+          '"%s"' % token if token else 'end of mask'))
+    return tree
+
+  def parse(self):
+    return self._selections()
+
+
+def _new_projector(tree):
+  """Returns function keeping only fields of the tree in a value."""
+  if tree is None:
+    return lambda value: value
+
+  projectors = [(name, _new_projector(subtree))
+                for name, subtree in sorted(tree.items())]
+
+  def project(value):
+    if isinstance(value, serialization.RawJSON):
+      value = serialization.loads(value.json)
+    if isinstance(value, list):
+      return [project(item) for item in value]
+    if isinstance(value, dict):
+      return dict([(name, projector(value[name]))
+                   for name, projector in projectors if name in value])
+    return value
+
+  return project
+
+
+class FieldMask(object):
+  """Compiled field mask; see compile_mask()."""
+
+  def __init__(self, tree):
+    self.tree = tree
+    self.project = _new_projector(tree)
+
+  def _subtree(self, path):
+    """Returns (is_selected, subtree) of a field path."""
+    tree = self.tree
+    for name in path:
+      if tree is None:
+        return True, None
+      if name not in tree:
+        return False, {}
+      tree = tree[name]
+    return True, tree
+
+  def selects(self, *path):
+    """Checks if any field at or under path is selected."""
+    return self._subtree(path)[0]
+
+  def subfields(self, *path):
+    """Returns names of fields selected under path; None if all are."""
+    _, tree = self._subtree(path)
+    if tree is None:
+      return None
+    return frozenset(tree.keys())
+
+  def child(self, *path):
+    """Returns mask of the value at path; None if it's selected as a whole."""
+    is_selected, tree = self._subtree(path)
+    if is_selected and tree is None:
+      return None
+    return FieldMask(tree)
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_MASKS)
+def compile_mask(text):
+  """Returns FieldMask for mask text; raises ValueError if it's invalid."""
+  if len(text) > MAX_MASK_LENGTH:
+    raise ValueError('Must be at most %s characters.' % MAX_MASK_LENGTH)
+  tokens = _tokenize(text)
+  if not tokens:
+    raise ValueError('Must select at least one field.')
+  return FieldMask(_Parser(tokens).parse())
@@ -0,0 +1,79 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import unittest
+import fieldmask
+import serialization
+
+
+class FieldMaskTestSuite(unittest.TestCase):
+  """Test cases for field masks."""
+
+  def test_compile(self):
+    mask = fieldmask.compile_mask(
+        'result(uid, votes_total, data/title), user/uid')
+    self.assertEqual({
+        'result': {'uid': None, 'votes_total': None, 'data': {'title': None}},
+        'user': {'uid': None},
+    }, mask.tree)
+    self.assertIs(mask, fieldmask.compile_mask(
+        'result(uid, votes_total, data/title), user/uid'))
+
+    # whole field wins over its parts
+    self.assertEqual(
+        {'a': None}, fieldmask.compile_mask('a/b,a,a(c)').tree)
+    self.assertEqual(
+        {'a': {'b': None, 'c': {'d': None}}},
+        fieldmask.compile_mask('a/b,a/c(d)').tree)
+
+  def test_compile_invalid(self):
+    for text in ['', ' ', 'a(', 'a)', 'a,,b', 'a/', 'a b', 'a(b', 'a.b',
+                 'a' * (fieldmask.MAX_MASK_LENGTH + 1)]:
+      with self.assertRaises(ValueError):
+        fieldmask.compile_mask(text)
+
+  def test_project(self):
+    mask = fieldmask.compile_mask('result(uid,data/title),app')
+    self.assertEqual({
+        'app': {'schema_version': 'V1'},
+        'result': [
+            {'uid': 1, 'data': {'title': 'Hello!'}},
+            {'uid': 2},
+        ],
+    }, mask.project({
+        'app': {'schema_version': 'V1'},
+        'user': {'uid': 'abc123'},
+        'result': [
+            {'uid': 1, 'votes_total': 3, 'data': serialization.RawJSON(
+                '{"title": "Hello!", "text": "World."}')},
+            {'uid': 2, 'votes_total': 1},
+        ],
+    }))
+
+    # whole RawJSON is kept as is, without being parsed
+    data = serialization.RawJSON('{"title": "Hello!"}')
+    self.assertIs(data, fieldmask.compile_mask('data').project(
+        {'data': data})['data'])
+
+  def test_selects(self):
+    mask = fieldmask.compile_mask('result(uid,data),user/uid')
+    self.assertTrue(mask.selects('result'))
+    self.assertTrue(mask.selects('result', 'data', 'title'))
+    self.assertTrue(mask.selects('user', 'uid'))
+    self.assertFalse(mask.selects('user', 'settings'))
+    self.assertFalse(mask.selects('app'))
+
+    self.assertEqual(frozenset(['uid', 'data']), mask.subfields('result'))
+    self.assertIsNone(mask.subfields('result', 'data'))
+    self.assertEqual(frozenset(), mask.subfields('app'))
+
+    self.assertEqual({'uid': None}, mask.child('user').tree)
+    self.assertIsNone(mask.child('result', 'data'))
+    self.assertEqual({}, mask.child('app').project({'a': 1}))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,127 @@
+"""Fingerprints static assets by content hash and rewrites HTML references.
+
+Each local asset referenced from HTML files is copied under a name with the
+hash of its content, i.e. css/main.css to css/main.1a2b3c4d5e6f.css, and the
+references are rewritten to point to the copy; the mapping is saved into a
+manifest, which tells the server which assets it can serve as immutable;
+assets are hashed again on every run, so changed ones get new names.
+
+The tool is run by manage.sh over the assembled static folder, e.g.:
+
+  python3 fingerprint.py --static_dir ~/toybox/manage/app/static
+"""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import assets
+
+
+# HTML files we rewrite references in
+DEFAULT_HTML_NAMES = ['index.html']
+
+# number of hex digits of content hash we put into the name
+HASH_LENGTH = 12
+
+# src and href attributes; full URLs, anchors and queries are not assets
+_REFERENCE = re.compile(
+    r'''(?P<prefix>\s(?:src|href)=)(?P<quote>["'])'''
+    r'''(?P<path>[^"'#?:]+)(?P=quote)''')
+
+
+def fingerprinted_name(name, data, hash_length=HASH_LENGTH):
+  """Returns name with content hash of data before its extension."""
+  root, ext = os.path.splitext(name)
+  return '%s.%s%s' % (
+      root, hashlib.sha256(data).hexdigest()[:hash_length], ext)
+
+
+def load_manifest(static_dir):
+  filename = os.path.join(static_dir, assets.MANIFEST_FILENAME)
+  if not os.path.isfile(filename):
+    return {}
+  with open(filename, 'r') as stream:
+    return json.load(stream)
+
+
+def fingerprint(static_dir, html_names=None):
+  """Fingerprints assets referenced from HTML files; returns the manifest."""
+  manifest = load_manifest(static_dir)
+  names_by_hashed_name = dict([
+      (hashed_name, name) for name, hashed_name in manifest.items()])
+  checked = set()
+
+  def fingerprint_asset(name):
+    # references rewritten by an earlier run point to the asset they hashed
+    hashed_name = name
+    name = names_by_hashed_name.get(name, name)
+    if not os.path.isfile(os.path.join(static_dir, name)):
+      return hashed_name
+    if name in checked:
+      return manifest[name]
+    checked.add(name)
+
+    # the asset may have changed since the earlier run; hash it again
+    with open(os.path.join(static_dir, name), 'rb') as stream:
+      data = stream.read()
+    hashed_name = fingerprinted_name(name, data)
+    if manifest.get(name) != hashed_name:
+      manifest[name] = hashed_name
+      names_by_hashed_name[hashed_name] = name
+      shutil.copyfile(os.path.join(static_dir, name),
+                      os.path.join(static_dir, hashed_name))
+      logging.info('Fingerprinted %s as %s', name, hashed_name)
+    return hashed_name
+
+  def rewrite(match):
+    path = match.group('path')
+    name = os.path.normpath(path.lstrip('/')).replace(os.sep, '/')
+    if (name.startswith('..') or
+        not os.path.isfile(os.path.join(static_dir, name))):
+      return match.group(0)
+    hashed_path = fingerprint_asset(name)
+    if path.startswith('/'):
+      hashed_path = '/' + hashed_path
+    return '%s%s%s%s' % (match.group('prefix'), match.group('quote'),
+                         hashed_path, match.group('quote'))
+
+  for html_name in html_names or DEFAULT_HTML_NAMES:
+    filename = os.path.join(static_dir, html_name)
+    with open(filename, 'r', encoding='utf-8') as stream:
+      html = stream.read()
+    with open(filename, 'w', encoding='utf-8') as stream:
+      stream.write(_REFERENCE.sub(rewrite, html))
+
+  with open(os.path.join(static_dir, assets.MANIFEST_FILENAME), 'w') as stream:
+    json.dump(manifest, stream, indent=2, sort_keys=True)
+  return manifest
+
+
+def _new_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--static_dir', required=True,
+                      help='Folder with static assets to fingerprint.')
+  parser.add_argument(
+      '--html', action='append',
+      help='HTML file to rewrite references in; can be repeated; '
+      'defaults to %s.' % ', '.join(DEFAULT_HTML_NAMES))
+  return parser
+
+
+def main(argv=None):
+  logging.basicConfig(level=logging.INFO)
+  args = _new_parser().parse_args(argv)
+  manifest = fingerprint(args.static_dir, html_names=args.html)
+  logging.info('Fingerprinted %s assets', len(manifest))
+
+
+if __name__ == '__main__':
+  main()
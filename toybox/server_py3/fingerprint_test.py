@@ -0,0 +1,104 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import assets
+import compression
+import fingerprint
+
+
+class FingerprintTestSuite(unittest.TestCase):
+  """Test cases for fingerprinting of static assets."""
+
+  def setUp(self):
+    super(FingerprintTestSuite, self).setUp()
+    self.static_dir = tempfile.mkdtemp()
+    self._write('css/main.css', 'body { color: red; }')
+    self._write('js/bundle.js', 'var a = 1;')
+    self._write('index.html', '\n'.join([
+        '<link rel="stylesheet" href="css/main.css">',
+        '<script src="/js/bundle.js"></script>',
+        '<script src="https://example.com/lib.js"></script>',
+        '<img src="img/missing.png">',
+        '<a href="#posts">Posts</a>',
+    ]))
+
+  def tearDown(self):
+    shutil.rmtree(self.static_dir)
+    super(FingerprintTestSuite, self).tearDown()
+
+  def _write(self, name, text):
+    filename = os.path.join(self.static_dir, name)
+    if not os.path.isdir(os.path.dirname(filename)):
+      os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as stream:
+      stream.write(text)
+
+  def _read(self, name):
+    with open(os.path.join(self.static_dir, name), 'r') as stream:
+      return stream.read()
+
+  def test_fingerprint(self):
+    manifest = fingerprint.fingerprint(self.static_dir)
+    css_name = fingerprint.fingerprinted_name(
+        'css/main.css', b'body { color: red; }')
+    js_name = fingerprint.fingerprinted_name('js/bundle.js', b'var a = 1;')
+    self.assertEqual(
+        {'css/main.css': css_name, 'js/bundle.js': js_name}, manifest)
+    self.assertRegex(css_name, r'^css/main\.[0-9a-f]{12}\.css$')
+    self.assertEqual('body { color: red; }', self._read(css_name))
+    self.assertEqual('\n'.join([
+        '<link rel="stylesheet" href="%s">' % css_name,
+        '<script src="/%s"></script>' % js_name,
+        '<script src="https://example.com/lib.js"></script>',
+        '<img src="img/missing.png">',
+        '<a href="#posts">Posts</a>',
+    ]), self._read('index.html'))
+
+    # running again changes nothing
+    html = self._read('index.html')
+    self.assertEqual(manifest, fingerprint.fingerprint(self.static_dir))
+    self.assertEqual(html, self._read('index.html'))
+    self.assertEqual(manifest, fingerprint.load_manifest(self.static_dir))
+
+  def test_changed_asset_is_fingerprinted_again(self):
+    old_name = fingerprint.fingerprint(self.static_dir)['css/main.css']
+    self._write('css/main.css', 'body { color: blue; }')
+    new_name = fingerprint.fingerprinted_name(
+        'css/main.css', b'body { color: blue; }')
+
+    # html still points to the old copy; it's rewritten to the new one
+    manifest = fingerprint.fingerprint(self.static_dir)
+    self.assertEqual(new_name, manifest['css/main.css'])
+    self.assertEqual(manifest, fingerprint.load_manifest(self.static_dir))
+    self.assertEqual('body { color: blue; }', self._read(new_name))
+    self.assertEqual('body { color: red; }', self._read(old_name))
+    self.assertIn('href="%s"' % new_name, self._read('index.html'))
+    self.assertNotIn(old_name, self._read('index.html'))
+
+    # html with original references gets the new one too
+    self._write('index.html', '<link rel="stylesheet" href="css/main.css">')
+    fingerprint.fingerprint(self.static_dir)
+    self.assertEqual(
+        '<link rel="stylesheet" href="%s">' % new_name,
+        self._read('index.html'))
+
+  def test_fingerprinted_assets_are_immutable(self):
+    fingerprint.fingerprint(self.static_dir)
+    cache = assets.AssetCache(self.static_dir, compression.Compressor())
+    cache.load()
+    css_name = cache.manifest['css/main.css']
+    self.assertTrue(cache.get(css_name).is_fingerprinted)
+    self.assertFalse(cache.get('css/main.css').is_fingerprinted)
+    self.assertFalse(cache.get('index.html').is_fingerprinted)
+    self.assertIsNone(cache.get(assets.MANIFEST_FILENAME))
+
+
+if __name__ == '__main__':
+  unittest.main()
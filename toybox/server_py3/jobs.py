@@ -0,0 +1,807 @@
+"""Maintenance jobs over Datastore tables.
+
+Jobs are run from the command line against the project Datastore, e.g.:
+
+  python3 jobs.py reindex --kind Posts
+  python3 jobs.py archive_votes --older_than_days 28
+  python3 jobs.py rebuild_vote_summaries
+  python3 jobs.py reconcile_votes --report_only
+  python3 jobs.py backfill --kind Posts --transform posts_updated_on
+  python3 jobs.py moderate_posts
+  python3 jobs.py prune_activity
+"""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import argparse
+import collections
+from concurrent import futures
+import datetime
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import container
+import dao
+import moderation
+import ratelimit
+
+
+# number of entities written in one transaction
+BATCH_SIZE = 25
+
+# votes on posts older than this are moved into archive
+ARCHIVE_VOTES_OLDER_THAN_DAYS = 28
+
+# defaults for jobs processing key ranges of a kind in parallel
+SHARD_COUNT = 16
+WORKER_COUNT = 8
+
+# number of pending posts moderated per round
+MODERATE_POSTS_LIMIT = 500
+
+# number of keys sampled per shard to pick shard boundaries
+_KEYS_SAMPLED_PER_SHARD = 32
+
+
+def _batches(items, batch_size):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def _key_order(key):
+  """Returns sortable tuple for a key; ids go before names like in Datastore."""
+  path = []
+  for element in key.path:
+    path.append(element['kind'])
+    if 'id' in element:
+      path.extend([0, element['id'], ''])
+    else:
+      path.extend([1, 0, element.get('name', '')])
+  return tuple(path)
+
+
+def key_range_shards(client, kind, shard_count=SHARD_COUNT):
+  """Splits key space of a kind into up to shard_count contiguous ranges.
+
+  Boundaries are picked from a random sample of keys Datastore returns when
+  ordering by __scatter__ property.
+
+  Returns:
+    A list of (start, end) key pairs; start is inclusive, end is exclusive;
+    None means the range is unbounded on that side.
+  """
+  query = client.query(kind=kind)
+  query.keys_only()
+  query.order = ['__scatter__']
+  sample = sorted(
+      set([entity.key for entity in query.fetch(
+          limit=shard_count * _KEYS_SAMPLED_PER_SHARD)]), key=_key_order)
+  boundaries = []
+  for index in range(1, shard_count):
+    boundary = sample[index * len(sample) // shard_count] if sample else None
+    if boundary is not None and boundary not in boundaries:
+      boundaries.append(boundary)
+  starts = [None] + boundaries
+  ends = boundaries + [None]
+  return list(zip(starts, ends))
+
+
+def query_key_range(client, kind, start, end):
+  """Returns query for all entities of a kind in a key range."""
+  query = client.query(kind=kind)
+  if start is not None:
+    query.add_filter('__key__', '>=', start)
+  if end is not None:
+    query.add_filter('__key__', '<', end)
+  query.order = ['__key__']
+  return query
+
+
+def _key_to_json(key):
+  if key is None:
+    return None
+  return list(key.flat_path)
+
+
+def _key_from_json(client, value):
+  if value is None:
+    return None
+  return client.key(*value)
+
+
+def _post_key(client, post_uid):
+  post_uid = str(post_uid)
+  if post_uid.isdigit():
+    post_uid = int(post_uid)
+  return client.key(dao.Posts.TABLE, post_uid)
+
+
+def reindex(client, table, batch_size=BATCH_SIZE):
+  """Rewrites entities so their indexes match table.SCHEMA.
+
+  Entities written before a property was excluded from indexes keep their
+  index entries until the entity is written again; this job rewrites all such
+  entities; entities that already match the schema are not written.
+
+  Returns:
+    A tuple of (number of entities seen, number of entities rewritten).
+  """
+  schema = table.SCHEMA
+  seen = 0
+  rewritten = 0
+  query = client.query(kind=schema.kind)
+  for batch in _batches(query.fetch(), batch_size):
+    seen += len(batch)
+    keys = [entity.key for entity in batch if schema.needs_reindex(entity)]
+    if not keys:
+      continue
+
+    # reload and write in transaction so we don't override concurrent updates
+    with client.transaction():
+      entities = [entity for entity in client.get_multi(keys) if entity]
+      client.put_multi([schema.apply_to(entity) for entity in entities])
+    rewritten += len(entities)
+    logging.info('Reindexed %s of %s %s', rewritten, seen, schema.kind)
+  return seen, rewritten
+
+
+def archive_votes(client, older_than_days=ARCHIVE_VOTES_OLDER_THAN_DAYS):
+  """Moves votes of posts older than older_than_days into VoteArchives.
+
+  Returns:
+    A tuple of (number of posts archived, number of votes archived).
+  """
+  archives = dao.VoteArchives(client=client)
+  cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+      days=older_than_days)
+  posts = 0
+  votes = 0
+  for post_uid in dao.Posts(client=client).iter_post_uids_created_before(
+      cutoff):
+    archived = archives.archive_post_votes(post_uid)
+    if archived:
+      posts += 1
+      votes += archived
+      logging.info('Archived %s votes of post %s', archived, post_uid)
+  return posts, votes
+
+
+def _query_votes(client, member_uids):
+  """Yields hot votes of all members or of the members specified."""
+  if not member_uids:
+    for item in client.query(kind=dao.Votes.TABLE).fetch():
+      yield dao._Vote(item)  # pylint: disable=protected-access
+    return
+  for member_uid in member_uids:
+    query = client.query(kind=dao.Votes.TABLE)
+    query.add_filter('member_uid', '=', str(member_uid))
+    for item in query.fetch():
+      yield dao._Vote(item)  # pylint: disable=protected-access
+
+
+def rebuild_vote_summaries(client, member_uids=None):
+  """Regenerates VoteSummaries of all or specified members from their votes.
+
+  Summaries are built from VoteArchives and Votes; votes cast while the job
+  is running are applied again in a final catch-up pass; VoteBlooms are
+  rebuilt from the same votes, which resizes filters to keep false positive
+  rate low; run this job periodically.
+
+  Returns:
+    A number of members which summaries were rebuilt.
+  """
+  started_on = dao.timezone_aware_now()
+  summaries = dao.VoteSummaries(client=client)
+  blooms = dao.VoteBlooms(client=client)
+  archives = dao.VoteArchives(client=client)
+  values = collections.defaultdict(dict)
+
+  # members without votes get empty summaries
+  if member_uids:
+    for member_uid in member_uids:
+      values[str(member_uid)] = {}
+  else:
+    for item in client.query(kind=dao.Members.TABLE).fetch():
+      values[item.key.name] = {}
+
+  # archived votes go first as votes from Votes table take precedence
+  for item in client.query(kind=dao.VoteArchives.TABLE).fetch():
+    for member_uid, value in dao.unpack(item['data']).items():
+      if member_uid in values:
+        values[member_uid][item.key.name] = value
+  for vote in _query_votes(client, member_uids):
+    if vote.member_uid in values:
+      values[vote.member_uid][vote.post_uid] = vote.value
+
+  for index, (member_uid, member_values) in enumerate(values.items()):
+    # cancelled votes stay in the filter, so their value 0 is still read
+    with client.transaction():
+      summaries.replace(member_uid, member_values)
+      blooms.replace(member_uid, list(member_values.keys()))
+    if index % 100 == 0:
+      logging.info('Rebuilt %s of %s vote summaries', index + 1, len(values))
+
+  # catch-up votes cast after we started
+  for vote in _query_votes(client, member_uids):
+    if vote.member_uid not in values:
+      continue
+    if dao.to_utc(vote.updated_on) >= started_on:
+      with client.transaction():
+        obj = client.get(vote.key)
+        if obj:
+          value = obj['value']
+        else:
+          # archived after we read it; archive has no cancelled votes
+          value = archives.get_archived_votes([vote.post_uid]).get(
+              vote.post_uid, {}).get(vote.member_uid, 0)
+        summaries.set_vote(vote.member_uid, vote.post_uid, value)
+        blooms.add_post(vote.member_uid, vote.post_uid, summaries)
+
+  return len(values)
+
+
+class _Checkpoint(object):
+  """Progress of a sharded job kept in a local JSON file to resume later."""
+
+  def __init__(self, filename=None):
+    self.filename = filename
+    self.state = {}
+    if filename and os.path.exists(filename):
+      with open(filename, 'r') as stream:
+        self.state = json.load(stream)
+      logging.info('Resuming from checkpoint %s', filename)
+
+  def get(self, name, default=None):
+    return self.state.get(name, default)
+
+  def set(self, name, value):
+    self.state[name] = value
+    if self.filename:
+      with open(self.filename + '.tmp', 'w') as stream:
+        json.dump(self.state, stream)
+      os.replace(self.filename + '.tmp', self.filename)
+
+
+def _sum_votes(votes, archived):
+  """Returns dict of post_uid to [votes_up, votes_down] for given votes.
+
+  Archived vote of the same member and post is superseded by the hot one; we
+  add a negative count for such archived votes to avoid counting both.
+  """
+  counts = collections.defaultdict(lambda: [0, 0])
+  for vote in votes:
+    for value, sign in [
+        (vote.value, 1),
+        (archived.get(vote.post_uid, {}).get(vote.member_uid), -1)]:
+      if value == 1:
+        counts[vote.post_uid][0] += sign
+      elif value == -1:
+        counts[vote.post_uid][1] += sign
+  return counts
+
+
+def reconcile_votes(client, report_only=False, shard_count=SHARD_COUNT,
+                    worker_count=WORKER_COUNT, batch_size=BATCH_SIZE,
+                    checkpoint_filename=None):
+  """Recomputes vote counters of all posts and repairs the ones that drifted.
+
+  Votes table is split into key ranges, which are summed up in parallel; sums
+  of finished shards are saved into the checkpoint file, so the job can be
+  resumed; archived votes are added to the sums; posts are then compared to
+  the sums and repaired in batched transactions; posts that got new votes or
+  were archived while the job was running are not repaired, run the job again
+  for them.
+
+  Returns:
+    A list of dicts, one per post with counters that drifted.
+  """
+  checkpoint = _Checkpoint(checkpoint_filename)
+  started_on = checkpoint.get('started_on')
+  if started_on:
+    started_on = dao.to_utc(dao.str_to_datetime(started_on))
+  else:
+    started_on = dao.timezone_aware_now()
+    checkpoint.set('started_on', started_on.strftime(
+        dao.ISO_8601_DATETIME_FORMAT))
+
+  # archived votes; their versions are kept with the first snapshot, so a
+  # resumed job can tell which archives changed under the saved shard sums
+  archived = {}
+  archive_versions = {}
+  for item in client.query(kind=dao.VoteArchives.TABLE).fetch():
+    archived[item.key.name] = dao.unpack(item['data'])
+    archive_versions[item.key.name] = item.get('version')
+  if checkpoint.get('archive_versions') is None:
+    checkpoint.set('archive_versions', archive_versions)
+  archive_versions = checkpoint.get('archive_versions')
+
+  # split Votes key space; boundaries must not change when we resume
+  shards = checkpoint.get('shards')
+  if shards is None:
+    shards = [
+        [_key_to_json(start), _key_to_json(end)]
+        for start, end in key_range_shards(
+            client, dao.Votes.TABLE, shard_count=shard_count)]
+    checkpoint.set('shards', shards)
+  done = checkpoint.get('done', {})
+
+  # map: sum votes in each shard in parallel
+  def map_shard(index):
+    start, end = shards[index]
+    query = query_key_range(client, dao.Votes.TABLE,
+                            _key_from_json(client, start),
+                            _key_from_json(client, end))
+    votes = [dao._Vote(item)  # pylint: disable=protected-access
+             for item in query.fetch()]
+    return index, _sum_votes(votes, archived)
+
+  pending = [index for index in range(len(shards)) if str(index) not in done]
+  with futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+    for index, counts in executor.map(map_shard, pending):
+      done[str(index)] = counts
+      checkpoint.set('done', done)
+      logging.info('Summed votes in shard %s of %s', len(done), len(shards))
+
+  # reduce: add up all shards and archives
+  totals = collections.defaultdict(lambda: [0, 0])
+  for post_uid, votes in archived.items():
+    for value in votes.values():
+      if value == 1:
+        totals[post_uid][0] += 1
+      elif value == -1:
+        totals[post_uid][1] += 1
+  for counts in done.values():
+    for post_uid, (up, down) in counts.items():
+      totals[post_uid][0] += up
+      totals[post_uid][1] += down
+
+  # diff with counters stored in posts
+  drifted = []
+  for item in client.query(kind=dao.Posts.TABLE).fetch():
+    post = dao._Post(item)  # pylint: disable=protected-access
+    up, down = totals.get(str(post.key.id_or_name), [0, 0])
+    if (post.votes_up, post.votes_down, post.votes_total) != (
+        up, down, up - down):
+      drifted.append({
+          'post_uid': post.key.id_or_name,
+          'stored': [post.votes_up, post.votes_down, post.votes_total],
+          'actual': [up, down, up - down],
+          'repaired': False,
+      })
+  for item in drifted:
+    logging.info('Post %s counters are %s, should be %s',
+                 item['post_uid'], item['stored'], item['actual'])
+  if report_only:
+    return drifted
+
+  # repair in batches; skip posts updated since we started and posts whose
+  # archive changed since we read it, their sums may count votes twice
+  boards = dao.Leaderboards(client=client)
+  posts_table = dao.Posts(client=client)
+  for batch in _batches(drifted, batch_size):
+    by_key = dict([(_post_key(client, item['post_uid']), item)
+                   for item in batch])
+    archive_keys = [client.key(dao.VoteArchives.TABLE, str(item['post_uid']))
+                    for item in batch]
+    with client.transaction():
+      utcnow = datetime.datetime.utcnow()
+      versions = dict([(obj.key.name, obj.get('version'))
+                       for obj in client.get_multi(archive_keys)])
+      repaired = []
+      updates = []
+      for obj in client.get_multi(list(by_key.keys())):
+        post = dao._Post(obj)  # pylint: disable=protected-access
+        if dao.to_utc(post.updated_on) >= started_on:
+          continue
+        post_uid = str(post.key.id_or_name)
+        if versions.get(post_uid) != archive_versions.get(post_uid):
+          continue
+        item = by_key[obj.key]
+        post.votes_up, post.votes_down, post.votes_total = item['actual']
+        post.updated_on = utcnow
+        post.version += 1
+        repaired.append(posts_table.SCHEMA.apply_to(obj))
+        updates.append(
+            (post.key.id_or_name, post.votes_total, post.is_deleted))
+        item['repaired'] = True
+      client.put_multi(repaired)
+      boards.update_posts(updates)
+    boards.invalidate()
+    logging.info('Repaired %s of %s posts', len(repaired), len(batch))
+  return drifted
+
+
+def moderate_posts(client, dlp, limit=MODERATE_POSTS_LIMIT):
+  """Inspects all posts pending moderation with DLP, round by round.
+
+  Returns:
+    A tuple of (number of posts inspected, number of posts flagged).
+  """
+  moderator = moderation.Moderator(dlp, posts=dao.Posts(client=client))
+  inspected = 0
+  flagged = 0
+  while True:
+    count, found = moderator.moderate_pending(limit)
+    inspected += count
+    flagged += found
+    if count < limit:
+      return inspected, flagged
+
+
+def prune_activity(client, now=None):
+  """Deletes minute and hour activity buckets older than MAX_BUCKETS.
+
+  Returns:
+    A number of entities deleted.
+  """
+  counters = dao.ActivityCounters(client=client)
+  now = now or datetime.datetime.utcnow()
+  deleted = 0
+  for granularity in ['minute', 'hour']:
+    step = counters.GRANULARITIES[granularity]
+    before = counters.bucket_start(
+        now, granularity) - step * (counters.MAX_BUCKETS - 1)
+    for series in sorted(counters.SERIES):
+      count = counters.delete_buckets_before(series, granularity, before)
+      if count:
+        logging.info('Deleted %s %s buckets of %s activity',
+                     count, granularity, series)
+      deleted += count
+  return deleted
+
+
+class _Throttle(object):
+  """Limits number of entities written per second across all workers."""
+
+  def __init__(self, per_second, batch_size, clock=time.monotonic,
+               sleep=time.sleep):
+    self._bucket = ratelimit.TokenBucket(ratelimit.Limit(
+        burst=max(per_second, batch_size), per_second=per_second))
+    self._clock = clock
+    self._sleep = sleep
+    self._lock = threading.Lock()
+
+  def wait(self, cost):
+    while True:
+      with self._lock:
+        retry_after = self._bucket.consume(self._clock(), cost=cost)
+      if not retry_after:
+        return
+      self._sleep(retry_after)
+
+
+class BackfillProgress(object):
+  """Counters of a running backfill; safe to update from many workers."""
+
+  def __init__(self, shards):
+    self.shards = shards
+    self.shards_done = 0
+    self.seen = 0
+    self.written = 0
+    self._lock = threading.Lock()
+
+  def add(self, seen, written):
+    with self._lock:
+      self.seen += seen
+      self.written += written
+
+  def shard_done(self):
+    with self._lock:
+      self.shards_done += 1
+
+  def to_dict(self):
+    with self._lock:
+      return {
+          'shards': self.shards,
+          'shards_done': self.shards_done,
+          'seen': self.seen,
+          'written': self.written,
+      }
+
+
+def _is_backfilled(entity, name):
+  return bool(name) and name in entity.get(dao.Schema.BACKFILLS, [])
+
+
+def backfill(client, kind, transform, name=None, shard_count=SHARD_COUNT,
+             worker_count=WORKER_COUNT, batch_size=BATCH_SIZE,
+             max_per_second=None, checkpoint_filename=None, progress=None,
+             clock=time.monotonic, sleep=time.sleep):
+  """Applies transform to all entities of a kind, key range shards in parallel.
+
+  The transform gets an entity, updates it in place and returns True if the
+  entity needs to be written; it is called inside a transaction on a freshly
+  read entity, so it must not do its own Datastore writes. If a name is given,
+  it is recorded in each entity processed and entities that already have it
+  are skipped; without a name the transform itself must detect entities that
+  are already done. Entities are written with put_multi() in batches, no more
+  than max_per_second entities per second across all workers. Shard
+  boundaries and the last key processed in each shard are kept in the
+  checkpoint file, so the job can be resumed; the last batch processed before
+  interruption can be seen again when resumed.
+
+  Returns:
+    A dict with counts of shards, entities seen and entities written.
+  """
+  table = dao.ALL_TABLES.get(kind)
+  checkpoint = _Checkpoint(checkpoint_filename)
+  checkpoint_lock = threading.Lock()
+  throttle = None
+  if max_per_second:
+    throttle = _Throttle(max_per_second, batch_size, clock=clock, sleep=sleep)
+
+  shards = checkpoint.get('shards')
+  if shards is None:
+    shards = [
+        [_key_to_json(start), _key_to_json(end)]
+        for start, end in key_range_shards(
+            client, kind, shard_count=shard_count)]
+    checkpoint.set('shards', shards)
+  cursors = checkpoint.get('cursors', {})
+  done = checkpoint.get('done', [])
+  counters = BackfillProgress(len(shards))
+
+  def save(index, cursor=None, is_done=False):
+    with checkpoint_lock:
+      if is_done:
+        done.append(index)
+        cursors.pop(str(index), None)
+        checkpoint.set('done', done)
+      else:
+        cursors[str(index)] = cursor
+      checkpoint.set('cursors', cursors)
+
+  def update(entities):
+    updated = []
+    for entity in entities:
+      if not entity or _is_backfilled(entity, name):
+        continue
+      changed = transform(entity)
+      if name:
+        entity[dao.Schema.BACKFILLS] = list(
+            entity.get(dao.Schema.BACKFILLS, [])) + [name]
+        changed = True
+      if not changed:
+        continue
+      if table:
+        table.SCHEMA.apply_to(entity)
+      updated.append(entity)
+    return updated
+
+  def run_shard(index):
+    start, end = shards[index]
+    query = query_key_range(
+        client, kind, _key_from_json(client, cursors.get(str(index), start)),
+        _key_from_json(client, end))
+    for batch in _batches(query.fetch(), batch_size):
+      keys = [entity.key for entity in batch
+              if not _is_backfilled(entity, name)]
+      written = 0
+      if keys:
+        if throttle:
+          throttle.wait(len(keys))
+        # reload and write in transaction so we don't override other updates
+        with client.transaction():
+          updated = update(client.get_multi(keys))
+          if updated:
+            client.put_multi(updated)
+        written = len(updated)
+      counters.add(len(batch), written)
+      save(index, cursor=_key_to_json(batch[-1].key))
+      if progress:
+        progress(counters.to_dict())
+    save(index, is_done=True)
+    counters.shard_done()
+    logging.info('Backfilled %s: %s', kind, counters.to_dict())
+
+  pending = [index for index in range(len(shards)) if index not in done]
+  with futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+    for _ in executor.map(run_shard, pending):
+      pass
+  return counters.to_dict()
+
+
+def _backfill_posts_updated_on(entity):
+  """Sets updated_on of posts created before we started to track it."""
+  if entity.get('updated_on'):
+    return False
+  entity['updated_on'] = entity['created_on']
+  return True
+
+
+def _backfill_posts_moderation(entity):
+  """Queues for moderation posts created before we started to moderate."""
+  if entity.get('moderation'):
+    return False
+  entity['moderation'] = dao.MODERATION_PENDING
+  return True
+
+
+def _backfill_members_slug(entity):
+  """Gives a slug to members created before slugs were introduced."""
+  if entity.get('slug'):
+    return False
+  entity['slug'] = str(uuid.uuid4())
+  return True
+
+
+# transforms that can be run by name from command line; any other function
+# can be given as "module:function"
+BACKFILL_TRANSFORMS = {
+    'members_slug': (dao.Members.TABLE, _backfill_members_slug),
+    'posts_moderation': (dao.Posts.TABLE, _backfill_posts_moderation),
+    'posts_updated_on': (dao.Posts.TABLE, _backfill_posts_updated_on),
+}
+
+
+def _load_transform(kind, name):
+  if name in BACKFILL_TRANSFORMS:
+    transform_kind, transform = BACKFILL_TRANSFORMS[name]
+    if transform_kind != kind:
+      raise ValueError('Transform %s only applies to %s, not to %s.' % (
+          name, transform_kind, kind))
+    return transform
+  if ':' not in name:
+    raise ValueError('Unknown transform: %s.' % name)
+  module_name, function_name = name.split(':', 1)
+  return getattr(importlib.import_module(module_name), function_name)
+
+
+def _reindex_command(args):
+  client = container.Registry.current().datastore_client
+  for kind in args.kind:
+    seen, rewritten = reindex(client, dao.ALL_TABLES[kind],
+                              batch_size=args.batch_size)
+    logging.info('Done reindexing %s: %s seen, %s rewritten',
+                 kind, seen, rewritten)
+
+
+def _archive_votes_command(args):
+  client = container.Registry.current().datastore_client
+  posts, votes = archive_votes(client, older_than_days=args.older_than_days)
+  logging.info('Done archiving: %s votes of %s posts', votes, posts)
+
+
+def _rebuild_vote_summaries_command(args):
+  client = container.Registry.current().datastore_client
+  count = rebuild_vote_summaries(client, member_uids=args.member_uid)
+  logging.info('Done rebuilding vote summaries of %s members', count)
+
+
+def _reconcile_votes_command(args):
+  client = container.Registry.current().datastore_client
+  drifted = reconcile_votes(
+      client, report_only=args.report_only, shard_count=args.shard_count,
+      worker_count=args.worker_count, batch_size=args.batch_size,
+      checkpoint_filename=args.checkpoint)
+  logging.info('Done reconciling votes: %s posts drifted, %s repaired',
+               len(drifted), len([item for item in drifted
+                                  if item['repaired']]))
+
+
+def _backfill_command(args):
+  client = container.Registry.current().datastore_client
+  counters = backfill(
+      client, args.kind, _load_transform(args.kind, args.transform),
+      name=None if args.no_marker else args.transform,
+      shard_count=args.shard_count, worker_count=args.worker_count,
+      batch_size=args.batch_size, max_per_second=args.max_per_second,
+      checkpoint_filename=args.checkpoint)
+  logging.info('Done backfilling %s with %s: %s seen, %s written',
+               args.kind, args.transform, counters['seen'],
+               counters['written'])
+
+
+def _moderate_posts_command(args):
+  # services module needs Google API client, which other jobs do not need
+  import google.auth  # pylint: disable=g-import-not-at-top
+  import services  # pylint: disable=g-import-not-at-top
+  client = container.Registry.current().datastore_client
+  credentials, _ = google.auth.default(
+      scopes=[services.DataLossPreventionService.SCOPE])
+  inspected, flagged = moderate_posts(
+      client, services.DataLossPreventionService(credentials),
+      limit=args.limit)
+  logging.info('Done moderating: %s posts inspected, %s flagged',
+               inspected, flagged)
+
+
+def _prune_activity_command(unused_args):
+  client = container.Registry.current().datastore_client
+  deleted = prune_activity(client)
+  logging.info('Done pruning activity: %s counters deleted', deleted)
+
+
+def _new_parser():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+
+  command = commands.add_parser(
+      'reindex', help='Rewrite entities to drop unused index entries.')
+  command.add_argument(
+      '--kind', action='append', choices=sorted(dao.ALL_TABLES.keys()),
+      required=True, help='Datastore kind to reindex; can be repeated.')
+  command.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+  command.set_defaults(handler=_reindex_command)
+
+  command = commands.add_parser(
+      'archive_votes', help='Move votes on old posts into archive blobs.')
+  command.add_argument('--older_than_days', type=int,
+                       default=ARCHIVE_VOTES_OLDER_THAN_DAYS)
+  command.set_defaults(handler=_archive_votes_command)
+
+  command = commands.add_parser(
+      'rebuild_vote_summaries',
+      help='Regenerate member vote summaries and filters from their votes.')
+  command.add_argument(
+      '--member_uid', action='append',
+      help='Member to rebuild; can be repeated; all members by default.')
+  command.set_defaults(handler=_rebuild_vote_summaries_command)
+
+  command = commands.add_parser(
+      'reconcile_votes',
+      help='Recount votes of all posts and repair counters that drifted.')
+  command.add_argument('--report_only', action='store_true',
+                       help='Only report drifted counters; do not repair.')
+  command.add_argument('--checkpoint',
+                       help='Local file to save progress into and resume from.')
+  command.add_argument('--shard_count', type=int, default=SHARD_COUNT)
+  command.add_argument('--worker_count', type=int, default=WORKER_COUNT)
+  command.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+  command.set_defaults(handler=_reconcile_votes_command)
+
+  command = commands.add_parser(
+      'backfill', help='Apply a transform to all entities of a kind.')
+  command.add_argument('--kind', required=True,
+                       choices=sorted(dao.ALL_TABLES.keys()))
+  command.add_argument(
+      '--transform', required=True,
+      help='One of %s or "module:function".' % ', '.join(
+          sorted(BACKFILL_TRANSFORMS.keys())))
+  command.add_argument(
+      '--no_marker', action='store_true',
+      help='Do not record transform name in entities; the transform must '
+      'skip entities that are already done.')
+  command.add_argument('--max_per_second', type=int,
+                       help='Maximum number of entities written per second.')
+  command.add_argument('--checkpoint',
+                       help='Local file to save progress into and resume from.')
+  command.add_argument('--shard_count', type=int, default=SHARD_COUNT)
+  command.add_argument('--worker_count', type=int, default=WORKER_COUNT)
+  command.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+  command.set_defaults(handler=_backfill_command)
+
+  command = commands.add_parser(
+      'moderate_posts', help='Inspect posts pending moderation with DLP.')
+  command.add_argument('--limit', type=int, default=MODERATE_POSTS_LIMIT,
+                       help='Number of pending posts moderated per round.')
+  command.set_defaults(handler=_moderate_posts_command)
+
+  command = commands.add_parser(
+      'prune_activity', help='Delete old minute and hour activity buckets.')
+  command.set_defaults(handler=_prune_activity_command)
+
+  return parser
+
+
+def main(argv=None):
+  logging.basicConfig(level=logging.INFO)
+  args = _new_parser().parse_args(argv)
+  args.handler(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,449 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from google.cloud import datastore
+import dao
+import dao_test
+import jobs
+import moderation_test
+
+
+class ReindexTestSuite(dao_test.BaseTestSuite):
+  """Test cases for reindex job."""
+
+  def _put_old_post(self, uid):
+    post = datastore.Entity(self.client.key(dao.Posts.TABLE, uid))
+    post.update({
+        'member_uid': 'member-1',
+        'data': '{}',
+        'votes_up': 0,
+        'votes_down': 0,
+        'votes_total': 0,
+        'is_deleted': False,
+        'version': 1,
+    })
+    self.client.put(post)
+    return post
+
+  def test_reindex(self):
+    for uid in range(1, 6):
+      self._put_old_post('old-%s' % uid)
+    dao.Members().get_or_create_member('member-1')
+    dao.Posts().insert_post('member-1', '{}')
+
+    seen, rewritten = jobs.reindex(self.client, dao.Posts, batch_size=2)
+    self.assertEqual((6, 5), (seen, rewritten))
+    for post in self.client.query(kind=dao.Posts.TABLE).fetch():
+      self.assertFalse(dao.Posts.SCHEMA.needs_reindex(post))
+
+    self.assertEqual((6, 0), jobs.reindex(self.client, dao.Posts))
+
+  def test_command_line(self):
+    self._put_old_post('old-1')
+    jobs.main(['reindex', '--kind', 'Posts', '--kind', 'Votes'])
+    self.assertFalse(dao.Posts.SCHEMA.needs_reindex(
+        self.client.get(self.client.key(dao.Posts.TABLE, 'old-1'))))
+
+
+class ArchiveVotesTestSuite(dao_test.BaseTestSuite):
+  """Test cases for archive_votes job."""
+
+  def test_archive_votes(self):
+    members = dao.Members()
+    posts = dao.Posts()
+    votes = dao.Votes()
+    members.get_or_create_member('member-1')
+    old = posts.insert_post('member-1', '{}')
+    new = posts.insert_post('member-1', '{}')
+    votes.insert_vote('member-1', old.key.id, 1)
+    votes.insert_vote('member-1', new.key.id, 1)
+    old_ = self.client.get(old.key)
+    old_['created_on'] -= datetime.timedelta(days=30)
+
+    self.assertEqual((1, 1), jobs.archive_votes(self.client))
+    self.assertEqual(
+        [str(new.key.id)], [vote.post_uid for vote in votes.query_votes()])
+    self.assertTrue(posts.get_post(old.key.id).votes_archived)
+    self.assertFalse(posts.get_post(new.key.id).votes_archived)
+
+    self.assertEqual((0, 0), jobs.archive_votes(self.client))
+
+
+class RebuildVoteSummariesTestSuite(dao_test.BaseTestSuite):
+  """Test cases for rebuild_vote_summaries job."""
+
+  def test_rebuild_vote_summaries(self):
+    members = dao.Members()
+    posts = dao.Posts()
+    votes = dao.Votes()
+    summaries = dao.VoteSummaries()
+    members.get_or_create_member('member-1')
+    members.get_or_create_member('member-2')
+    post1 = posts.insert_post('member-1', '{}')
+    post2 = posts.insert_post('member-1', '{}')
+    votes.insert_vote('member-1', post1.key.id, 1)
+    votes.insert_vote('member-2', post1.key.id, -1)
+    dao.VoteArchives().archive_post_votes(post1.key.id)
+    votes.insert_vote('member-1', post2.key.id, -1)
+
+    # drop all summaries
+    for key in list(self.client.entities.keys()):
+      if key.kind == dao.VoteSummaries.TABLE:
+        self.client.delete(key)
+    post_uids = [post1.key.id, post2.key.id]
+    self.assertIsNone(summaries.get_vote_values('member-1', post_uids))
+
+    self.assertEqual(2, jobs.rebuild_vote_summaries(self.client))
+    self.assertEqual(
+        {str(post1.key.id): 1, str(post2.key.id): -1},
+        summaries.get_vote_values('member-1', post_uids))
+    self.assertEqual(
+        {str(post1.key.id): -1},
+        summaries.get_vote_values('member-2', post_uids))
+
+    self.assertEqual(1, jobs.rebuild_vote_summaries(
+        self.client, member_uids=['member-2']))
+
+  def test_rebuild_vote_summaries_keeps_cancelled_votes(self):
+    posts = dao.Posts()
+    votes = dao.Votes()
+    dao.Members().get_or_create_member('member-1')
+    post = posts.insert_post('member-1', '{}')
+    votes.insert_vote('member-1', post.key.id, 1)
+    votes.insert_vote('member-1', post.key.id, 1)
+    self.assertEqual(0, votes.query_votes()[0].value)
+
+    self.assertEqual(1, jobs.rebuild_vote_summaries(self.client))
+    self.assertEqual(0, dao.posts_query_to_list(
+        'member-1', [posts.get_post(post.key.id)])[0]['my_vote_value'])
+
+  def test_rebuild_vote_summaries_catches_up_archived_vote(self):
+    posts = dao.Posts()
+    votes = dao.Votes()
+    dao.Members().get_or_create_member('member-1')
+    post = posts.insert_post('member-1', '{}')
+    votes.insert_vote('member-1', post.key.id, -1)
+
+    # vote cast while job is running, then archived before catch-up
+    stale = datastore.Entity(votes.query_votes()[0].key)
+    stale.update(self.client.get(stale.key))
+    stale['updated_on'] += datetime.timedelta(days=1)
+    dao.VoteArchives().archive_post_votes(post.key.id)
+    self.assertFalse(votes.query_votes())
+
+    original = jobs._query_votes
+    def query_votes(client, member_uids):
+      for vote in original(client, member_uids):
+        yield vote
+      yield dao._Vote(stale)  # pylint: disable=protected-access
+    jobs._query_votes = query_votes
+    try:
+      self.assertEqual(1, jobs.rebuild_vote_summaries(self.client))
+    finally:
+      jobs._query_votes = original
+    self.assertEqual({str(post.key.id): -1}, dao.VoteSummaries(
+        ).get_vote_values('member-1', [post.key.id]))
+
+
+class ReconcileVotesTestSuite(dao_test.BaseTestSuite):
+  """Test cases for reconcile_votes job."""
+
+  def setUp(self):
+    super(ReconcileVotesTestSuite, self).setUp()
+    self.posts = dao.Posts()
+    self.votes = dao.Votes()
+    dao.Members().get_or_create_member('member-1')
+    self.post_uids = []
+    for _ in range(4):
+      post = self.posts.insert_post('member-1', '{}')
+      self.post_uids.append(post.key.id)
+      for index in range(3):
+        self.votes.insert_vote('member-%s' % index, post.key.id, 1)
+    self.votes.insert_vote('member-0', self.post_uids[1], -1)
+    dao.VoteArchives().archive_post_votes(self.post_uids[0])
+    self.votes.insert_vote('member-1', self.post_uids[0], -1)
+
+  def _corrupt(self, post_uid):
+    post = self.client.get(self.client.key(dao.Posts.TABLE, post_uid))
+    post['votes_up'] += 5
+    post['votes_total'] += 5
+
+  def _counters(self, post_uid):
+    post = self.posts.get_post(post_uid)
+    return [post.votes_up, post.votes_down, post.votes_total]
+
+  def test_key_range_shards(self):
+    shards = jobs.key_range_shards(self.client, dao.Votes.TABLE, 3)
+    self.assertEqual(3, len(shards))
+    self.assertIsNone(shards[0][0])
+    self.assertIsNone(shards[-1][1])
+    keys = []
+    for start, end in shards:
+      keys.extend([item.key for item in jobs.query_key_range(
+          self.client, dao.Votes.TABLE, start, end).fetch()])
+    self.assertEqual(10, len(keys))
+    self.assertEqual(10, len(set(keys)))
+
+  def test_no_drift(self):
+    self.assertEqual([], jobs.reconcile_votes(self.client, shard_count=3))
+
+  def test_report_and_repair(self):
+    self._corrupt(self.post_uids[0])
+    self._corrupt(self.post_uids[1])
+
+    drifted = jobs.reconcile_votes(
+        self.client, report_only=True, shard_count=3)
+    self.assertEqual(
+        [(self.post_uids[0], [7, 1, 6], [2, 1, 1], False),
+         (self.post_uids[1], [7, 1, 6], [2, 1, 1], False)],
+        [(item['post_uid'], item['stored'], item['actual'], item['repaired'])
+         for item in drifted])
+    self.assertEqual([7, 1, 6], self._counters(self.post_uids[0]))
+
+    drifted = jobs.reconcile_votes(self.client, shard_count=3, batch_size=1)
+    self.assertEqual([True, True], [item['repaired'] for item in drifted])
+    self.assertEqual([2, 1, 1], self._counters(self.post_uids[0]))
+    self.assertEqual([2, 1, 1], self._counters(self.post_uids[1]))
+    self.assertEqual([], jobs.reconcile_votes(self.client))
+
+  def test_repair_updates_board_and_change_time(self):
+    old_shards = dao.Leaderboards.SHARDS
+    dao.Leaderboards.SHARDS = 1
+    try:
+      self.posts.query_top_posts(2)
+      updated_on = self.posts.get_post(self.post_uids[0]).updated_on
+      self._corrupt(self.post_uids[0])
+      self._corrupt(self.post_uids[1])
+      jobs.reconcile_votes(self.client, shard_count=3)
+
+      # both posts share a board shard; neither update is lost
+      self.assertEqual(set(self.post_uids[2:]), set(
+          dao.Leaderboards().get_top_post_uids(2)))
+    finally:
+      dao.Leaderboards.SHARDS = old_shards
+    self.assertGreater(
+        self.posts.get_post(self.post_uids[0]).updated_on, updated_on)
+
+  def test_skips_posts_archived_while_running(self):
+    self._corrupt(self.post_uids[2])
+    self._corrupt(self.post_uids[3])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(tmp_dir, 'checkpoint.json')
+      jobs.reconcile_votes(
+          self.client, report_only=True, checkpoint_filename=filename)
+      dao.VoteArchives().archive_post_votes(self.post_uids[2])
+      drifted = jobs.reconcile_votes(
+          self.client, checkpoint_filename=filename)
+    finally:
+      shutil.rmtree(tmp_dir)
+    self.assertEqual(
+        [(self.post_uids[2], False), (self.post_uids[3], True)],
+        [(item['post_uid'], item['repaired']) for item in drifted])
+    self.assertEqual([8, 0, 8], self._counters(self.post_uids[2]))
+    self.assertEqual([3, 0, 3], self._counters(self.post_uids[3]))
+
+  def test_resume_from_checkpoint(self):
+    self._corrupt(self.post_uids[2])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(tmp_dir, 'checkpoint.json')
+      first = jobs.reconcile_votes(
+          self.client, report_only=True, checkpoint_filename=filename)
+      self.assertTrue(os.path.exists(filename))
+
+      # all shards are done; nothing is read from Votes again
+      original = jobs.query_key_range
+      try:
+        jobs.query_key_range = None
+        jobs.main(['reconcile_votes', '--checkpoint', filename])
+      finally:
+        jobs.query_key_range = original
+      self.assertEqual(1, len(first))
+      self.assertEqual([3, 0, 3], self._counters(self.post_uids[2]))
+    finally:
+      shutil.rmtree(tmp_dir)
+
+
+class ModeratePostsTestSuite(dao_test.BaseTestSuite):
+  """Test cases for moderate_posts job."""
+
+  def test_moderate_posts(self):
+    posts = dao.Posts()
+    dao.Members().get_or_create_member('member-1')
+    for index in range(5):
+      posts.insert_post('member-1', '{"text": "call %s"}' % index)
+    dlp = moderation_test.MockDataLossPreventionService({
+        'call 3': 'PHONE_NUMBER'})
+    self.assertEqual((5, 1), jobs.moderate_posts(self.client, dlp, limit=2))
+    self.assertEqual(3, len(dlp.calls))
+    self.assertEqual(1, len(posts.query_posts(
+        moderation=dao.MODERATION_FLAGGED)))
+    self.assertEqual(4, len(posts.query_posts(
+        moderation=dao.MODERATION_APPROVED)))
+
+  def test_backfill_old_posts(self):
+    post = datastore.Entity(self.client.key(dao.Posts.TABLE, 'old-1'))
+    post.update({'member_uid': 'member-1', 'data': '{}', 'version': 1})
+    self.client.put(post)
+    jobs.main(['backfill', '--kind', 'Posts',
+               '--transform', 'posts_moderation'])
+    self.assertEqual(
+        ['old-1'], [item.key.name for item in dao.Posts(
+            client=self.client).query_pending_moderation(10)])
+
+
+class PruneActivityTestSuite(dao_test.BaseTestSuite):
+  """Test cases for prune_activity job."""
+
+  def test_prune_activity(self):
+    counters = dao.ActivityCounters()
+    now = datetime.datetime(2024, 6, 10, 12, 30)
+    for when in [now - datetime.timedelta(days=10),
+                 now - datetime.timedelta(hours=3),
+                 now]:
+      counters.increment(dao.ActivityCounters.SERIES_VOTES, when=when)
+    counters.increment(dao.ActivityCounters.SERIES_POSTS, when=now)
+
+    # minute and hour buckets of the old event and the minute bucket of the
+    # 3 hours old event are deleted; day buckets are kept
+    self.assertEqual(3, jobs.prune_activity(self.client, now=now))
+    self.assertEqual(0, jobs.prune_activity(self.client, now=now))
+
+    def total(series, granularity):
+      return sum([count for _, count in counters.get_series(
+          series, granularity, counters.MAX_BUCKETS, end=now)])
+
+    self.assertEqual(1, total(dao.ActivityCounters.SERIES_VOTES, 'minute'))
+    self.assertEqual(2, total(dao.ActivityCounters.SERIES_VOTES, 'hour'))
+    self.assertEqual(3, total(dao.ActivityCounters.SERIES_VOTES, 'day'))
+    self.assertEqual(1, total(dao.ActivityCounters.SERIES_POSTS, 'minute'))
+    self.assertEqual(1, total(dao.ActivityCounters.SERIES_POSTS, 'day'))
+
+
+class BackfillTestSuite(dao_test.BaseTestSuite):
+  """Test cases for backfill job."""
+
+  def setUp(self):
+    super(BackfillTestSuite, self).setUp()
+    for uid in range(6):
+      post = datastore.Entity(self.client.key(dao.Posts.TABLE, 'old-%s' % uid))
+      post.update({
+          'member_uid': 'member-1',
+          'data': '{}',
+          'created_on': datetime.datetime(2020, 1, 1 + uid),
+          'is_deleted': False,
+          'version': 1,
+      })
+      self.client.put(post)
+
+  def _posts(self):
+    return list(self.client.query(kind=dao.Posts.TABLE).fetch())
+
+  def test_backfill_with_marker(self):
+    reports = []
+    counters = jobs.backfill(
+        self.client, dao.Posts.TABLE, jobs._backfill_posts_updated_on,
+        name='posts_updated_on', shard_count=3, batch_size=2,
+        progress=reports.append)
+    self.assertEqual(6, counters['seen'])
+    self.assertEqual(6, counters['written'])
+    self.assertEqual(counters['shards'], counters['shards_done'])
+    self.assertEqual(6, reports[-1]['seen'])
+    for post in self._posts():
+      self.assertEqual(post['created_on'], post['updated_on'])
+      self.assertEqual(['posts_updated_on'], post['backfills'])
+      self.assertFalse(dao.Posts.SCHEMA.needs_reindex(post))
+
+    # marked entities are not read again in transaction
+    original = self.client.get_multi
+    try:
+      self.client.get_multi = None
+      counters = jobs.backfill(
+          self.client, dao.Posts.TABLE, jobs._backfill_posts_updated_on,
+          name='posts_updated_on')
+    finally:
+      self.client.get_multi = original
+    self.assertEqual((6, 0), (counters['seen'], counters['written']))
+
+  def test_backfill_without_marker(self):
+    counters = jobs.backfill(
+        self.client, dao.Posts.TABLE, jobs._backfill_posts_updated_on)
+    self.assertEqual((6, 6), (counters['seen'], counters['written']))
+    for post in self._posts():
+      self.assertNotIn('backfills', post)
+    counters = jobs.backfill(
+        self.client, dao.Posts.TABLE, jobs._backfill_posts_updated_on)
+    self.assertEqual((6, 0), (counters['seen'], counters['written']))
+
+  def test_throttle(self):
+    now = [0.0]
+    slept = []
+
+    def sleep(seconds):
+      slept.append(seconds)
+      now[0] += seconds
+
+    jobs.backfill(
+        self.client, dao.Posts.TABLE, jobs._backfill_posts_updated_on,
+        name='posts_updated_on', shard_count=1, batch_size=2,
+        max_per_second=2, clock=lambda: now[0], sleep=sleep)
+    self.assertEqual(2.0, sum(slept))
+
+  def test_resume_from_checkpoint(self):
+    calls = []
+
+    def transform(entity):
+      calls.append(entity.key.name)
+      if len(calls) == 3:
+        raise Exception('Interrupted')
+      return jobs._backfill_posts_updated_on(entity)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(tmp_dir, 'checkpoint.json')
+      with self.assertRaises(Exception):
+        jobs.backfill(self.client, dao.Posts.TABLE, transform, name='test',
+                      shard_count=1, batch_size=1,
+                      checkpoint_filename=filename)
+      self.assertEqual(['old-1'], jobs._Checkpoint(filename).get(
+          'cursors')['0'][1:])
+
+      counters = jobs.backfill(
+          self.client, dao.Posts.TABLE, transform, name='test',
+          checkpoint_filename=filename)
+      self.assertEqual(5, counters['seen'])
+      self.assertEqual(4, counters['written'])
+      self.assertEqual(7, len(calls))
+      self.assertEqual(['old-0', 'old-1', 'old-2', 'old-2'], calls[:4])
+      self.assertEqual([0], jobs._Checkpoint(filename).get('done'))
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_command_line(self):
+    member = datastore.Entity(self.client.key(dao.Members.TABLE, 'member-1'))
+    member.update({'data': '{}', 'version': 1})
+    self.client.put(member)
+    jobs.main(['backfill', '--kind', 'Members', '--transform', 'members_slug'])
+    member = self.client.get(member.key)
+    self.assertTrue(member['slug'])
+    self.assertEqual(['members_slug'], member['backfills'])
+
+    with self.assertRaises(ValueError):
+      jobs.main(['backfill', '--kind', 'Posts', '--transform', 'members_slug'])
+    jobs.main(['backfill', '--kind', 'Posts', '--no_marker', '--transform',
+               'jobs:_backfill_posts_updated_on'])
+    for post in self._posts():
+      self.assertTrue(post['updated_on'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,16 +4,29 @@
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
+import base64
+import binascii
+from concurrent import futures
 import datetime
+import hashlib
+import itertools
 import json
 import logging
-import mimetypes
+import math
 import os
 import traceback
+import urllib.parse
 import auth
 import flask
 from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+import assets
+import compression
+import container
 import dao
+import fieldmask
+import ratelimit
+import serialization
 
 # configure logging
 logging.basicConfig()
@@ -49,6 +62,42 @@ PROFILE_TAGS = {
 MAX_MEMBERS_IN_LIST = 500
 MAX_POSTS_IN_LIST = 500
 
+# changes within this window before watermark are returned again; this covers
+# transactions, which started before watermark was issued, but committed after
+POST_CHANGES_OVERLAP = datetime.timedelta(seconds=30)
+
+# write rate limits per member; keyed by the name of the route view function
+RATE_LIMITS = {
+    'api_v1_registration': ratelimit.Limit(burst=5, per_second=1.0 / 60),
+    'api_v1_profile': ratelimit.Limit(burst=10, per_second=1.0 / 30),
+    'api_v1_posts_insert': ratelimit.Limit(burst=10, per_second=1.0 / 30),
+    'api_v1_posts_post': ratelimit.Limit(burst=10, per_second=1.0 / 10),
+    'api_v1_votes_put': ratelimit.Limit(burst=30, per_second=1.0),
+    'api_v1_posts_views': ratelimit.Limit(burst=60, per_second=2.0),
+}
+
+# routes that take tokens from the bucket of another route; each vote cast in
+# bulk takes a token of single votes
+RATE_LIMITED_AS = {
+    'api_v1_votes_bulk_put': 'api_v1_votes_put',
+}
+
+# max number of posts client can report as viewed in one request
+MAX_POST_VIEWS_IN_REQUEST = 100
+
+# max number of votes client can cast in one bulk request; no more than rate
+# limit of votes lets through at once
+MAX_VOTES_IN_BULK = RATE_LIMITS['api_v1_votes_put'].burst
+
+# batch requests; consecutive reads of a batch run concurrently
+MAX_REQUESTS_IN_BATCH = 20
+BATCH_WORKER_COUNT = 4
+BATCH_METHODS = ['GET', 'PUT', 'POST']
+
+# sub-requests of a batch find verified user and loaded member here
+BATCH_USER_ENVIRON_KEY = 'toybox.batch.user'
+BATCH_MEMBER_ENVIRON_KEY = 'toybox.batch.member'
+
 # application schema; this is delivered to the client as JSON
 APP_SCHEMA = {
     'version': 'V1',
@@ -77,6 +126,9 @@ APP_SCHEMA = {
     },
 }
 
+# schema is served once per version and is cached by browsers for a year
+APP_SCHEMA_CACHE_MAX_AGE_SECS = 365 * 24 * 60 * 60
+
 # admin email addresses
 ADMIN_EMAILS = set([
     'psimakov@google.com',
@@ -101,6 +153,26 @@ OAUTH_UID_NS = '2'
 # JSON response details
 API_RESPONSE_PREFIX = ')]}\'\n'
 API_RESPONSE_CONTENT_TYPE = 'application/json; charset=utf-8'
+API_RESPONSE_PREFIX_BYTES = API_RESPONSE_PREFIX.encode('ascii')
+
+# sorting keys makes responses easier to read and diff, but costs CPU
+API_RESPONSE_SORT_KEYS = False
+
+# lists can be streamed on request with "stream" parameter; "json" is the
+# usual response sent in chunks, "ndjson" has envelope and each item on its
+# own line; items are read, encoded and sent one page at a time
+STREAM_FORMAT_JSON = 'json'
+STREAM_FORMAT_NDJSON = 'ndjson'
+STREAM_FORMATS = [STREAM_FORMAT_JSON, STREAM_FORMAT_NDJSON]
+STREAM_PAGE_SIZE = 50
+API_RESPONSE_NDJSON_CONTENT_TYPE = 'application/x-ndjson; charset=utf-8'
+
+# responses are compressed if client accepts it and they are large enough
+COMPRESSION_MIN_BYTES = compression.DEFAULT_MIN_BYTES
+COMPRESSION_GZIP_LEVEL = compression.DEFAULT_GZIP_LEVEL
+COMPRESSION_BROTLI_QUALITY = compression.DEFAULT_BROTLI_QUALITY
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
 
 # relative path to static assets
 STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
@@ -112,6 +184,27 @@ if not os.path.isdir(STATIC_DIR):
 firebase_utils = auth.FirebaseAppUtils(FIREBASE_CLOUD_PROJECT_ID)
 oauth2_utils = auth.OAuth2AppUtils(FIREBASE_CLOUD_PROJECT_ID)
 
+# token buckets for all members and routes
+rate_limiter = ratelimit.RateLimiter(RATE_LIMITS)
+
+# compressor of all responses
+compressor = compression.Compressor(
+    min_bytes=COMPRESSION_MIN_BYTES, gzip_level=COMPRESSION_GZIP_LEVEL,
+    brotli_quality=COMPRESSION_BROTLI_QUALITY)
+
+# static assets are loaded and compressed once, so we compress them harder
+static_assets = assets.AssetCache(STATIC_DIR, compression.Compressor(
+    min_bytes=COMPRESSION_MIN_BYTES, gzip_level=STATIC_GZIP_LEVEL,
+    brotli_quality=STATIC_BROTLI_QUALITY))
+static_assets.load()
+
+# application schema is serialized once; its version changes with content,
+# so any schema change gets a new URL and clients never use a stale one
+APP_SCHEMA_BODY = '%s%s' % (
+    API_RESPONSE_PREFIX, json.dumps(APP_SCHEMA, sort_keys=True))
+APP_SCHEMA_HASH = hashlib.sha256(APP_SCHEMA_BODY.encode('utf-8')).hexdigest()
+APP_SCHEMA_VERSION = '%s-%s' % (APP_SCHEMA['version'], APP_SCHEMA_HASH[:12])
+
 
 def parse_api_response(body):
   assert body.startswith(API_RESPONSE_PREFIX)
@@ -132,36 +225,93 @@ def set_no_cache_headers(headers):
 
 
 def serve_static_file(filename):
-  """Serves static file."""
-
-  # Remove drive letter (if we are on Windows).
-  filename = os.path.abspath(filename)
-  filename = os.path.join(os.sep, filename)
-  unused_drive, path_no_drive = os.path.splitdrive(filename)
-
-  # Remove leading path separator.
-  relfilename = path_no_drive[1:]
-  filename = os.path.join(STATIC_DIR, relfilename)
-  logging.info("Serving static file: %s" % filename)
-
-  if not os.path.isfile(filename):
+  """Serves static file from memory."""
+  response = static_assets.serve(flask.request, filename)
+  if response is None:
     flask.abort(404)
-
-  mime = mimetypes.guess_type(filename)[0]
-  if not mime:
-    mime = 'text/plain'
-
-  with open(filename, 'rb') as data:
-    return flask.Response(data.read(), 200, mimetype=mime)
+  return response
 
 
 def format_api_response(status_code, data):
+  # prefix and body are sent as two chunks, so the body is not copied
   response = flask.Response(
-      '%s%s' % (API_RESPONSE_PREFIX, json.dumps(data, sort_keys=True)),
+      [API_RESPONSE_PREFIX_BYTES, serialization.dumps(
+          data, sort_keys=API_RESPONSE_SORT_KEYS)],
       status_code, {
           'Content-Type': API_RESPONSE_CONTENT_TYPE,
       })
   set_no_cache_headers(response.headers)
+
+  # batch requests take data from here, so they don't parse the body back
+  response.api_data = data
+  return response
+
+
+class StreamedResult(object):
+  """Result of a method sent to client as pages of items are produced."""
+
+  def __init__(self, pages, stream_format):
+    self.pages = pages
+    self.stream_format = stream_format
+
+
+def get_stream_format():
+  """Returns stream format client asked for or None."""
+  stream_format = flask.request.args.get('stream', None)
+  if stream_format is not None and stream_format not in STREAM_FORMATS:
+    abort_invalid_attribute('stream', 'Must be one of: %s.' % ', '.join(
+        STREAM_FORMATS))
+  return stream_format
+
+
+def get_field_mask():
+  """Returns mask of fields client asked for with "fields" or None."""
+  text = flask.request.args.get('fields', None)
+  if text is None:
+    return None
+  try:
+    return fieldmask.compile_mask(text)
+  except ValueError as error:
+    abort_invalid_attribute('fields', str(error))
+
+
+def format_streamed_api_response(envelope, result, field_mask=None):
+  """Returns response sending envelope first, then result page by page."""
+  item_mask = None
+  if field_mask:
+    envelope = field_mask.project(envelope)
+    item_mask = field_mask.child('result')
+
+  def encode(item):
+    if item_mask:
+      item = item_mask.project(item)
+    return serialization.dumps(item, sort_keys=API_RESPONSE_SORT_KEYS)
+
+  def ndjson():
+    yield API_RESPONSE_PREFIX_BYTES + serialization.dumps(
+        envelope, sort_keys=API_RESPONSE_SORT_KEYS) + b'\n'
+    for page in result.pages:
+      if page:
+        yield b''.join([encode(item) + b'\n' for item in page])
+
+  def json_array():
+    head = serialization.dumps(envelope, sort_keys=API_RESPONSE_SORT_KEYS)
+    yield API_RESPONSE_PREFIX_BYTES + head[:-1] + (
+        b', ' if envelope else b'') + b'"result": ['
+    separator = b''
+    for page in result.pages:
+      if page:
+        yield separator + b', '.join([encode(item) for item in page])
+        separator = b', '
+    yield b']}'
+
+  if result.stream_format == STREAM_FORMAT_NDJSON:
+    body, content_type = ndjson(), API_RESPONSE_NDJSON_CONTENT_TYPE
+  else:
+    body, content_type = json_array(), API_RESPONSE_CONTENT_TYPE
+  response = flask.Response(
+      flask.stream_with_context(body), 200, {'Content-Type': content_type})
+  set_no_cache_headers(response.headers)
   return response
 
 
@@ -193,6 +343,11 @@ def set_cors_policy(response):
   return response
 
 
+@app.after_request
+def compress_response(response):
+  return compressor.compress_response(flask.request, response)
+
+
 @app.route('/', methods=['GET'])
 def static_root():
   return flask.redirect('/index.html', code=301)
@@ -200,9 +355,7 @@ def static_root():
 
 @app.route('/<path:filename>', methods=['GET'])
 def static_get(filename):
-  response = serve_static_file(filename)
-  set_no_cache_headers(response.headers)
-  return response
+  return serve_static_file(filename)
 
 
 def api_v1_ping():
@@ -212,6 +365,21 @@ def api_v1_ping():
   })
 
 
+def api_v1_schema(version):
+  """Serves application schema of a given version; anyone can read it."""
+  if version != APP_SCHEMA_VERSION:
+    flask.abort(format_api_response(404, dao.NotFoundError(
+        'No schema version "%s".' % version).to_json_serializable()))
+  response = flask.Response(APP_SCHEMA_BODY, 200, {
+      'Content-Type': API_RESPONSE_CONTENT_TYPE,
+  })
+  response.set_etag(APP_SCHEMA_HASH)
+  response.cache_control.public = True
+  response.cache_control.max_age = APP_SCHEMA_CACHE_MAX_AGE_SECS
+  response.cache_control.immutable = True
+  return response.make_conditional(flask.request)
+
+
 class ETag(object):
   """ETag.
 
@@ -289,19 +457,160 @@ def get_uid_for(user):
   return uid
 
 
-def with_user(method):
-  """Executed method with current user."""
-  user = get_user_for_request(flask.request)
+def get_verified_user():
+  """Returns user of current request or of the batch it is part of."""
+  user = flask.request.environ.get(BATCH_USER_ENVIRON_KEY)
+  if user:
+    return dict(user)
+  return get_user_for_request(flask.request)
+
+
+def load_member(user):
+  """Returns member of user; all reads of a batch share one member."""
+  member = flask.request.environ.get(BATCH_MEMBER_ENVIRON_KEY)
+  if member:
+    return member
+  return dao.Members().get_or_create_member(get_uid_for(user))
+
+
+class RequestContext(object):
+  """Verified user of a request with member and settings loaded on demand.
+
+  Member is read and its settings are parsed at most once per request;
+  update_settings() writes new settings through to storage and keeps the
+  context current, so the response is built without reading member again.
+  """
+
+  def __init__(self, user, roles, status, field_mask=None):
+    self.user = user
+    self.roles = roles
+    self.status = status
+    self.field_mask = field_mask
+    self._member = None
+    self._settings = None
+
+  @property
+  def member_uid(self):
+    return get_uid_for(self.user)
+
+  @property
+  def member(self):
+    if self._member is None:
+      self._member = load_member(self.user)
+    return self._member
+
+  @property
+  def settings(self):
+    """Returns parsed member settings; callers must not change them."""
+    if self._settings is None:
+      self._settings = json.loads(self.member.data)
+    return self._settings
+
+  def update_settings(self, settings, version=None):
+    """Saves new member settings; aborts with 400 if version is stale."""
+    try:
+      self._member = dao.Members().update(
+          self.member_uid, json.dumps(settings), version=version)
+    except dao.ETagError as error:
+      flask.abort(format_api_response(400, error.to_json_serializable()))
+    self._settings = settings
+
+  def invalidate(self):
+    """Forgets member, so it is read again; call if it was changed elsewhere."""
+    self._member = None
+    self._settings = None
+
+  def selects(self, *path):
+    """Checks if client asked for any field at or under path."""
+    return not self.field_mask or self.field_mask.selects(*path)
+
+  def fields_at(self, *path):
+    """Returns names of fields client asked for under path; None if all."""
+    if not self.field_mask:
+      return None
+    return self.field_mask.subfields(*path)
+
+
+def get_rate_limit_store():
+  registry = container.Registry.current()
+  if registry.shared_cache is not None:
+    return registry.shared_cache
+  return registry.cache
+
+
+def check_rate_limit(user, cost=1):
+  """Returns 429 response if user exceeded rate limit of current route."""
+  retry_after = rate_limiter.check(
+      get_rate_limit_store(),
+      RATE_LIMITED_AS.get(flask.request.endpoint, flask.request.endpoint),
+      get_uid_for(user), cost=cost)
+  if not retry_after:
+    return None
+  response = format_api_response(
+      429, dao.TooManyRequestsError(
+          'Too many requests. Please try again later.'
+      ).to_json_serializable())
+  response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+  return response
+
+
+def response_etag_for(ctx, validator):
+  """Returns ETag of a response with given context and validator."""
+  value = json.dumps([
+      ctx.user, sorted(ctx.roles or []), ctx.status, ctx.member.version,
+      APP_SCHEMA_VERSION, flask.request.query_string.decode('utf-8'),
+      validator], sort_keys=True, default=str)
+  return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def set_revalidate_headers(headers):
+  """Lets client keep response, but only use it after checking its ETag."""
+  headers['Cache-Control'] = 'private, no-cache'
+  headers.pop('Expires', None)
+  headers.pop('Pragma', None)
+
+
+def with_user(method, validator=None, rate_limit_cost=1):
+  """Executed method with current user.
+
+  Method and validator get RequestContext of the request. If validator is
+  given, validator(ctx) must return a cheap value that changes whenever the
+  result of the method changes; the result is not built and 304 is returned
+  if client already has the response with the same ETag. Method takes
+  rate_limit_cost tokens from the rate limit bucket of its route.
+
+  If client asked for some fields only with "fields" parameter, response is
+  projected to them before it is serialized, and member is not read unless
+  some of its fields are asked for.
+  """
+  user = get_verified_user()
   if not user:
     return flask.Response('Unauthorized.', 401)
   roles, status = get_roles_for(user)
+  ctx = RequestContext(user, roles, status, field_mask=get_field_mask())
 
   result = None
   if method:
     if not roles:
       return flask.Response('Access denied.', 403)
+
+    # reject before doing any Datastore work
+    too_many_requests = check_rate_limit(user, cost=rate_limit_cost)
+    if too_many_requests:
+      return too_many_requests
+
+  etag = None
+  if validator:
+    etag = response_etag_for(ctx, validator(ctx))
+    if flask.request.if_none_match.contains_weak(etag):
+      response = flask.Response(status=304)
+      response.set_etag(etag, weak=True)
+      set_revalidate_headers(response.headers)
+      return response
+
+  if method:
     try:
-      result = method(user, roles)
+      result = method(ctx)
     except HTTPException:              # these are flask.abort; ok
       raise
     except dao.BusinessRuleError:      # these are our dao.* exceptions; ok
@@ -314,26 +623,42 @@ def with_user(method):
               'Internal server error. Please try again later.'
           ).to_json_serializable()))
 
-  member = dao.Members().get_or_create_member(get_uid_for(user))
-
   user['roles'] = roles
-  user['settings'] = json.loads(member.data)
-  user['slug'] = member.slug
   user['status'] = status
-  user[ETag.ETAG_NAME_SETTINGS] = member.version
+
+  # member is current; methods that change it write through the context
+  if any([ctx.selects('user', name) for name in [
+      'settings', 'slug', ETag.ETAG_NAME_SETTINGS]]):
+    member = ctx.member
+    user['settings'] = serialization.RawJSON(member.data)
+    user['slug'] = member.slug
+    user[ETag.ETAG_NAME_SETTINGS] = member.version
 
   response = {
       'app': {
-          'schema': APP_SCHEMA,
+          'schema_version': APP_SCHEMA_VERSION,
       },
       'user': user,
       'server': get_server_info(),
   }
 
-  if result or result == []:  # pylint: disable=g-explicit-bool-comparison
-    response['result'] = result
-
-  return format_api_response(200, response)
+  # pages of streamed result are not even read if client doesn't need them
+  if isinstance(result, StreamedResult) and not ctx.selects('result'):
+    result = None
+
+  if isinstance(result, StreamedResult):
+    response = format_streamed_api_response(
+        response, result, field_mask=ctx.field_mask)
+  else:
+    if result or result == []:  # pylint: disable=g-explicit-bool-comparison
+      response['result'] = result
+    if ctx.field_mask:
+      response = ctx.field_mask.project(response)
+    response = format_api_response(200, response)
+  if etag:
+    response.set_etag(etag, weak=True)
+    set_revalidate_headers(response.headers)
+  return response
 
 
 def validate_profile(profile):
@@ -349,37 +674,27 @@ def validate_profile(profile):
 
 def api_v1_whoami():
   """Queries capabilities of user specified by id_token in HTTP header."""
-  return with_user(None)
+  return with_user(None, validator=lambda unused_ctx: None)
 
 
 def api_v1_registration():
   """Register current user into the program."""
 
-  def action(user, unused_roles):
-    members = dao.Members()
-
-    # load member current settings
-    member_uid = get_uid_for(user)
-    member = members.get_or_create_member(member_uid)
+  def action(ctx):
     version = ETag.from_request(ETag.ETAG_NAME_SETTINGS)
     if not version:
-      version = member.version
+      version = ctx.member.version
 
     # update registration portion of settings
-    settings = json.loads(member.data)
+    settings = dict(ctx.settings)
     settings['registered'] = True
     settings['registration'] = {
-        'displayName': user['displayName'],
-        'photoURL': user['photoURL'],
-        'email': user['email'],
+        'displayName': ctx.user['displayName'],
+        'photoURL': ctx.user['photoURL'],
+        'email': ctx.user['email'],
         'created_on': dao.datetime_to_str(dao.timezone_aware_now()),
     }
-
-    # save to storage
-    try:
-      members.update(member_uid, json.dumps(settings), version=version)
-    except dao.ETagError as error:
-      flask.abort(format_api_response(400, error.to_json_serializable()))
+    ctx.update_settings(settings, version=version)
 
   return with_user(action)
 
@@ -397,84 +712,293 @@ def api_v1_profile():
     abort_user_error('Provided "profile" is not a valid JSON.')
   validate_profile(profile)
 
-  def action(user, unused_roles):
-    members = dao.Members()
-
-    # load member current settings
-    member_uid = get_uid_for(user)
-    member = members.get_or_create_member(member_uid)
+  def action(ctx):
     version = ETag.from_request(ETag.ETAG_NAME_SETTINGS)
     if not version:
-      version = member.version
+      version = ctx.member.version
 
     # update profile portion of settings
-    settings = json.loads(member.data)
+    settings = dict(ctx.settings)
     settings['profile'] = profile
-
-    # save to storage
-    try:
-      members.update(member_uid, json.dumps(settings), version=version)
-    except dao.ETagError as error:
-      flask.abort(format_api_response(400, error.to_json_serializable()))
+    ctx.update_settings(settings, version=version)
 
   return with_user(action)
 
 
+def member_to_projection(member, roles):
+  """Returns member projection or None if roles can't see this member."""
+  settings = json.loads(member.data)
+  profile = settings.get('profile', None)
+  registration = settings.get('registration', None)
+
+  # check rights
+  is_admin = ROLE_ADMIN in roles
+  is_public = profile and (
+      profile.get('visibility') == PROFILE_VISIBILITY_PUBLIC)
+  if not(is_public or is_admin):
+    return None
+
+  return {
+      'slug': member.slug,
+      'profile': profile,
+      'registration': registration,
+  }
+
+
+def iter_member_projections(roles):
+  """Yields projections of members roles can see."""
+  projections = (member_to_projection(member, roles)
+                 for member in dao.Members().iter_members())
+  return itertools.islice(
+      (projection for projection in projections if projection),
+      MAX_MEMBERS_IN_LIST)
+
+
 def api_v1_members():
-  """Lists members."""
+  """Lists members; if "stream" is given, sends them as they are read."""
 
-  def action(unused_user, roles):
-    members = dao.Members()
-    is_admin = ROLE_ADMIN in roles
-    results = []
+  stream_format = get_stream_format()
 
-    # add registered members
-    for member in members.query_members():
-      if len(results) > MAX_MEMBERS_IN_LIST:
-        break
-
-      settings = json.loads(member.data)
-      profile = settings.get('profile', None)
-      registration = settings.get('registration', None)
-
-      # check rights
-      is_public = profile and (
-          profile.get('visibility') == PROFILE_VISIBILITY_PUBLIC)
-      if not(is_public or is_admin):
-        continue
-
-      # add projection to output
-      results.append({
-          'slug': member.slug,
-          'profile': profile,
-          'registration': registration,
-      })
+  def action(ctx):
+    projections = iter_member_projections(ctx.roles)
+    if stream_format:
+      return StreamedResult(
+          dao.iter_pages(projections, STREAM_PAGE_SIZE), stream_format)
+    return list(projections)
+
+  def validator(unused_ctx):
+    return dao.Members().get_generation()
+
+  return with_user(action, validator=validator)
 
-    return results
+
+def api_v1_member_by_slug(slug):
+  """Gets one member by slug."""
+
+  def action(ctx):
+    member = dao.Members().get_member_by_slug(slug)
+    projection = member_to_projection(member, ctx.roles) if member else None
+    if not projection:
+      flask.abort(format_api_response(404, dao.NotFoundError(
+          'No member for slug "%s".' % slug).to_json_serializable()))
+    return projection
 
   return with_user(action)
 
 
+def posts_validator(ctx):
+  """Changes when any post, any recent write of the user or views change."""
+  generations = [dao.Posts().get_generation(),
+                 dao.RecentWrites().get_generation(ctx.member_uid)]
+  fields = ctx.fields_at('result')
+  if fields is None or 'views' in fields:
+    generations.append(dao.PostViews().get_generation())
+  return generations
+
+
+def is_moderator(roles):
+  return bool(set([ROLE_MODERATOR, ROLE_ADMIN]) & set(roles or []))
+
+
+def is_post_visible_to(roles):
+  """Returns accept(post) for posts roles can see; flagged are hidden."""
+  if is_moderator(roles):
+    return lambda post: True
+  return lambda post: post.moderation != dao.MODERATION_FLAGGED
+
+
+def by_votes_total(posts):
+  return sorted(posts, key=lambda post: post.votes_total, reverse=True)
+
+
 def api_v1_posts_get():
-  """Lists all posts."""
+  """Lists all posts or, if "top" is given, only few posts with most votes.
+
+  If "moderation" is given, only posts in that moderation state are listed;
+  only moderators can list pending and flagged posts, and flagged posts are
+  not listed for others at all. If "stream" is given, posts are sent page by
+  page as they are read.
+  """
+
+  moderation = flask.request.args.get('moderation', None)
+  if moderation is not None and moderation not in dao.MODERATION_STATES:
+    abort_invalid_attribute('moderation', 'Must be one of: %s.' % ', '.join(
+        sorted(dao.MODERATION_STATES)))
+
+  top = flask.request.args.get('top', None)
+  if top is not None:
+    try:
+      top = int(top)
+    except ValueError:
+      abort_invalid_attribute('top', 'Must be a number.')
+    if not 0 < top <= dao.Leaderboards.SIZE:
+      abort_invalid_attribute(
+          'top', 'Must be between 1 and %s.' % dao.Leaderboards.SIZE)
+
+  stream_format = get_stream_format()
+
+  def action(ctx):
+    if moderation in [dao.MODERATION_PENDING, dao.MODERATION_FLAGGED] and (
+        not is_moderator(ctx.roles)):
+      flask.abort(flask.Response('Access denied.', 403))
+    if moderation:
+      accept = lambda post: post.moderation == moderation
+    else:
+      accept = is_post_visible_to(ctx.roles)
 
-  def action(user, unused_roles):
     posts = dao.Posts()
-    member_uid = get_uid_for(user)
-    return dao.posts_query_to_list(
-        member_uid, posts.query_posts(), client=posts.client)
+    member_uid = ctx.member_uid
+    recent = dao.RecentWrites(client=posts.client)
+
+    # streamed posts go in query order, recent writes of member go last
+    if stream_format and not top:
+      items = recent.iter_merged_posts(
+          member_uid, posts.iter_posts(moderation=moderation), accept=accept)
+      return StreamedResult(dao.posts_query_to_pages(
+          member_uid, (post for post in items if accept(post)),
+          STREAM_PAGE_SIZE, fields=ctx.fields_at('result'),
+          client=posts.client), stream_format)
+
+    # posts are filtered before top ones are picked
+    if top and moderation:
+      items = recent.merge_posts(member_uid, posts.iter_posts(
+          moderation=moderation, limit=top))
+    elif top:
+      items = recent.merge_posts(member_uid, posts.query_top_posts(
+          top, accept=None if is_moderator(ctx.roles) else accept))
+    else:
+      items = recent.merge_posts(
+          member_uid, posts.query_posts(moderation=moderation),
+          accept=accept)
+    items = [post for post in items if accept(post)]
+    results = dao.posts_query_to_list(
+        member_uid, by_votes_total(items), fields=ctx.fields_at('result'),
+        client=posts.client)
+    if stream_format:
+      return StreamedResult([results], stream_format)
+    return results
 
-  return with_user(action)
+  return with_user(action, validator=posts_validator)
 
 
 def api_v1_member_posts():
   """Lists all posts of current user."""
 
-  def action(user, unused_roles):
+  def action(ctx):
     posts = dao.Posts()
-    member_uid = get_uid_for(user)
+    member_uid = ctx.member_uid
+    items = dao.RecentWrites(client=posts.client).merge_posts(
+        member_uid, posts.query_member_posts(member_uid),
+        accept=lambda post: post.member_uid == member_uid)
     return dao.posts_query_to_list(
-        member_uid, posts.query_member_posts(member_uid), client=posts.client)
+        member_uid, by_votes_total(items), fields=ctx.fields_at('result'),
+        client=posts.client)
+
+  return with_user(action, validator=posts_validator)
+
+
+class Watermark(object):
+  """Watermark of post changes already seen by the client.
+
+  Watermark is opaque to the client; it's a point in time after which the
+  client has not seen any post changes; when "is_exact" is not set, we also
+  return changes made in the POST_CHANGES_OVERLAP window before that time;
+  the client may receive a change more than once, but never misses one.
+  Exact watermark of a full page also has uid of the last post sent, so
+  posts with the same updated_on that did not fit are sent next time.
+  """
+
+  def __init__(self, since, is_exact=False, after_uid=None):
+    self.since = since
+    self.is_exact = is_exact
+    self.after_uid = after_uid
+
+  def to_token(self):
+    epoch = datetime.datetime.utcfromtimestamp(0)
+    micros = (self.since - epoch) // datetime.timedelta(microseconds=1)
+    value = '%s.%s' % (micros, int(self.is_exact))
+    if self.after_uid is not None:
+      value = '%s.%s' % (value, self.after_uid)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('utf-8')
+
+  @classmethod
+  def from_token(cls, token):
+    try:
+      value = base64.urlsafe_b64decode(token.encode('utf-8')).decode('utf-8')
+      parts = value.split('.')
+      if len(parts) not in [2, 3]:
+        raise ValueError(value)
+      since = datetime.datetime.utcfromtimestamp(0) + datetime.timedelta(
+          microseconds=int(parts[0]))
+      after_uid = int(parts[2]) if len(parts) == 3 else None
+      return cls(since, is_exact=parts[1] == '1', after_uid=after_uid)
+    except (binascii.Error, UnicodeError, ValueError, OverflowError):
+      abort_user_error('Provided "since" is not a valid watermark.')
+
+  def query_since(self):
+    if self.is_exact:
+      return self.since
+    return self.since - POST_CHANGES_OVERLAP
+
+
+def api_v1_posts_changes():
+  """Lists posts created, updated or deleted after client watermark.
+
+  Posts user can't see, like flagged ones for users who are not moderators,
+  are not listed; if they changed, they are reported as deleted, so client
+  drops its copies.
+  """
+
+  token = flask.request.args.get('since', None)
+  watermark = Watermark.from_token(token) if token else None
+
+  def action(ctx):
+    posts = dao.Posts()
+    member_uid = ctx.member_uid
+    recent = dao.RecentWrites(client=posts.client)
+    now = datetime.datetime.utcnow()
+    accept = is_post_visible_to(ctx.roles)
+
+    # no watermark; send all posts and watermark to start from
+    if not watermark:
+      items = [post for post in recent.merge_posts(
+          member_uid, posts.query_posts(), accept=accept) if accept(post)]
+      return {
+          'posts': dao.posts_query_to_list(
+              member_uid, by_votes_total(items),
+              fields=ctx.fields_at('result', 'posts'), client=posts.client),
+          'deleted': [],
+          'watermark': Watermark(now).to_token(),
+          'has_more': False,
+      }
+
+    # changes since watermark; if there are too many, client must come back
+    since = watermark.query_since()
+    changes = posts.query_posts_changed_since(
+        since, after_uid=watermark.after_uid if watermark.is_exact else None)
+    has_more = len(changes) >= dao.MAX_POST_CHANGES_IN_LIST
+    if has_more:
+      next_watermark = Watermark(
+          dao.to_utc(changes[-1].updated_on).replace(tzinfo=None),
+          is_exact=True, after_uid=changes[-1].key.id)
+    else:
+      next_watermark = Watermark(now)
+
+      # own changes the query may not see yet
+      changes = recent.merge_posts(
+          member_uid, changes, keep_deleted=True,
+          accept=lambda post: dao.to_utc(post.updated_on) > dao.to_utc(since))
+
+    return {
+        'posts': dao.posts_query_to_list(
+            member_uid, [post for post in changes
+                         if not post.is_deleted and accept(post)],
+            fields=ctx.fields_at('result', 'posts'), client=posts.client),
+        'deleted': [post.key.id for post in changes
+                    if post.is_deleted or not accept(post)],
+        'watermark': next_watermark.to_token(),
+        'has_more': has_more,
+    }
 
   return with_user(action)
 
@@ -486,8 +1010,8 @@ def api_v1_posts_insert():
   if not json_string:
     abort_user_error('Missing required parameter "post".')
 
-  def action(user, unused_roles):
-    member_uid = get_uid_for(user)
+  def action(ctx):
+    member_uid = ctx.member_uid
     dao.Posts().insert_post(member_uid, json_string)
 
   return with_user(action)
@@ -505,13 +1029,36 @@ def api_v1_posts_post():
   if not post_uid:
     abort_user_error('Missing required parameter "post.uid".')
 
-  def action(user, unused_roles):
-    member_uid = get_uid_for(user)
+  def action(ctx):
+    member_uid = ctx.member_uid
     dao.Posts().mark_post_deleted(member_uid, post_uid)
 
   return with_user(action)
 
 
+def api_v1_posts_views():
+  """Counts views of posts client has shown to the user."""
+
+  json_string = flask.request.form.get('views', None)
+  if not json_string:
+    abort_user_error('Missing required parameter "views".')
+  try:
+    post_uids = json.loads(json_string)
+  except:  # pylint: disable=bare-except
+    abort_user_error('Provided "views" is not a valid JSON.')
+  if not isinstance(post_uids, list) or not post_uids or not all(
+      [dao.is_valid_post_uid(item) for item in post_uids]):
+    abort_invalid_attribute('views', 'Must be a list of post uids.')
+  if len(post_uids) > MAX_POST_VIEWS_IN_REQUEST:
+    abort_invalid_attribute('views', 'Must have at most %s post uids.' % (
+        MAX_POST_VIEWS_IN_REQUEST))
+
+  def action(unused_ctx):
+    dao.PostViews().record_views(set([str(item) for item in post_uids]))
+
+  return with_user(action)
+
+
 def api_v1_votes_put():
   """Records user vote."""
 
@@ -527,35 +1074,253 @@ def api_v1_votes_put():
   if not value:
     abort_user_error('Missing required parameter "vote.value".')
 
-  def action(user, unused_roles):
+  def action(ctx):
     votes = dao.Votes()
-    member_uid = get_uid_for(user)
+    member_uid = ctx.member_uid
 
     # record vote
-    post, vote = votes.insert_vote(member_uid, post_uid, value)
+    post, vote_ = votes.insert_vote(member_uid, post_uid, value)
     result = dao.posts_query_to_list(member_uid, [post], fill_votes=False,
                                      client=votes.client)[0]
-
-    # update my_vote_value directly; it may not get picked up
-    # due to indexed query being out of date
-    result['my_vote_value'] = vote.value
+    result['my_vote_value'] = vote_.value
     return result
 
   return with_user(action)
 
 
+def api_v1_votes_bulk_put():
+  """Records many votes of user; returns result or error for each vote."""
+
+  # extract and validate votes
+  json_string = flask.request.form.get('votes', None)
+  if not json_string:
+    abort_user_error('Missing required parameter "votes".')
+  try:
+    votes = json.loads(json_string)
+  except:  # pylint: disable=bare-except
+    abort_user_error('Provided "votes" is not a valid JSON.')
+  if not isinstance(votes, list) or not votes:
+    abort_invalid_attribute('votes', 'Must be a non-empty list.')
+  if len(votes) > MAX_VOTES_IN_BULK:
+    abort_invalid_attribute('votes', 'Must have at most %s items.' % (
+        MAX_VOTES_IN_BULK))
+  for vote in votes:
+    if not isinstance(vote, dict) or not vote.get('uid') or (
+        not vote.get('value')):
+      abort_invalid_attribute(
+          'votes', 'Each item must have "uid" and "value".')
+
+  def action(ctx):
+    votes_ = dao.Votes()
+    member_uid = ctx.member_uid
+
+    # record votes
+    inserted = votes_.insert_votes(
+        member_uid, [(vote['uid'], vote['value']) for vote in votes])
+    posts = dict([(result[0].key.id_or_name, result[0]) for result in inserted
+                  if not isinstance(result, dao.BusinessRuleError)])
+    items = dict([(item['uid'], item) for item in dao.posts_query_to_list(
+        member_uid, list(posts.values()), fill_votes=False,
+        client=votes_.client)])
+
+    results = []
+    for vote, result in zip(votes, inserted):
+      if isinstance(result, dao.BusinessRuleError):
+        results.append({
+            'uid': vote['uid'],
+            'status': 404 if isinstance(result, dao.NotFoundError) else 400,
+            'error': result.to_json_serializable(),
+        })
+      else:
+        results.append({
+            'uid': vote['uid'],
+            'status': 200,
+            'result': dict(items[result[0].key.id_or_name],
+                           my_vote_value=result[1].value),
+        })
+    return results
+
+  return with_user(action, rate_limit_cost=len(votes))
+
+
+def api_v1_activity(series):
+  """Lists counts of posts or votes in last time buckets; oldest first."""
+
+  if series not in dao.ActivityCounters.SERIES:
+    flask.abort(format_api_response(404, dao.NotFoundError(
+        'No activity series "%s".' % series).to_json_serializable()))
+  granularity = flask.request.args.get('granularity', 'hour')
+  if granularity not in dao.ActivityCounters.GRANULARITIES:
+    abort_invalid_attribute('granularity', 'Must be one of: %s.' % ', '.join(
+        dao.ActivityCounters.GRANULARITIES.keys()))
+  count = flask.request.args.get('count', '24')
+  try:
+    count = int(count)
+  except ValueError:
+    abort_invalid_attribute('count', 'Must be a number.')
+  if not 0 < count <= dao.ActivityCounters.MAX_BUCKETS:
+    abort_invalid_attribute('count', 'Must be between 1 and %s.' % (
+        dao.ActivityCounters.MAX_BUCKETS))
+
+  def action(unused_ctx):
+    buckets = dao.ActivityCounters().get_series(series, granularity, count)
+    return {
+        'series': series,
+        'granularity': granularity,
+        'buckets': [{
+            'start': dao.datetime_to_str(start),
+            'count': value,
+        } for start, value in buckets],
+    }
+
+  return with_user(action)
+
+
+def parse_batch_requests():
+  """Loads and validates sub-requests of a batch from request parameters."""
+  json_string = flask.request.form.get('requests', None)
+  if not json_string:
+    abort_user_error('Missing required parameter "requests".')
+  try:
+    requests = json.loads(json_string)
+  except:  # pylint: disable=bare-except
+    abort_user_error('Provided "requests" is not a valid JSON.')
+  if not isinstance(requests, list) or not requests:
+    abort_invalid_attribute('requests', 'Must be a non-empty list.')
+  if len(requests) > MAX_REQUESTS_IN_BATCH:
+    abort_invalid_attribute('requests', 'Must have at most %s items.' % (
+        MAX_REQUESTS_IN_BATCH))
+  for request in requests:
+    if (not isinstance(request, dict) or
+        request.get('method') not in BATCH_METHODS or
+        not isinstance(request.get('path'), str) or
+        not isinstance(request.get('params', {}), dict) or
+        not isinstance(request.get('if_none_match', ''), str)):
+      abort_invalid_attribute('requests', (
+          'Each item must have "method" (one of: %s), "path" and optional '
+          '"params" object.') % ', '.join(BATCH_METHODS))
+    if (request['method'] == 'GET' and request.get('params') and
+        '?' in request['path']):
+      abort_invalid_attribute(
+          'requests', 'Query must be given either in "path" or in "params".')
+
+    # streamed responses have no data to put into the batch result
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(request['path']).query)
+    if 'stream' in request.get('params', {}) or 'stream' in query:
+      abort_invalid_attribute(
+          'requests', 'Sub-requests can\'t use "stream".')
+  return requests
+
+
+def batch_result_for(response):
+  """Returns status and data of a sub-request response without envelope."""
+  result = {'status': response.status_code}
+  if response.headers.get('ETag'):
+    result['etag'] = response.headers['ETag']
+  data = getattr(response, 'api_data', None)
+  if data is not None:
+    if response.status_code != 200:
+      result['error'] = data
+    elif 'result' in data:
+      result['result'] = data['result']
+  return result
+
+
+def run_batch_request(request, base_url, user, member):
+  """Runs a sub-request of a batch as user; returns its result."""
+  params = request.get('params') or {}
+  builder = EnvironBuilder(
+      path=request['path'], base_url=base_url, method=request['method'],
+      headers=[('If-None-Match', request['if_none_match'])]
+      if request.get('if_none_match') else None,
+      query_string=params if request['method'] == 'GET' and params else None,
+      data=params if request['method'] != 'GET' else None)
+  environ = builder.get_environ()
+  environ[BATCH_USER_ENVIRON_KEY] = user
+  if member:
+    environ[BATCH_MEMBER_ENVIRON_KEY] = member
+
+  with app.request_context(environ):
+    if flask.request.endpoint == api_v1_batch.__name__:
+      return {'status': 400, 'error': dao.BusinessRuleError(
+          'Batch requests can not be nested.').to_json_serializable()}
+    try:
+      response = app.make_response(app.dispatch_request())
+    except HTTPException as e:
+      response = e.get_response()
+    except Exception:  # pylint: disable=broad-except
+      logging.error('Exception:\n%s', traceback.format_exc())
+      response = format_api_response(
+          500,
+          dao.BusinessRuleError(
+              'Internal server error. Please try again later.'
+          ).to_json_serializable())
+    return batch_result_for(response)
+
+
+def api_v1_batch():
+  """Runs many API requests of current user in one HTTP request.
+
+  Parameter "requests" is a list of sub-requests; each has "method",
+  "path", optional "params" and optional "if_none_match". User is verified
+  once for the whole batch. Sub-requests run in order, except consecutive
+  reads (GET), which run concurrently and share one member load; results
+  with "status", "etag", "result" or "error" are in the order of requests.
+  """
+
+  requests = parse_batch_requests()
+  base_url = flask.request.host_url
+
+  def action(ctx):
+    verified_user = dict(ctx.user)
+    results = [None] * len(requests)
+
+    with futures.ThreadPoolExecutor(
+        max_workers=BATCH_WORKER_COUNT) as executor:
+      index = 0
+      while index < len(requests):
+        # writes run alone; next reads must see what they changed
+        if requests[index]['method'] != 'GET':
+          results[index] = run_batch_request(
+              requests[index], base_url, verified_user, None)
+          ctx.invalidate()
+          index += 1
+          continue
+
+        reads = []
+        while index < len(requests) and requests[index]['method'] == 'GET':
+          reads.append(index)
+          index += 1
+        member = ctx.member
+        for read, result in zip(reads, executor.map(
+            lambda read: run_batch_request(
+                requests[read], base_url, verified_user, member), reads)):
+          results[read] = result
+
+    return results
+
+  return with_user(action)
+
+
 # all HTTP routes are registered in one place here
 ALL_ROUTES = [
     ('/api/rest/v1/ping', api_v1_ping, ['GET']),
     ('/api/rest/v1/whoami', api_v1_whoami, ['GET']),
+    ('/api/rest/v1/schema/<version>', api_v1_schema, ['GET']),
     ('/api/rest/v1/registration', api_v1_registration, ['PUT']),
     ('/api/rest/v1/profile', api_v1_profile, ['POST']),
     ('/api/rest/v1/members', api_v1_members, ['GET']),
+    ('/api/rest/v1/members/<slug>', api_v1_member_by_slug, ['GET']),
     ('/api/rest/v1/member/posts', api_v1_member_posts, ['GET']),
     ('/api/rest/v1/posts', api_v1_posts_get, ['GET']),
+    ('/api/rest/v1/posts/changes', api_v1_posts_changes, ['GET']),
+    ('/api/rest/v1/activity/<series>', api_v1_activity, ['GET']),
     ('/api/rest/v1/posts', api_v1_posts_insert, ['PUT']),
     ('/api/rest/v1/posts', api_v1_posts_post, ['POST']),
+    ('/api/rest/v1/posts/views', api_v1_posts_views, ['PUT']),
     ('/api/rest/v1/votes', api_v1_votes_put, ['PUT']),
+    ('/api/rest/v1/votes/bulk', api_v1_votes_bulk_put, ['PUT']),
+    ('/api/rest/v1/batch', api_v1_batch, ['POST']),
 ]
 
 
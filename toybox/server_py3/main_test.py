@@ -4,8 +4,12 @@
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
 
+import gzip
 import json
 import unittest
+import cache
+import container
+import counters
 import dao
 import dao_test
 import main
@@ -63,6 +67,18 @@ class AuthAndRolesTestSuite(dao_test.BaseTestSuite):
         set(['lang', 'time', 'software', 'version']),
         set(main.parse_api_response(response.text)['server'].keys()))
 
+  def test_static_get_requires_no_credentials(self):
+    response = self.app.get('/index.html')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('public, no-cache', response.headers['Cache-Control'])
+
+    response = self.app.get('/index.html', headers={
+        'If-None-Match': response.headers['ETag']})
+    self.assertEqual(304, response.status_int)
+
+    response = self.app.get('/missing.html', expect_errors=True)
+    self.assertEqual(404, response.status_int)
+
   def test_api_whoami_get_not_authorized(self):
     response = self.app.get('/api/rest/v1/whoami', expect_errors=True)
     self.assertEqual(401, response.status_int)
@@ -125,6 +141,78 @@ class MembersTestSuite(dao_test.BaseTestSuite):
     finally:
       main.get_user_for_request = original
 
+  def test_schema(self):
+
+    def then(unused_member_uid):
+      response = self.app.get('/api/rest/v1/whoami')
+      app = main.parse_api_response(response.text)['app']
+      self.assertEqual({'schema_version': main.APP_SCHEMA_VERSION}, app)
+
+    self._with_user(then)
+
+    url = '/api/rest/v1/schema/%s' % main.APP_SCHEMA_VERSION
+    response = self.app.get(url)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(main.APP_SCHEMA, main.parse_api_response(response.text))
+    self.assertEqual('"%s"' % main.APP_SCHEMA_HASH, response.headers['ETag'])
+    self.assertIn('immutable', response.headers['Cache-Control'])
+    self.assertIn('max-age=%s' % main.APP_SCHEMA_CACHE_MAX_AGE_SECS,
+                  response.headers['Cache-Control'])
+
+    response = self.app.get(url, headers={
+        'If-None-Match': response.headers['ETag']})
+    self.assertEqual(304, response.status_int)
+    self.assertEqual(b'', response.body)
+
+    response = self.app.get('/api/rest/v1/schema/V0', expect_errors=True)
+    self.assertEqual(404, response.status_int)
+
+  def test_whoami_not_modified(self):
+
+    def then(unused_member_uid):
+      response = self.app.get('/api/rest/v1/whoami')
+      etag = response.headers['ETag']
+      self.assertEqual('private, no-cache', response.headers['Cache-Control'])
+      response = self.app.get(
+          '/api/rest/v1/whoami', headers={'If-None-Match': etag})
+      self.assertEqual(304, response.status_int)
+      self.assertEqual(etag, response.headers['ETag'])
+
+      # settings changed
+      dao.Members().update('abc123', '{"a": 1}')
+      response = self.app.get(
+          '/api/rest/v1/whoami', headers={'If-None-Match': etag})
+      self.assertEqual(200, response.status_int)
+      self.assertNotEqual(etag, response.headers['ETag'])
+
+      # claims of the token changed
+      etag = response.headers['ETag']
+      main.get_user_for_request = lambda request: dict(
+          mock_get_admin_user_for_request(request), displayName='Other')
+      response = self.app.get(
+          '/api/rest/v1/whoami', headers={'If-None-Match': etag})
+      self.assertEqual(200, response.status_int)
+      self.assertEqual(
+          'Other',
+          main.parse_api_response(response.text)['user']['displayName'])
+
+    self._with_user(then)
+
+  def test_list_members_not_modified(self):
+
+    def then(unused_member_uid):
+      etag = self.app.get('/api/rest/v1/members').headers['ETag']
+      response = self.app.get(
+          '/api/rest/v1/members', headers={'If-None-Match': etag})
+      self.assertEqual(304, response.status_int)
+
+      dao.Members().get_or_create_member('other')
+      response = self.app.get(
+          '/api/rest/v1/members', headers={'If-None-Match': etag})
+      self.assertEqual(200, response.status_int)
+
+    self._with_user(then)
+
   def test_registration_is_idempotent(self):
     self.test_registration()
     self.test_registration(etag=2)
@@ -197,6 +285,42 @@ class MembersTestSuite(dao_test.BaseTestSuite):
 
     return expected
 
+  def test_member_is_read_once_per_request(self):
+
+    def then(unused_member_uid):
+      reads = []
+      original = dao.Members.get_or_create_member
+
+      def get_or_create_member(members, uid):
+        reads.append(uid)
+        return original(members, uid)
+
+      dao.Members.get_or_create_member = get_or_create_member
+      try:
+        response = self.app.get('/api/rest/v1/whoami')
+        self.assertEqual(200, response.status_int)
+        self.assertEqual(['abc123'], reads)
+
+        del reads[:]
+        params = {
+            'settings_etag': 2,
+            'profile': json.dumps({
+                'title': 'My title', 'location': 'SFO', 'about': 'Dogs.'}),
+        }
+        response = self.app.post('/api/rest/v1/profile', params=params)
+        self.assertEqual(200, response.status_int)
+        self.assertEqual(['abc123'], reads)
+
+        # envelope has settings written by the request, not the ones read
+        user = main.parse_api_response(response.text)['user']
+        self.assertEqual(3, user['settings_etag'])
+        self.assertEqual('My title', user['settings']['profile']['title'])
+        self.assertTrue(user['settings']['registered'])
+      finally:
+        dao.Members.get_or_create_member = original
+
+    self._with_user(then)
+
   def test_list_members(self):
     expected = self.test_update()
     original = main.get_user_for_request
@@ -212,6 +336,55 @@ class MembersTestSuite(dao_test.BaseTestSuite):
     finally:
       main.get_user_for_request = original
 
+  def test_list_members_streamed(self):
+    expected = self.test_update()
+    original = main.get_user_for_request
+    try:
+      main.get_user_for_request = mock_get_admin_user_for_request
+
+      response = self.app.get('/api/rest/v1/members?stream=ndjson')
+      self.assertEqual(200, response.status_int)
+      self.assertEqual('application/x-ndjson', response.content_type)
+      lines = response.text[len(main.API_RESPONSE_PREFIX):].splitlines()
+      self.assertEqual(2, len(lines))
+      self.assertIn('user', json.loads(lines[0]))
+      self.assertEqual(expected, json.loads(lines[1])['profile'])
+
+      response = self.app.get('/api/rest/v1/members?stream=json')
+      members = main.parse_api_response(response.text)['result']
+      self.assertEqual(1, len(members))
+      self.assertEqual(expected, members[0]['profile'])
+
+      response = self.app.get(
+          '/api/rest/v1/members?stream=xml', expect_errors=True)
+      self.assertEqual(400, response.status_int)
+    finally:
+      main.get_user_for_request = original
+
+  def test_get_member_by_slug(self):
+    expected = self.test_update()
+    slug = dao.Members().query_members()[0].slug
+    original = main.get_user_for_request
+    try:
+      main.get_user_for_request = mock_get_admin_user_for_request
+      response = self.app.get('/api/rest/v1/members/%s' % slug)
+      self.assertEqual(200, response.status_int)
+      member = main.parse_api_response(response.text)['result']
+      self.assertEqual(slug, member['slug'])
+      self.assertEqual(expected, member['profile'])
+
+      response = self.app.get('/api/rest/v1/members/no-such-slug',
+                              expect_errors=True)
+      self.assertEqual(404, response.status_int)
+
+      # private profiles are only visible to admins
+      main.get_user_for_request = mock_get_rogue_user_for_request
+      response = self.app.get('/api/rest/v1/members/%s' % slug,
+                              expect_errors=True)
+      self.assertEqual(404, response.status_int)
+    finally:
+      main.get_user_for_request = original
+
 
 class PostsAndVotesTestSuite(MembersTestSuite):
   """Test cases for Posts and Votes."""
@@ -243,6 +416,149 @@ class PostsAndVotesTestSuite(MembersTestSuite):
 
     self._with_user(then)
 
+  def test__api_posts_get__not_modified(self):
+
+    def then(unused_member_uid):
+      self.insert_post()
+      response = self.app.get('/api/rest/v1/posts')
+      etag = response.headers['ETag']
+      response = self.app.get(
+          '/api/rest/v1/posts', headers={'If-None-Match': etag})
+      self.assertEqual(304, response.status_int)
+      self.assertEqual(b'', response.body)
+
+      # other query has other ETag
+      response = self.app.get(
+          '/api/rest/v1/posts', params={'top': 1},
+          headers={'If-None-Match': etag})
+      self.assertEqual(200, response.status_int)
+
+      # any vote changes the posts
+      post_uid = main.parse_api_response(response.text)['result'][0]['uid']
+      etag = self.app.get('/api/rest/v1/member/posts').headers['ETag']
+      dao.Votes().insert_vote('other', post_uid, 1)
+      response = self.app.get(
+          '/api/rest/v1/member/posts', headers={'If-None-Match': etag})
+      self.assertEqual(200, response.status_int)
+
+      # view counts change as often as they are cached, unless not asked for
+      etag = response.headers['ETag']
+      fields_etag = self.app.get(
+          '/api/rest/v1/member/posts', params={'fields': 'result(uid)'}
+      ).headers['ETag']
+      old_get_generation = dao.PostViews.get_generation
+      dao.PostViews.get_generation = lambda unused_self: 'later'
+      try:
+        response = self.app.get(
+            '/api/rest/v1/member/posts', headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_int)
+        response = self.app.get(
+            '/api/rest/v1/member/posts', params={'fields': 'result(uid)'},
+            headers={'If-None-Match': fields_etag})
+        self.assertEqual(304, response.status_int)
+      finally:
+        dao.PostViews.get_generation = old_get_generation
+
+    self._with_user(then)
+
+  def test__api_posts_get__streamed(self):
+
+    def then(member_uid):
+      posts = dao.Posts()
+      for index in range(main.STREAM_PAGE_SIZE + 10):
+        posts.insert_post(member_uid, json.dumps({'text': str(index)}))
+      expected = main.parse_api_response(
+          self.app.get('/api/rest/v1/posts').text)
+
+      response = self.app.get('/api/rest/v1/posts?stream=json')
+      self.assertEqual(200, response.status_int)
+      self.assertIn('ETag', response.headers)
+      result = main.parse_api_response(response.text)
+      self.assertEqual(expected['user'], result['user'])
+      self.assertEqual(
+          sorted([post['uid'] for post in expected['result']]),
+          sorted([post['uid'] for post in result['result']]))
+
+      response = self.app.get('/api/rest/v1/posts?stream=ndjson')
+      lines = response.text[len(main.API_RESPONSE_PREFIX):].splitlines()
+      self.assertEqual(1 + main.STREAM_PAGE_SIZE + 10, len(lines))
+      self.assertEqual(
+          expected['result'][0], [json.loads(line) for line in lines[1:]][0])
+
+      response = self.app.get('/api/rest/v1/posts?stream=json&top=3')
+      self.assertEqual(
+          expected['result'][:3],
+          main.parse_api_response(response.text)['result'])
+
+    self._with_user(then)
+
+  def test__api_posts_get__compressed(self):
+
+    def then(member_uid):
+      for _ in range(20):
+        dao.Posts().insert_post(member_uid, json.dumps({'text': 'Hello!'}))
+      # webtest decodes gzip responses; we need the raw bytes here
+      client = main.app.test_client()
+      response = client.get('/api/rest/v1/posts', headers={
+          'Accept-Encoding': 'gzip'})
+      self.assertEqual('gzip', response.headers['Content-Encoding'])
+      self.assertIn('Accept-Encoding', response.headers['Vary'])
+      self.assertEqual(20, len(main.parse_api_response(gzip.decompress(
+          response.data).decode('utf-8'))['result']))
+
+      response = client.get('/api/rest/v1/ping', headers={
+          'Accept-Encoding': 'gzip'})
+      self.assertNotIn('Content-Encoding', response.headers)
+
+    self._with_user(then)
+
+  def test__api_posts_get__fields(self):
+
+    def then(member_uid):
+      post = dao.Posts().insert_post(
+          member_uid, json.dumps({'title': 'Hello!', 'text': 'World.'}))
+      response = self.app.get(
+          '/api/rest/v1/posts?fields=result(uid,votes_total,data/title)')
+      self.assertEqual(200, response.status_int)
+      result = main.parse_api_response(response.text)
+      self.assertEqual(['result'], list(result.keys()))
+      self.assertEqual(
+          ['data', 'uid', 'votes_total'], sorted(result['result'][0].keys()))
+      self.assertEqual({'title': 'Hello!'}, result['result'][0]['data'])
+
+      # member is not read if client didn't ask for any of its fields
+      original = dao.Members.get_or_create_member
+      dao.Members.get_or_create_member = None
+      try:
+        response = self.app.get(
+            '/api/rest/v1/posts/changes'
+            '?fields=user(uid,roles),result(has_more,posts/uid)')
+      finally:
+        dao.Members.get_or_create_member = original
+      self.assertEqual({
+          'user': {'uid': member_uid, 'roles': main.ROLES_ALL},
+          'result': {'has_more': False, 'posts': [{'uid': post.key.id}]},
+      }, main.parse_api_response(response.text))
+
+      response = self.app.get(
+          '/api/rest/v1/posts?stream=json&fields=result/uid')
+      self.assertEqual(
+          [['uid']], [list(post.keys()) for post in main.parse_api_response(
+              response.text)['result']])
+      response = self.app.get(
+          '/api/rest/v1/posts?stream=ndjson&fields=app,result/data/text')
+      lines = response.text[len(main.API_RESPONSE_PREFIX):].splitlines()
+      self.assertEqual(['app'], list(json.loads(lines[0]).keys()))
+      self.assertEqual({'data': {'text': 'World.'}}, json.loads(lines[1]))
+
+      response = self.app.get(
+          '/api/rest/v1/posts?fields=result(uid', expect_errors=True)
+      self.assertEqual(400, response.status_int)
+      self.assertEqual('fields', main.parse_api_response(
+          response.text)['name'])
+
+    self._with_user(then)
+
   def test__api_posts_post(self):
 
     def then(unused_member_uid):
@@ -289,9 +605,408 @@ class PostsAndVotesTestSuite(MembersTestSuite):
           }),
       })
       self.assertEqual(200, response.status_int)
+      self.assertEqual(1, main.parse_api_response(
+          response.text)['result']['my_vote_value'])
+
+      # shared cache evicts recent writes at once; vote value is still sent
+      registry = container.Registry.current()
+      old_shared_cache = registry.patch(
+          'shared_cache', cache.InProcessCache(max_items=0))
+      try:
+        response = self.app.put('/api/rest/v1/votes', {
+            'vote': json.dumps({
+                'uid': dao.Posts().query_posts()[0].key.id,
+                'value': -1,
+            }),
+        })
+        self.assertEqual(-1, main.parse_api_response(
+            response.text)['result']['my_vote_value'])
+        response = self.app.put('/api/rest/v1/votes/bulk', {
+            'votes': json.dumps([
+                {'uid': dao.Posts().query_posts()[0].key.id, 'value': 1},
+            ]),
+        })
+        self.assertEqual(1, main.parse_api_response(
+            response.text)['result'][0]['result']['my_vote_value'])
+      finally:
+        registry.patch('shared_cache', old_shared_cache)
+
+    self._with_user(then)
+
+  def test__api_batch(self):
+
+    def then(member_uid):
+      post_uid = dao.Posts().insert_post(member_uid, '{}').key.id
+      etag = self.app.get('/api/rest/v1/members').headers['ETag']
+
+      # user is verified once for the whole batch
+      verified = []
+      def mock_get_user_for_request(request):
+        verified.append(request.path)
+        return mock_get_admin_user_for_request(request)
+      main.get_user_for_request = mock_get_user_for_request
+
+      response = self.app.post('/api/rest/v1/batch', {
+          'requests': json.dumps([
+              {'method': 'GET', 'path': '/api/rest/v1/whoami'},
+              {'method': 'GET', 'path': '/api/rest/v1/posts'},
+              {'method': 'GET', 'path': '/api/rest/v1/members',
+               'if_none_match': etag},
+              {'method': 'PUT', 'path': '/api/rest/v1/votes', 'params': {
+                  'vote': json.dumps({'uid': post_uid, 'value': 1})}},
+              {'method': 'GET', 'path': '/api/rest/v1/member/posts'},
+              {'method': 'GET', 'path': '/api/rest/v1/posts',
+               'params': {'top': 'x'}},
+              {'method': 'GET', 'path': '/api/rest/v1/no-such-path'},
+              {'method': 'POST', 'path': '/api/rest/v1/batch'},
+          ]),
+      })
+      self.assertEqual(200, response.status_int)
+      self.assertEqual(['/api/rest/v1/batch'], verified)
+
+      data = main.parse_api_response(response.text)
+      self.assertEqual(member_uid, data['user']['uid'])
+      results = data['result']
+      self.assertEqual(
+          [200, 200, 304, 200, 200, 400, 404, 400],
+          [result['status'] for result in results])
+      self.assertNotIn('result', results[0])
+      self.assertEqual([None], [
+          post['my_vote_value'] for post in results[1]['result']])
+      self.assertEqual(etag, results[2]['etag'])
+      self.assertEqual(1, results[3]['result']['votes_total'])
+      self.assertEqual([1], [
+          post['my_vote_value'] for post in results[4]['result']])
+      self.assertEqual('top', results[5]['error']['name'])
+
+    self._with_user(then)
+
+  def test__api_batch_invalid(self):
+
+    def then(unused_member_uid):
+      for requests in [
+          None, '[', '[]', json.dumps([{'method': 'DELETE', 'path': '/'}]),
+          json.dumps([{'method': 'GET'}] * (main.MAX_REQUESTS_IN_BATCH + 1)),
+          json.dumps([{'method': 'GET', 'path': '/api/rest/v1/posts',
+                       'params': {'stream': 'json'}}]),
+          json.dumps([{'method': 'GET',
+                       'path': '/api/rest/v1/posts?top=1&stream=ndjson'}])]:
+        response = self.app.post('/api/rest/v1/batch', {
+            'requests': requests} if requests else {}, expect_errors=True)
+        self.assertEqual(400, response.status_int)
+
+    self._with_user(then)
+
+  def test__api_votes_bulk_put(self):
+
+    def then(member_uid):
+      post_uid = dao.Posts().insert_post(member_uid, '{}').key.id
+      response = self.app.put('/api/rest/v1/votes/bulk', {
+          'votes': json.dumps([
+              {'uid': post_uid, 'value': 1},
+              {'uid': post_uid, 'value': -1},
+              {'uid': 123456789, 'value': 1},
+              {'uid': post_uid, 'value': 5},
+              {'uid': [post_uid], 'value': 1},
+              {'uid': 'x' * 2000, 'value': 1},
+          ]),
+      })
+      self.assertEqual(200, response.status_int)
+      results = main.parse_api_response(response.text)['result']
+      self.assertEqual(
+          [200, 200, 404, 400, 400, 400],
+          [result['status'] for result in results])
+      self.assertEqual(post_uid, results[0]['uid'])
+      self.assertEqual(-1, results[0]['result']['my_vote_value'])
+      self.assertEqual(-1, results[1]['result']['votes_total'])
+      self.assertEqual(-1, results[1]['result']['my_vote_value'])
+      self.assertEqual(-1, dao.Posts().get_post(post_uid).votes_total)
+
+      response = self.app.put('/api/rest/v1/votes/bulk', {
+          'votes': json.dumps([{'uid': post_uid}]),
+      }, expect_errors=True)
+      self.assertEqual(400, response.status_int)
+
+    self._with_user(then)
+
+  def test__api_posts_get__top(self):
+
+    def then(unused_member_uid):
+      for _ in range(3):
+        self.insert_post()
+      response = self.app.get('/api/rest/v1/posts', params={'top': 2})
+      self.assertEqual(200, response.status_int)
+      self.assertEqual(
+          2, len(main.parse_api_response(response.text)['result']))
+
+      response = self.app.get('/api/rest/v1/posts', params={
+          'top': dao.Leaderboards.SIZE + 1}, expect_errors=True)
+      self.assertEqual(400, response.status_int)
+
+    self._with_user(then)
+
+  def test__api_posts_get__moderation(self):
+
+    def then(unused_member_uid):
+      for _ in range(2):
+        self.insert_post()
+      posts = dao.Posts()
+      post_uid = posts.query_posts()[0].key.id
+      posts.set_moderation({post_uid: ['EMAIL_ADDRESS']})
+
+      response = self.app.get('/api/rest/v1/posts', params={
+          'moderation': dao.MODERATION_FLAGGED})
+      self.assertEqual(200, response.status_int)
+      self.assertEqual(
+          [post_uid],
+          [item['uid'] for item in main.parse_api_response(
+              response.text)['result']])
+      response = self.app.get('/api/rest/v1/posts', params={
+          'moderation': dao.MODERATION_PENDING, 'top': 2})
+      self.assertEqual(
+          1, len(main.parse_api_response(response.text)['result']))
+
+      response = self.app.get('/api/rest/v1/posts', params={
+          'moderation': 'unknown'}, expect_errors=True)
+      self.assertEqual(400, response.status_int)
+
+      # filter applies before top posts are picked
+      other_uid = [post.key.id for post in posts.query_posts()
+                   if post.key.id != post_uid][0]
+      dao.Votes().insert_vote('member-2', other_uid, 1)
+      response = self.app.get('/api/rest/v1/posts', params={
+          'moderation': dao.MODERATION_FLAGGED, 'top': 1})
+      self.assertEqual(
+          [post_uid],
+          [item['uid'] for item in main.parse_api_response(
+              response.text)['result']])
+
+    self._with_user(then)
+
+  def test__api_posts_get__moderation_needs_moderator(self):
+
+    def then(unused_member_uid):
+      for _ in range(2):
+        self.insert_post()
+      posts = dao.Posts()
+      flagged_uid, other_uid = [post.key.id for post in posts.query_posts()]
+      posts.set_moderation({flagged_uid: ['EMAIL_ADDRESS'], other_uid: []})
+      dao.Votes().insert_vote('member-2', flagged_uid, 1)
+
+      main.get_user_for_request = mock_get_whiteisted_email_user_for_request
+      for moderation in [dao.MODERATION_FLAGGED, dao.MODERATION_PENDING]:
+        response = self.app.get('/api/rest/v1/posts', params={
+            'moderation': moderation}, expect_errors=True)
+        self.assertEqual(403, response.status_int)
+
+      # flagged posts are not listed at all
+      for params in [{}, {'top': 1}, {'stream': 'json'}, {
+          'moderation': dao.MODERATION_APPROVED}]:
+        response = self.app.get('/api/rest/v1/posts', params=params)
+        self.assertEqual(200, response.status_int)
+        self.assertEqual(
+            [other_uid],
+            [item['uid'] for item in main.parse_api_response(
+                response.text)['result']])
+
+    self._with_user(then)
+
+  def test__api_activity(self):
+
+    def then(unused_member_uid):
+      self.insert_post()
+      response = self.app.get('/api/rest/v1/activity/posts', params={
+          'granularity': 'day', 'count': 3})
+      self.assertEqual(200, response.status_int)
+      result = main.parse_api_response(response.text)['result']
+      self.assertEqual('day', result['granularity'])
+      self.assertEqual([0, 0, 1], [
+          bucket['count'] for bucket in result['buckets']])
+
+      response = self.app.get('/api/rest/v1/activity/posts', params={
+          'count': dao.ActivityCounters.MAX_BUCKETS + 1}, expect_errors=True)
+      self.assertEqual(400, response.status_int)
+      response = self.app.get('/api/rest/v1/activity/posts', params={
+          'granularity': 'week'}, expect_errors=True)
+      self.assertEqual(400, response.status_int)
+      response = self.app.get(
+          '/api/rest/v1/activity/unknown', expect_errors=True)
+      self.assertEqual(404, response.status_int)
+
+    self._with_user(then)
+
+  def test__api_posts_get__sees_own_writes(self):
+
+    def then(unused_member_uid):
+      original = dao.Posts.query_posts
+      try:
+        # index lag; query does not see any posts
+        dao.Posts.query_posts = lambda self, moderation=None: []
+        self.insert_post()
+        posts = self.list_posts()
+        self.assertEqual(1, len(posts))
+        self.assertTrue(posts[0]['can_delete'])
+        self.assertEqual(1, len(self.list_post_changes()['posts']))
+      finally:
+        dao.Posts.query_posts = original
+
+    self._with_user(then)
+
+  def test__api_posts_views(self):
+
+    def then(unused_member_uid):
+      self.insert_post()
+      post_uid = self.list_posts()[0]['uid']
+      response = self.app.put('/api/rest/v1/posts/views', params={
+          'views': json.dumps([post_uid, post_uid])})
+      self.assertEqual(200, response.status_int)
+      self.assertEqual(1, self.list_posts()[0]['views'])
+
+      for views in [json.dumps({}), '[1', json.dumps([[1]]),
+                    json.dumps(['x' * 2000]), json.dumps([True])]:
+        response = self.app.put('/api/rest/v1/posts/views', params={
+            'views': views}, expect_errors=True)
+        self.assertEqual(400, response.status_int)
+
+    original = dao._POST_VIEWS_PENDING
+    try:
+      dao._POST_VIEWS_PENDING = counters.WriteBehindCounter(
+          lambda unused_deltas: None, background=False)
+      self._with_user(then)
+    finally:
+      dao._POST_VIEWS_PENDING = original
+
+  def list_post_changes(self, since=None):
+    params = {'since': since} if since else {}
+    response = self.app.get('/api/rest/v1/posts/changes', params=params)
+    self.assertEqual(200, response.status_int)
+    return main.parse_api_response(response.text)['result']
+
+  def test__api_posts_changes(self):
+
+    def then(unused_member_uid):
+      self.insert_post()
+      changes = self.list_post_changes()
+      self.assertEqual(1, len(changes['posts']))
+      self.assertFalse(changes['has_more'])
+      watermark = changes['watermark']
+
+      # nothing changed after exact watermark
+      since = main.Watermark.from_token(watermark).since
+      self.assertFalse(self.list_post_changes(
+          main.Watermark(since, is_exact=True).to_token())['posts'])
+
+      # exact watermark of a full page keeps uid of the last post sent
+      parsed = main.Watermark.from_token(main.Watermark(
+          since, is_exact=True, after_uid=123).to_token())
+      self.assertEqual((since, True, 123),
+                       (parsed.since, parsed.is_exact, parsed.after_uid))
+
+      # deleted posts are reported
+      uid = dao.Posts().query_posts()[0].key.id
+      self.app.post('/api/rest/v1/posts', {
+          'post': json.dumps({'uid': uid}),
+      })
+      changes = self.list_post_changes(watermark)
+      self.assertEqual([], changes['posts'])
+      self.assertEqual([uid], changes['deleted'])
+
+    self._with_user(then)
+
+  def test__api_posts_changes__flagged_posts(self):
+
+    def then(unused_member_uid):
+      for _ in range(2):
+        self.insert_post()
+      main.get_user_for_request = mock_get_whiteisted_email_user_for_request
+      watermark = self.list_post_changes()['watermark']
+      posts = dao.Posts()
+      flagged_uid, other_uid = [post.key.id for post in posts.query_posts()]
+      posts.set_moderation({flagged_uid: ['EMAIL_ADDRESS'], other_uid: []})
+
+      # flagged post is reported deleted, so client drops its copy
+      changes = self.list_post_changes(watermark)
+      self.assertEqual([other_uid], [item['uid'] for item in changes['posts']])
+      self.assertEqual([flagged_uid], changes['deleted'])
+      self.assertEqual(
+          [other_uid],
+          [item['uid'] for item in self.list_post_changes()['posts']])
+
+      # moderators still see it
+      main.get_user_for_request = mock_get_admin_user_for_request
+      changes = self.list_post_changes(watermark)
+      self.assertEqual(2, len(changes['posts']))
+      self.assertEqual([], changes['deleted'])
+
+    self._with_user(then)
+
+  def test__api_posts_changes__bad_watermark(self):
+
+    def then(unused_member_uid):
+      response = self.app.get('/api/rest/v1/posts/changes', params={
+          'since': 'not-a-watermark'}, expect_errors=True)
+      self.assertEqual(400, response.status_int)
+
+    self._with_user(then)
+
+  def test__api_posts_put__rate_limited(self):
+
+    def then(unused_member_uid):
+      limit = main.RATE_LIMITS['api_v1_posts_insert']
+      for _ in range(limit.burst):
+        self.insert_post()
+      writes = len(self.client.items)
+
+      response = self.app.put('/api/rest/v1/posts', {
+          'post': '{}'
+      }, expect_errors=True)
+      self.assertEqual(429, response.status_int)
+      self.assertTrue(int(response.headers['Retry-After']) >= 1)
+      self.assertEqual(
+          'TooManyRequestsError',
+          main.parse_api_response(response.text)['code'])
+      self.assertEqual(writes, len(self.client.items))
+      self.assertEqual(limit.burst, len(self.list_posts()))
+
+    self._with_user(then)
+
+  def test__api_votes_bulk_put__rate_limited(self):
+
+    def then(member_uid):
+      post_uid = dao.Posts().insert_post(member_uid, '{}').key.id
+      limit = main.RATE_LIMITS['api_v1_votes_put']
+      response = self.app.put('/api/rest/v1/votes/bulk', {
+          'votes': json.dumps([{'uid': post_uid, 'value': 1}] * (
+              limit.burst - 1)),
+      })
+      self.assertEqual(200, response.status_int)
+
+      # bulk votes take tokens of single votes
+      response = self.app.put('/api/rest/v1/votes/bulk', {
+          'votes': json.dumps([{'uid': post_uid, 'value': 1}] * 2),
+      }, expect_errors=True)
+      self.assertEqual(429, response.status_int)
+      response = self.app.put('/api/rest/v1/votes', {
+          'vote': json.dumps({'uid': post_uid, 'value': -1}),
+      })
+      self.assertEqual(200, response.status_int)
+      response = self.app.put('/api/rest/v1/votes', {
+          'vote': json.dumps({'uid': post_uid, 'value': 1}),
+      }, expect_errors=True)
+      self.assertEqual(429, response.status_int)
 
     self._with_user(then)
 
+  def test_rate_limit_store_prefers_shared_cache(self):
+    registry = container.Registry.current()
+    self.assertIs(registry.cache, main.get_rate_limit_store())
+    shared_cache = cache.InProcessCache()
+    old_shared_cache = registry.patch('shared_cache', shared_cache)
+    try:
+      self.assertIs(shared_cache, main.get_rate_limit_store())
+    finally:
+      registry.patch('shared_cache', old_shared_cache)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,117 @@
+"""Moderation of posts with Data Loss Prevention (DLP) API.
+
+New posts are inserted in pending moderation state, so the write path does
+not wait for DLP; a job later picks up pending posts, packs the content of
+many posts into one DLP inspect() call and records the findings in each post.
+"""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import bisect
+import logging
+import dao
+
+
+# info types we look for in posts; we do not let DLP list all of them as
+# it costs an extra call and brings in many noisy info types
+DEFAULT_INFO_TYPES = [
+    'CREDIT_CARD_NUMBER',
+    'EMAIL_ADDRESS',
+    'IBAN_CODE',
+    'PHONE_NUMBER',
+    'US_SOCIAL_SECURITY_NUMBER',
+]
+
+# DLP accepts up to 0.5 MB of content per request; we stay well below it
+MAX_BATCH_BYTES = 256 * 1024
+MAX_BATCH_POSTS = 50
+
+# content of posts in one batch is joined by this separator
+_SEPARATOR = b'\n'
+
+
+def pack(posts, max_bytes=MAX_BATCH_BYTES, max_posts=MAX_BATCH_POSTS):
+  """Yields batches of (post_uid, content) to inspect in one call each.
+
+  A post larger than max_bytes is put into a batch of its own.
+  """
+  batch = []
+  size = 0
+  for post in posts:
+    content = post.data.encode('utf-8')
+    if batch and (len(batch) >= max_posts or
+                  size + len(_SEPARATOR) + len(content) > max_bytes):
+      yield batch
+      batch = []
+      size = 0
+    if batch:
+      size += len(_SEPARATOR)
+    batch.append((post.key.id_or_name, content))
+    size += len(content)
+  if batch:
+    yield batch
+
+
+class Moderator(object):
+  """Inspects posts pending moderation and records findings."""
+
+  def __init__(self, dlp, posts=None, project_id=None,
+               info_types=None, max_batch_bytes=MAX_BATCH_BYTES,
+               max_batch_posts=MAX_BATCH_POSTS):
+    self._dlp = dlp
+    self._posts = posts if posts else dao.Posts()
+    self._project_id = project_id or 'projects/%s' % dlp.PROJECT
+    self._info_types = info_types or DEFAULT_INFO_TYPES
+    self._max_batch_bytes = max_batch_bytes
+    self._max_batch_posts = max_batch_posts
+
+  def inspect(self, batch):
+    """Inspects a batch in one DLP call; returns post_uid to info types found.
+
+    Findings are mapped back to posts by their byte offsets in the packed
+    content; if DLP truncates findings, the batch is split and inspected
+    again in halves, so no post is approved without being fully inspected.
+    """
+    starts = []
+    offset = 0
+    for _, content in batch:
+      starts.append(offset)
+      offset += len(content) + len(_SEPARATOR)
+    content = _SEPARATOR.join([content for _, content in batch])
+
+    response = self._dlp.inspect(
+        self._project_id, content.decode('utf-8'),
+        type_names=self._info_types)
+    result = response.get('result', {})
+    if result.get('findingsTruncated') and len(batch) > 1:
+      middle = len(batch) // 2
+      found = self.inspect(batch[:middle])
+      found.update(self.inspect(batch[middle:]))
+      return found
+
+    found = dict([(post_uid, []) for post_uid, _ in batch])
+    for finding in result.get('findings', []):
+      byte_range = finding.get('location', {}).get('byteRange', {})
+      index = bisect.bisect_right(starts, int(byte_range.get('start', 0))) - 1
+      found[batch[index][0]].append(finding['infoType']['name'])
+    return found
+
+  def moderate_pending(self, limit):
+    """Moderates up to limit pending posts.
+
+    Returns:
+      A tuple of (number of posts inspected, number of posts flagged).
+    """
+    inspected = 0
+    flagged = 0
+    for batch in pack(self._posts.query_pending_moderation(limit),
+                      max_bytes=self._max_batch_bytes,
+                      max_posts=self._max_batch_posts):
+      found = self.inspect(batch)
+      self._posts.set_moderation(found)
+      inspected += len(batch)
+      flagged += len([names for names in found.values() if names])
+      logging.info('Moderated %s posts, %s flagged', inspected, flagged)
+    return inspected, flagged
@@ -0,0 +1,100 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import json
+import unittest
+import dao
+import dao_test
+import moderation
+
+
+class MockDataLossPreventionService(object):
+  """Mock DLP service; finds all occurrences of the words it knows."""
+
+  PROJECT = 'test-project'
+
+  def __init__(self, words, max_findings=None):
+    self.words = words
+    self.max_findings = max_findings
+    self.calls = []
+
+  def inspect(self, project_id, content, type_names=None):
+    self.calls.append((project_id, content, type_names))
+    data = content.encode('utf-8')
+    findings = []
+    for word, info_type in sorted(self.words.items()):
+      start = data.find(word.encode('utf-8'))
+      while start != -1:
+        byte_range = {'end': str(start + len(word.encode('utf-8')))}
+        if start:
+          byte_range['start'] = str(start)
+        findings.append({
+            'infoType': {'name': info_type},
+            'location': {'byteRange': byte_range},
+        })
+        start = data.find(word.encode('utf-8'), start + 1)
+    result = {}
+    if self.max_findings is not None and len(findings) > self.max_findings:
+      findings = findings[:self.max_findings]
+      result['findingsTruncated'] = True
+    if findings:
+      result['findings'] = findings
+    return {'result': result}
+
+
+class ModeratorTestSuite(dao_test.BaseTestSuite):
+  """Test cases for Moderator."""
+
+  def setUp(self):
+    super(ModeratorTestSuite, self).setUp()
+    self.posts = dao.Posts()
+    dao.Members().get_or_create_member('member-1')
+    self.post_uids = []
+    for text in ['hello', 'mail me at a@b.c', 'café 555-0100', 'bye']:
+      post = self.posts.insert_post(
+          'member-1', json.dumps({'text': text}, ensure_ascii=False))
+      self.post_uids.append(post.key.id)
+    self.dlp = MockDataLossPreventionService({
+        'a@b.c': 'EMAIL_ADDRESS', '555-0100': 'PHONE_NUMBER'})
+
+  def test_pack(self):
+    posts = self.posts.get_posts(self.post_uids)
+    batches = list(moderation.pack(posts, max_posts=3))
+    self.assertEqual([3, 1], [len(batch) for batch in batches])
+    batches = list(moderation.pack(posts, max_bytes=40))
+    self.assertEqual([1, 1, 1, 1], [len(batch) for batch in batches])
+    self.assertEqual(
+        [self.post_uids[0]], [post_uid for post_uid, _ in batches[0]])
+
+  def test_moderate_pending(self):
+    moderator = moderation.Moderator(self.dlp, posts=self.posts)
+    self.assertEqual((4, 2), moderator.moderate_pending(10))
+    self.assertEqual(1, len(self.dlp.calls))
+    self.assertEqual('projects/test-project', self.dlp.calls[0][0])
+    self.assertEqual(
+        [dao.MODERATION_APPROVED, dao.MODERATION_FLAGGED,
+         dao.MODERATION_FLAGGED, dao.MODERATION_APPROVED],
+        [post.moderation for post in self.posts.get_posts(self.post_uids)])
+    self.assertEqual(
+        ['PHONE_NUMBER'],
+        self.posts.get_post(self.post_uids[2]).moderation_findings)
+    self.assertEqual((0, 0), moderator.moderate_pending(10))
+
+  def test_truncated_findings_are_inspected_again(self):
+    self.dlp.max_findings = 1
+    moderator = moderation.Moderator(self.dlp, posts=self.posts)
+    self.assertEqual((4, 2), moderator.moderate_pending(10))
+    self.assertLess(1, len(self.dlp.calls))
+    self.assertEqual(
+        ['EMAIL_ADDRESS'],
+        self.posts.get_post(self.post_uids[1]).moderation_findings)
+    self.assertEqual(
+        ['PHONE_NUMBER'],
+        self.posts.get_post(self.post_uids[2]).moderation_findings)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,88 @@
+"""Token bucket rate limiting of member writes."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import collections
+import math
+import threading
+import time
+
+
+# rate limit for one route; bucket holds up to "burst" tokens, which are
+# refilled at "per_second" tokens per second; each call takes one token
+Limit = collections.namedtuple('Limit', ['burst', 'per_second'])
+
+
+class TokenBucket(object):
+  """Token bucket of one member for one route."""
+
+  def __init__(self, limit, tokens=None, updated_on=None):
+    self.limit = limit
+    self.tokens = limit.burst if tokens is None else tokens
+    self.updated_on = updated_on
+
+  def _refill(self, now):
+    if self.updated_on is not None and now > self.updated_on:
+      self.tokens = min(
+          self.limit.burst,
+          self.tokens + (now - self.updated_on) * self.limit.per_second)
+    self.updated_on = now
+
+  def consume(self, now, cost=1):
+    """Takes tokens; returns 0 if allowed or seconds to wait otherwise."""
+    self._refill(now)
+    if self.tokens >= cost:
+      self.tokens -= cost
+      return 0
+    return (cost - self.tokens) / self.limit.per_second
+
+  def seconds_to_full(self):
+    return (self.limit.burst - self.tokens) / self.limit.per_second
+
+  def to_state(self):
+    return (self.tokens, self.updated_on)
+
+  @classmethod
+  def from_state(cls, limit, state):
+    if not state:
+      return cls(limit)
+    tokens, updated_on = state
+    return cls(limit, tokens=tokens, updated_on=updated_on)
+
+
+class RateLimiter(object):
+  """Keeps token buckets per member uid and per route.
+
+  Bucket state is kept in a cache; by default it is the in-process cache, but
+  a shared cache can be used to enforce limits across all server instances;
+  updates of a shared cache are not atomic, so concurrent requests from the
+  same member to different instances may occasionally get extra tokens.
+  """
+
+  KEY_PREFIX = 'ratelimit'
+
+  def __init__(self, limits, clock=time.time):
+    self._limits = limits
+    self._clock = clock
+    self._lock = threading.Lock()
+
+  def limit_for(self, route):
+    return self._limits.get(route)
+
+  def _key(self, route, member_uid):
+    return '%s/%s/%s' % (self.KEY_PREFIX, route, member_uid)
+
+  def check(self, store, route, member_uid, cost=1):
+    """Takes tokens from a bucket; returns seconds to wait or 0 if allowed."""
+    limit = self.limit_for(route)
+    if not limit:
+      return 0
+    key = self._key(route, member_uid)
+    with self._lock:
+      bucket = TokenBucket.from_state(limit, store.get(key))
+      retry_after = bucket.consume(self._clock(), cost=cost)
+      store.set(key, bucket.to_state(),
+                ttl=max(1, int(math.ceil(bucket.seconds_to_full()))))
+    return retry_after
@@ -0,0 +1,70 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import unittest
+import cache
+import ratelimit
+
+
+class MockClock(object):
+  """Mock clock to use in tests."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TokenBucketTestSuite(unittest.TestCase):
+  """Test cases for TokenBucket."""
+
+  def test_burst_then_refill(self):
+    bucket = ratelimit.TokenBucket(ratelimit.Limit(burst=2, per_second=0.5))
+    self.assertEqual(0, bucket.consume(10.0))
+    self.assertEqual(0, bucket.consume(10.0))
+    self.assertEqual(2.0, bucket.consume(10.0))
+    self.assertEqual(1.0, bucket.consume(11.0))
+    self.assertEqual(0, bucket.consume(12.0))
+
+  def test_refill_is_capped_by_burst(self):
+    bucket = ratelimit.TokenBucket(ratelimit.Limit(burst=2, per_second=1.0))
+    bucket.consume(0.0)
+    bucket.consume(1000.0)
+    self.assertEqual(1, bucket.tokens)
+
+
+class RateLimiterTestSuite(unittest.TestCase):
+  """Test cases for RateLimiter."""
+
+  def setUp(self):
+    super(RateLimiterTestSuite, self).setUp()
+    self.clock = MockClock()
+    self.store = cache.InProcessCache(clock=self.clock)
+    self.limiter = ratelimit.RateLimiter({
+        'votes': ratelimit.Limit(burst=1, per_second=0.1),
+    }, clock=self.clock)
+
+  def test_unlimited_route(self):
+    for _ in range(100):
+      self.assertEqual(0, self.limiter.check(self.store, 'posts', 'm-1'))
+
+  def test_buckets_are_per_member(self):
+    self.assertEqual(0, self.limiter.check(self.store, 'votes', 'm-1'))
+    self.assertEqual(10.0, self.limiter.check(self.store, 'votes', 'm-1'))
+    self.assertEqual(0, self.limiter.check(self.store, 'votes', 'm-2'))
+
+  def test_bucket_state_expires_when_full(self):
+    self.assertEqual(0, self.limiter.check(self.store, 'votes', 'm-1'))
+    self.clock.now += 10
+    self.assertEqual(0, self.limiter.check(self.store, 'votes', 'm-1'))
+    self.assertTrue(self.store.get('ratelimit/votes/m-1'))
+    self.clock.now += 11
+    self.assertIsNone(self.store.get('ratelimit/votes/m-1'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,86 @@
+"""JSON encoding of API responses with a fast backend if it's installed.
+
+orjson is used if available; the standard json module is the fallback.
+Values that are already JSON, like post data we store as a string, can be
+wrapped into RawJSON and are then written out as is, without being parsed
+and encoded again.
+"""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import binascii
+import json
+import os
+import re
+
+
+# orjson is optional; it's several times faster than json module
+try:
+  import orjson  # pylint: disable=g-import-not-at-top
+except ImportError:
+  orjson = None
+
+
+class RawJSON(object):
+  """A fragment of valid JSON text to be included into output as is."""
+
+  __slots__ = ['json']
+
+  def __init__(self, json_string):
+    self.json = json_string
+
+  def __eq__(self, other):
+    return isinstance(other, RawJSON) and self.json == other.json
+
+  def __repr__(self):
+    return 'RawJSON(%r)' % self.json
+
+
+# raw fragments are first encoded as placeholder strings, which are then
+# replaced by fragments; the nonce prevents a string in the data from being
+# taken for a placeholder
+_NONCE = binascii.hexlify(os.urandom(8)).decode('ascii')
+_PLACEHOLDER = '__raw_json_%s_%%s__' % _NONCE
+_PLACEHOLDER_PATTERN = re.compile(
+    ('"%s"' % (_PLACEHOLDER % '([0-9]+)')).encode('ascii'))
+
+
+def backend_name():
+  return 'orjson' if orjson else 'json'
+
+
+def _dumps(value, default, sort_keys):
+  if orjson:
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+      option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(value, default=default, option=option)
+  return json.dumps(
+      value, default=default, sort_keys=sort_keys).encode('utf-8')
+
+
+def dumps(value, sort_keys=False):
+  """Returns value encoded as JSON bytes; RawJSON fragments are kept as is."""
+  fragments = []
+
+  def default(item):
+    if isinstance(item, RawJSON):
+      fragments.append(item.json)
+      return _PLACEHOLDER % (len(fragments) - 1)
+    raise TypeError(
+        'Object of type %s is not JSON serializable' % type(item).__name__)
+
+  data = _dumps(value, default, sort_keys)
+  if not fragments:
+    return data
+  return _PLACEHOLDER_PATTERN.sub(
+      lambda match: fragments[int(match.group(1))].encode('utf-8'), data)
+
+
+def loads(data):
+  """Returns value decoded from JSON str or bytes."""
+  if orjson:
+    return orjson.loads(data)
+  return json.loads(data)
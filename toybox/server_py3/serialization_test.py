@@ -0,0 +1,61 @@
+"""Tests."""
+
+
+__author__ = 'Pavel Simakov (psimakov@google.com)'
+
+
+import json
+import unittest
+import serialization
+
+
+class SerializationTestSuite(unittest.TestCase):
+  """Test cases for JSON serialization."""
+
+  def setUp(self):
+    super(SerializationTestSuite, self).setUp()
+    self.orjson = serialization.orjson
+
+  def tearDown(self):
+    serialization.orjson = self.orjson
+    super(SerializationTestSuite, self).tearDown()
+
+  def _test_dumps(self):
+    value = {
+        'b': [1, 2.5, None, True],
+        'a': serialization.RawJSON('{"text": "caf\\u00e9"}'),
+        'c': 'café',
+    }
+    data = serialization.dumps(value)
+    self.assertIsInstance(data, bytes)
+    self.assertEqual({
+        'b': [1, 2.5, None, True],
+        'a': {'text': 'café'},
+        'c': 'café',
+    }, json.loads(data.decode('utf-8')))
+    self.assertIn(b'{"text": "caf\\u00e9"}', data)
+
+    data = serialization.dumps(value, sort_keys=True)
+    self.assertLess(data.index(b'"a"'), data.index(b'"b"'))
+    self.assertEqual({'a': 1}, serialization.loads(b'{"a": 1}'))
+
+  def test_dumps(self):
+    self._test_dumps()
+
+  def test_dumps_without_orjson(self):
+    serialization.orjson = None
+    self._test_dumps()
+
+  def test_placeholder_like_strings_are_kept(self):
+    value = ['__raw_json_0123456789abcdef_0__', serialization.RawJSON('1')]
+    self.assertEqual(
+        ['__raw_json_0123456789abcdef_0__', 1],
+        json.loads(serialization.dumps(value).decode('utf-8')))
+
+  def test_not_serializable(self):
+    with self.assertRaises(TypeError):
+      serialization.dumps({'a': object()})
+
+
+if __name__ == '__main__':
+  unittest.main()